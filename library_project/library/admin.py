@@ -7,8 +7,10 @@ from django.shortcuts import render, redirect
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django import forms
-from .models import Book, Student, Pupil
+from .models import Book, Student, Pupil, Loan
+from . import cache
 from .library import Library
+from .search import search_books
 
 
 # Custom Forms for Borrowing/Returning in Admin
@@ -38,11 +40,22 @@ class BookAdmin(admin.ModelAdmin):
     list_display = ('id', 'title', 'author', 'isbn', 'year', 'quantity', 'label', 'borrower_count', 'view_borrowers')
     list_filter = ('label', 'year')
     search_fields = ('title', 'author', 'isbn')
+    readonly_fields = ('active_loans', 'total_copies')
+
+    def get_queryset(self, request):
+        # Borrower counts are computed in the changelist query itself
+        return super().get_queryset(request).with_borrower_counts()
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search through the full-text index instead of LIKE scans over search_fields."""
+        if not search_term.strip():
+            return queryset, False
+        return search_books(queryset, search_term), False
 
     def borrower_count(self, obj):
         """Count how many users have borrowed this book."""
-        student_count = obj.borrowed_by_students.count()
-        pupil_count = obj.borrowed_by_pupils.count()
+        student_count = obj.student_count
+        pupil_count = obj.pupil_count
         return f"{student_count + pupil_count} ({student_count} students, {pupil_count} pupils)"
 
     borrower_count.short_description = 'Borrowers'
@@ -59,6 +72,7 @@ class BookAdmin(admin.ModelAdmin):
     def mark_as_unavailable(self, request, queryset):
         """Mark selected books as unavailable (quantity=0)."""
         updated = queryset.update(quantity=0)
+        cache.invalidate(cache.BOOKS)
         self.message_user(request, f"{updated} books marked as unavailable.")
 
     mark_as_unavailable.short_description = "Mark selected books as unavailable"
@@ -66,35 +80,60 @@ class BookAdmin(admin.ModelAdmin):
     def mark_as_available(self, request, queryset):
         """Mark selected books as available with 1 copy."""
         updated = queryset.update(quantity=1)
+        cache.invalidate(cache.BOOKS)
         self.message_user(request, f"{updated} books marked as available (quantity=1).")
 
     mark_as_available.short_description = "Mark selected books as available (quantity=1)"
 
 
 class BorrowedBooksInline(admin.TabularInline):
-    model = Student.borrowed_books.through
-    extra = 1
+    """
+    A user's open loans. Only the due date can be changed here.
+
+    Opening, returning or moving a loan must go through Library (the
+    Borrow/Return buttons, or edit_borrowing), which moves the book's
+    stock counters in the same transaction. Saving Loan rows from the
+    inline would leave quantity and active_loans out of step.
+    """
+    model = Loan
+    fk_name = 'student'
+    fields = ('book', 'borrowed_at', 'due_at', 'change_loan')
+    readonly_fields = ('book', 'borrowed_at', 'change_loan')
+    extra = 0
+    can_delete = False
     verbose_name = "Borrowed Book"
     verbose_name_plural = "Borrowed Books"
 
-    def formfield_for_foreignkey(self, db_field, request, **kwargs):
-        if db_field.name == "book":
-            kwargs["queryset"] = Book.objects.filter(quantity__gt=0)
-        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+    def get_queryset(self, request):
+        # Only open loans; returned ones stay in the table as history
+        return super().get_queryset(request).active().select_related('book', self.fk_name)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def change_loan(self, obj):
+        """Link to change or return this loan in the front-end."""
+        url = reverse('edit_borrowing', args=[obj.borrower_type, obj.borrower.user_id, obj.book_id])
+        return format_html('<a href="{}" class="button">Change or Return</a>', url)
+
+    change_loan.short_description = 'Actions'
 
 
 class StudentAdmin(admin.ModelAdmin):
     list_display = ('user_id', 'name', 'surname', 'group', 'borrowed_book_count', 'view_books', 'admin_actions')
     search_fields = ('user_id', 'name', 'surname', 'group')
     list_filter = ('group',)
-    exclude = ('borrowed_books',)
     inlines = [BorrowedBooksInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_borrowed_count()
+
     def borrowed_book_count(self, obj):
         """Count how many books this student has borrowed."""
-        return obj.borrowed_books.count()
+        return obj.borrowed_count
 
     borrowed_book_count.short_description = 'Books Borrowed'
+    borrowed_book_count.admin_order_field = 'borrowed_count'
 
     def view_books(self, obj):
         """Link to view borrowed books in the front-end."""
@@ -119,17 +158,11 @@ class StudentAdmin(admin.ModelAdmin):
     actions = ['return_all_books']
 
     def return_all_books(self, request, queryset):
-        """Return all books borrowed by selected students."""
-        total_returned = 0
-        for student in queryset:
-            books = list(student.borrowed_books.all())
-            for book in books:
-                book.quantity += 1
-                book.save()
-                student.borrowed_books.remove(book)
-                total_returned += 1
-
-        self.message_user(request, f"{total_returned} books returned from {queryset.count()} students.")
+        """Return all books borrowed by selected students in one transaction."""
+        returned, borrowers = Library.return_all_books(queryset)
+        self.message_user(
+            request, f"{returned} books returned from {borrowers} of {queryset.count()} selected students."
+        )
 
     return_all_books.short_description = "Return all books from selected students"
 
@@ -251,30 +284,25 @@ class StudentAdmin(admin.ModelAdmin):
         return TemplateResponse(request, 'admin/library/return_book.html', context)
 
 
-class PupilBorrowedBooksInline(admin.TabularInline):
-    model = Pupil.borrowed_books.through
-    extra = 1
-    verbose_name = "Borrowed Book"
-    verbose_name_plural = "Borrowed Books"
-
-    def formfield_for_foreignkey(self, db_field, request, **kwargs):
-        if db_field.name == "book":
-            kwargs["queryset"] = Book.objects.filter(quantity__gt=0, label='for children')
-        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+class PupilBorrowedBooksInline(BorrowedBooksInline):
+    fk_name = 'pupil'
 
 
 class PupilAdmin(admin.ModelAdmin):
     list_display = ('user_id', 'name', 'surname', 'group', 'age', 'borrowed_book_count', 'view_books', 'admin_actions')
     search_fields = ('user_id', 'name', 'surname', 'group')
     list_filter = ('group', 'age')
-    exclude = ('borrowed_books',)
     inlines = [PupilBorrowedBooksInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_borrowed_count()
+
     def borrowed_book_count(self, obj):
         """Count how many books this pupil has borrowed."""
-        return obj.borrowed_books.count()
+        return obj.borrowed_count
 
     borrowed_book_count.short_description = 'Books Borrowed'
+    borrowed_book_count.admin_order_field = 'borrowed_count'
 
     def view_books(self, obj):
         """Link to view borrowed books in the front-end."""
@@ -299,17 +327,11 @@ class PupilAdmin(admin.ModelAdmin):
     actions = ['return_all_books']
 
     def return_all_books(self, request, queryset):
-        """Return all books borrowed by selected pupils."""
-        total_returned = 0
-        for pupil in queryset:
-            books = list(pupil.borrowed_books.all())
-            for book in books:
-                book.quantity += 1
-                book.save()
-                pupil.borrowed_books.remove(book)
-                total_returned += 1
-
-        self.message_user(request, f"{total_returned} books returned from {queryset.count()} pupils.")
+        """Return all books borrowed by selected pupils in one transaction."""
+        returned, borrowers = Library.return_all_books(queryset)
+        self.message_user(
+            request, f"{returned} books returned from {borrowers} of {queryset.count()} selected pupils."
+        )
 
     return_all_books.short_description = "Return all books from selected pupils"
 
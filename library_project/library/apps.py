@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        # Connect the cache invalidation signal handlers
+        from . import cache  # noqa: F401
+        # Count the queries of every connection opened from here on
+        from . import metrics  # noqa: F401
+        # busy_timeout, synchronous and (optionally) WAL on every SQLite connection
+        from . import sqlite  # noqa: F401
@@ -0,0 +1,426 @@
+# library/benchmarks.py
+"""
+Benchmarks for the library's hot paths.
+
+seed_library() fills the database with reproducible synthetic data, and
+run_benchmarks() times each registered case against it. Every case runs
+inside a transaction that is rolled back afterwards, so cases don't see
+each other's writes and repeated runs measure the same work.
+
+The `benchmark` management command wraps both around a throwaway test
+database and writes the results as JSON for comparison between commits.
+"""
+import gc
+import io
+import pickle
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+
+from django.core.cache import caches
+from django.db import OperationalError, connection, transaction
+from django.test import Client
+from django.urls import reverse
+
+from . import user_ids
+from .library import Library
+from .models import Book, Student, Pupil, Loan
+
+
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+DEFAULT_SEED = 1234
+SEED_BATCH_SIZE = 5000
+
+# User IDs are five digits starting with 2 (students) or 1 (pupils), so
+# there can never be more than 10,000 of each
+MAX_USERS_PER_TYPE = 10_000
+
+WORDS = (
+    'river', 'shadow', 'garden', 'winter', 'silver', 'forest', 'secret', 'ocean', 'island', 'lantern',
+    'mountain', 'journey', 'stone', 'harbor', 'whisper', 'castle', 'dragon', 'summer', 'crown', 'library',
+)
+SURNAMES = ('Smith', 'Ivanova', 'Garcia', 'Kim', 'Novak', 'Okafor', 'Rossi', 'Tanaka', 'Dubois', 'Khan')
+LABEL_CHOICES = [choice for choice, _ in Book.LABEL_CHOICES]
+
+_cases = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark case.
+
+    The decorated function is called with a BenchmarkContext inside the
+    case's transaction, does any untimed preparation, and returns a
+    zero-argument callable that does the timed work and returns how many
+    operations it performed, or (operations, bytes produced) for cases
+    whose output size matters.
+    """
+    def register(prepare):
+        _cases[name] = prepare
+        return prepare
+    return register
+
+
+def case_names():
+    return list(_cases)
+
+
+def dataset_size(scale):
+    """Books for a scale name ('10k', ...) or a plain number."""
+    if scale in SCALES:
+        return SCALES[scale]
+    return int(scale)
+
+
+def _batched(objects, batch_size=SEED_BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_library(books, seed=DEFAULT_SEED):
+    """
+    Create ``books`` books, as many users (capped by the ID space) and one
+    open loan per ten books, all derived from ``seed``.
+
+    Returns the number of rows created per table.
+    """
+    rng = random.Random(seed)
+    students = min(MAX_USERS_PER_TYPE, books * 7 // 10)
+    pupils = min(MAX_USERS_PER_TYPE, books - books * 7 // 10)
+
+    def make_books():
+        for i in range(books):
+            yield Book(
+                title=' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 4))) + f' {i}',
+                author=f'{rng.choice(WORDS).title()} {rng.choice(SURNAMES)}',
+                isbn=f'BENCH{i:012d}',
+                year=rng.randint(1900, 2024),
+                quantity=rng.randint(1, 5),
+                label=rng.choice(LABEL_CHOICES),
+            )
+
+    for batch in _batched(make_books()):
+        Book.objects.bulk_create(batch)
+    for batch in _batched(Student(user_id=f'2{i:04d}', name=f'Student{i}', surname=rng.choice(SURNAMES),
+                                  group=f'S{i % 40}') for i in range(students)):
+        Student.objects.bulk_create(batch)
+    for batch in _batched(Pupil(user_id=f'1{i:04d}', name=f'Pupil{i}', surname=rng.choice(SURNAMES),
+                                group=f'P{i % 30}', age=rng.randint(6, 12)) for i in range(pupils)):
+        Pupil.objects.bulk_create(batch)
+
+    book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+    student_ids = list(Student.objects.order_by('id').values_list('id', flat=True))
+    pupil_ids = list(Pupil.objects.order_by('id').values_list('id', flat=True))
+    loans = 0
+    if book_ids and (student_ids or pupil_ids):
+        def make_loans():
+            seen = set()
+            for _ in range(books // 10):
+                borrower_type = 'pupil' if pupil_ids and (not student_ids or rng.random() < 0.3) else 'student'
+                user_pk = rng.choice(pupil_ids if borrower_type == 'pupil' else student_ids)
+                book_id = rng.choice(book_ids)
+                if (borrower_type, user_pk, book_id) not in seen:
+                    seen.add((borrower_type, user_pk, book_id))
+                    yield Loan(borrower_type=borrower_type, book_id=book_id, **{f'{borrower_type}_id': user_pk})
+
+        for batch in _batched(make_loans()):
+            Loan.objects.bulk_create(batch)
+            loans += len(batch)
+        Book.objects.sync_active_loans()
+
+    return {'books': books, 'students': students, 'pupils': pupils, 'loans': loans}
+
+
+class BenchmarkContext:
+    def __init__(self, seed, operations):
+        self.rng = random.Random(seed)
+        self.client = Client()
+        # Upper bound on the operations a case performs per run
+        self.operations = operations
+
+    def get(self, url, data=None):
+        response = self.client.get(url, data)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _run_case(name, seed, operations, trace_memory):
+    """Prepare and run one case in a rolled-back transaction; returns (ops, seconds, queries, peak, bytes)."""
+    caches['default'].clear()
+    with transaction.atomic():
+        run = _cases[name](BenchmarkContext(seed, operations))
+        gc.collect()
+        counter = _QueryCounter()
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            with connection.execute_wrapper(counter):
+                started = time.perf_counter()
+                ops = run()
+                seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        transaction.set_rollback(True)
+    ops, output_bytes = ops if isinstance(ops, tuple) else (ops, None)
+    return ops, seconds, counter.count, peak, output_bytes
+
+
+def run_benchmarks(names=None, repeat=3, seed=DEFAULT_SEED, operations=200, memory=True, progress=None):
+    """
+    Run the named cases (all by default) and return one result dict per case.
+
+    Timings are the median of ``repeat`` runs. Peak memory comes from one
+    extra run under tracemalloc, since tracing slows the code it measures.
+    """
+    results = []
+    for name in names or case_names():
+        if name not in _cases:
+            raise KeyError(f"Unknown benchmark: {name}")
+        runs = [_run_case(name, seed, operations, False) for _ in range(repeat)]
+        ops, _, queries, _, output_bytes = runs[0]
+        seconds = statistics.median(run[1] for run in runs)
+        peak = _run_case(name, seed, operations, True)[3] if memory else None
+
+        result = {
+            'name': name,
+            'ops': ops,
+            'seconds': seconds,
+            'ops_per_second': ops / seconds if seconds else None,
+            'queries': queries,
+            'queries_per_op': queries / ops if ops else None,
+            'peak_memory_bytes': peak,
+            'output_bytes': output_bytes,
+        }
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def concurrent_borrow_throughput(threads=8, operations=100, hot_books=5, seed=DEFAULT_SEED):
+    """
+    Time ``threads`` students borrowing and returning at once, each on its
+    own connection, ``operations`` borrow/return pairs apiece.
+
+    The books are shared between a handful of titles so the threads
+    contend for the same rows and the write lock. Unlike the registered
+    cases this commits, so run it against a throwaway database. Failed
+    operations, such as "database is locked", are counted rather than
+    retried.
+    """
+    rng = random.Random(seed)
+    books = list(Book.objects.filter(quantity__gt=0).order_by('id')[:hot_books])
+    students = list(Student.objects.order_by('id')[:threads])
+    if not books or len(students) < threads:
+        raise ValueError(f"Needs at least one book in stock and {threads} students")
+    plans = [[rng.choice(books).pk for _ in range(operations)] for _ in students]
+
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    outcomes = []
+
+    def work(student, book_ids):
+        ops, failures, timings = 0, [], []
+        try:
+            barrier.wait()
+            for book_id in book_ids:
+                book = Book(pk=book_id)
+                started = time.perf_counter()
+                try:
+                    if student.borrow_book(book):
+                        student.return_book(book)
+                        ops += 2
+                except OperationalError as e:
+                    failures.append(str(e))
+                timings.append(time.perf_counter() - started)
+        finally:
+            connection.close()
+            with lock:
+                outcomes.append((ops, failures, timings))
+
+    workers = [threading.Thread(target=work, args=pair) for pair in zip(students, plans)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+
+    ops = sum(outcome[0] for outcome in outcomes)
+    errors = [error for outcome in outcomes for error in outcome[1]]
+    latencies = sorted(timing for outcome in outcomes for timing in outcome[2])
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0.0
+
+    return {
+        'threads': threads,
+        'ops': ops,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': seconds,
+        'ops_per_second': ops / seconds if seconds else None,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def _sample(ctx, queryset, count):
+    """``count`` rows of ``queryset`` picked by the seeded generator, in a stable order."""
+    ids = sorted(queryset.values_list('id', flat=True))
+    chosen = ctx.rng.sample(ids, min(count, len(ids)))
+    rows = queryset.in_bulk(chosen)
+    return [rows[pk] for pk in chosen]
+
+
+@benchmark('borrow_return')
+def _borrow_return(ctx):
+    books = _sample(ctx, Book.objects.filter(quantity__gt=0, label='for children'), ctx.operations)
+    users = (_sample(ctx, Student.objects.all(), ctx.operations // 2)
+             + _sample(ctx, Pupil.objects.all(), ctx.operations // 2))
+    pairs = [(user, ctx.rng.choice(books)) for user in users] if books else []
+
+    def run():
+        ops = 0
+        for user, book in pairs:
+            if Library.process_borrowing(user, book)[0]:
+                Library.process_return(user, book)
+                ops += 2
+        return ops
+    return run
+
+
+def _page_views(ctx, url, params_list):
+    def run():
+        for params in params_list:
+            ctx.get(url, params)
+        return len(params_list)
+    return run
+
+
+@benchmark('book_list')
+def _book_list(ctx):
+    return _page_views(ctx, reverse('book_list'), [{}] * 20)
+
+
+@benchmark('book_list_filtered')
+def _book_list_filtered(ctx):
+    params = [{'label': 'for children', 'sort': '-year'}, {'author': ctx.rng.choice(WORDS)},
+              {'year_min': 1950, 'year_max': 1960}, {'q': ctx.rng.choice(WORDS)}]
+    return _page_views(ctx, reverse('book_list'), params * 5)
+
+
+@benchmark('book_search')
+def _book_search(ctx):
+    # Short prefixes match the most rows, the worst case for ranking
+    params = [{'q': ctx.rng.choice(WORDS)[:length]} for length in (3, 4, 6) for _ in range(5)]
+    return _page_views(ctx, reverse('book_list'), params)
+
+
+@benchmark('user_list')
+def _user_list(ctx):
+    return _page_views(ctx, reverse('user_list'), [{}] * 3)
+
+
+@benchmark('borrowed_books')
+def _borrowed_books(ctx):
+    return _page_views(ctx, reverse('borrowed_books'), [{'page': page} for page in range(1, 21)])
+
+
+@benchmark('classify_user_ids')
+def _classify_user_ids(ctx):
+    ids = [f'{ctx.rng.randint(0, 99_999):05d}' for _ in range(100 * ctx.operations)]
+
+    def run():
+        user_ids.classify_many(ids)
+        return len(ids)
+    return run
+
+
+@benchmark('import_books_txt')
+def _import_books_txt(ctx):
+    lines = 10 * ctx.operations
+    data = ''.join(
+        f'Imported {ctx.rng.choice(WORDS)} {i},Bench Author,IMPBENCH{i:011d},2001,2,general\n'
+        for i in range(lines)
+    ).encode('utf-8')
+
+    def run():
+        upload = io.BytesIO(data)
+        upload.name = 'books.txt'
+        ctx.client.post(reverse('import_books_txt'), {'books_file': upload})
+        return lines
+    return run
+
+
+@benchmark('export_books_txt')
+def _export_books_txt(ctx):
+    books = Book.objects.count()
+
+    def run():
+        ctx.get(reverse('export_books_txt'))
+        return books
+    return run
+
+
+@benchmark('serialize_library')
+def _serialize_library(ctx):
+    rows = Book.objects.count() + Student.objects.count() + Pupil.objects.count() + Loan.objects.count()
+
+    def run():
+        return rows, len(ctx.get(reverse('serialize_library')))
+    return run
+
+
+# What serialize_library did before snapshots, kept for comparison. It left out loans.
+@benchmark('serialize_library_pickle')
+def _serialize_library_pickle(ctx):
+    rows = Book.objects.count() + Student.objects.count() + Pupil.objects.count()
+
+    def run():
+        library_data = {
+            'books': list(Book.objects.all()),
+            'students': list(Student.objects.all()),
+            'pupils': list(Pupil.objects.all()),
+        }
+        return rows, len(pickle.dumps(library_data))
+    return run
+
+
+@benchmark('deserialize_library')
+def _deserialize_library(ctx):
+    rows = Book.objects.count() + Student.objects.count() + Pupil.objects.count() + Loan.objects.count()
+    snapshot = ctx.get(reverse('serialize_library'))
+
+    def run():
+        upload = io.BytesIO(snapshot)
+        upload.name = 'library.jsonl.gz'
+        ctx.client.post(reverse('deserialize_library'), {'library_file': upload})
+        return rows
+    return run
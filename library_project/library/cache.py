@@ -0,0 +1,163 @@
+# library/cache.py
+"""
+Read-through cache for catalogue and user lookups.
+
+Entries are keyed under a per-namespace version number. invalidate()
+stores a new version so every old key in the namespace stops being read and
+simply expires. A change to one book only deletes that book's entry
+(invalidate_books()), so a borrow doesn't empty the whole catalogue cache.
+Both happen once the surrounding transaction commits, so a rolled-back
+write never evicts good data and a reader inside the transaction never
+caches uncommitted rows.
+
+Loans are not cached, so opening or closing one needs no invalidation beyond
+the stock change it makes. Code that changes rows without signals (queryset.update(),
+bulk_create(), raw deletes) must invalidate itself: invalidate_books() when
+it knows the few books it touched, invalidate() for bulk changes.
+
+Hit and miss counts are exported by library.metrics.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+
+from .models import Book, Student, Pupil, stock_changed
+
+
+DEFAULT_TIMEOUT = 300
+
+BOOKS = 'book'
+USER_NAMESPACES = {Student: 'student', Pupil: 'pupil'}
+ALL_NAMESPACES = (BOOKS,) + tuple(USER_NAMESPACES.values())
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[getattr(settings, 'LIBRARY_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'LIBRARY_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _version_key(namespace):
+    return f'library:version:{namespace}'
+
+
+def _get_version(namespace):
+    cache = get_cache()
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # A fresh timestamp never repeats a version whose keys may still be cached
+        version = time.time_ns()
+        cache.add(_version_key(namespace), version, None)
+        version = cache.get(_version_key(namespace), version)
+    return version
+
+
+def _key(namespace, ident):
+    return f'library:{namespace}:{_get_version(namespace)}:{ident}'
+
+
+def _record(hit):
+    with _stats_lock:
+        _stats['hits' if hit else 'misses'] += 1
+
+
+def stats():
+    """Hit and miss counts for this process since startup (or reset_stats())."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['hits'] = _stats['misses'] = 0
+
+
+def _read_through(namespace, ident, load):
+    cache = get_cache()
+    key = _key(namespace, ident)
+    value = cache.get(key)
+    if value is not None:
+        _record(True)
+        return value
+
+    _record(False)
+    value = load()
+    # Misses aren't cached, so a newly created row shows up immediately
+    if value is not None:
+        cache.set(key, value, get_timeout())
+    return value
+
+
+def invalidate(*namespaces):
+    """Bump the version of each namespace once the current transaction commits."""
+    def bump():
+        cache = get_cache()
+        for namespace in namespaces:
+            cache.set(_version_key(namespace), time.time_ns(), None)
+
+    transaction.on_commit(bump)
+
+
+def invalidate_books(*book_ids):
+    """Delete these books' cached entries once the current transaction commits."""
+    def drop():
+        get_cache().delete_many([_key(BOOKS, book_id) for book_id in book_ids])
+
+    transaction.on_commit(drop)
+
+
+def get_book(book_id):
+    """Return the Book with this id, or None if it doesn't exist."""
+    return _read_through(BOOKS, book_id, lambda: Book.objects.filter(id=book_id).first())
+
+
+def get_book_or_404(book_id):
+    book = get_book(book_id)
+    if book is None:
+        raise Http404("No Book matches the given query.")
+    return book
+
+
+def get_user(model, user_id):
+    """Return the Student or Pupil with this user_id, or None if it doesn't exist."""
+    return _read_through(
+        USER_NAMESPACES[model], user_id,
+        lambda: model.objects.filter(user_id=user_id).first()
+    )
+
+
+def get_user_or_404(model, user_id):
+    user = get_user(model, user_id)
+    if user is None:
+        raise Http404(f"No {model._meta.object_name} matches the given query.")
+    return user
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def _book_changed(sender, instance, **kwargs):
+    invalidate_books(instance.pk)
+
+
+@receiver(stock_changed, sender=Book)
+def _stock_changed(sender, book_id, **kwargs):
+    invalidate_books(book_id)
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+@receiver(post_save, sender=Pupil)
+@receiver(post_delete, sender=Pupil)
+def _user_changed(sender, **kwargs):
+    invalidate(USER_NAMESPACES[sender])
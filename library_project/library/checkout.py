@@ -0,0 +1,256 @@
+# library/checkout.py
+"""
+Batch borrowing and returning for checkout desks.
+
+A batch is a list of items such as
+
+    {"action": "borrow", "user_id": "20001", "book_id": 7}
+
+Every user, book and open loan the batch mentions is loaded with one query
+per table, the items are checked in memory in order, and the new loans,
+closed loans and stock changes are written with a fixed number of
+statements in one transaction, however many items there are.
+
+Desks POST batches as JSON to /books/checkout/. That endpoint is CSRF
+protected like every other form: GET /books/checkout/token/ first, then
+send the csrftoken cookie it sets and an X-CSRFToken header carrying the
+token it returns.
+"""
+import logging
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import cache, user_ids
+from .library import Library
+from .models import Book, Student, Pupil, Loan
+
+
+DEFAULT_MAX_ITEMS = 500
+ACTIONS = ('borrow', 'return')
+USER_MODELS = {user_ids.STUDENT: Student, user_ids.PUPIL: Pupil}
+# A batch is re-run from scratch if another request changed the same rows,
+# waiting a little longer before each new attempt
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class BatchError(ValueError):
+    """Raised when a batch as a whole is malformed."""
+
+
+class BatchConflict(Exception):
+    """Raised when stock or loans changed underneath a batch while it ran."""
+
+
+def get_max_items():
+    return getattr(settings, 'LIBRARY_CHECKOUT_MAX_ITEMS', DEFAULT_MAX_ITEMS)
+
+
+def _user_id(item):
+    return str(item.get('user_id', '')) if isinstance(item, dict) else ''
+
+
+def _parse_item(item, kind):
+    """Return (action, user model, user_id, book_id) or raise ValueError."""
+    if not isinstance(item, dict):
+        raise ValueError("Item must be an object.")
+    action = item.get('action')
+    if action not in ACTIONS:
+        raise ValueError("Action must be 'borrow' or 'return'.")
+
+    user_id = _user_id(item)
+    if kind is None:
+        raise ValueError(user_ids.error_for(user_id))
+    model = USER_MODELS[kind]
+
+    try:
+        book_id = int(item.get('book_id'))
+    except (TypeError, ValueError):
+        raise ValueError("book_id must be a whole number.")
+    return action, model, user_id, book_id
+
+
+def _result(item, error=None, quantity=None):
+    item = item if isinstance(item, dict) else {}
+    result = {
+        'action': item.get('action'),
+        'user_id': item.get('user_id'),
+        'book_id': item.get('book_id'),
+        'ok': error is None,
+    }
+    if error is None:
+        result['quantity'] = quantity
+    else:
+        result['error'] = error
+    return result
+
+
+def _load_open_loans(users, book_ids):
+    """Map (borrower_type, user pk, book id) -> loan id for the open loans involved."""
+    borrowers = Q()
+    for model, by_user_id in users.items():
+        if by_user_id:
+            borrowers |= Q(**{f'{model.borrower_type}_id__in': [user.pk for user in by_user_id.values()]})
+    if not borrowers or not book_ids:
+        return {}
+
+    loans = Loan.objects.active().filter(borrowers, book_id__in=book_ids).values_list(
+        'id', 'borrower_type', 'student_id', 'pupil_id', 'book_id'
+    )
+    return {
+        (borrower_type, student_id or pupil_id, book_id): loan_id
+        for loan_id, borrower_type, student_id, pupil_id, book_id in loans
+    }
+
+
+def _apply_stock(deltas):
+    """Apply each book's net stock change with one guarded UPDATE per distinct change."""
+    # A batch usually moves every book by -1 or +1, so this is one or two
+    # statements; building a CASE over hundreds of books costs far more
+    by_delta = defaultdict(list)
+    for book_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(book_id)
+
+    for delta, book_ids in by_delta.items():
+        # Only rows that stay non-negative are updated; anything else is a conflict
+        updated = Book.objects.filter(pk__in=book_ids, quantity__gte=-delta).update(
+            quantity=F('quantity') + delta, active_loans=F('active_loans') - delta
+        )
+        if updated != len(book_ids):
+            raise BatchConflict("Stock changed while the batch was being processed.")
+
+
+def _run(items):
+    results = [None] * len(items)
+    requests = []
+    # Every user ID in the batch is classified in one pass
+    kinds = user_ids.classify_many([_user_id(item) for item in items])
+    for index, (item, kind) in enumerate(zip(items, kinds)):
+        try:
+            requests.append((index,) + _parse_item(item, kind))
+        except ValueError as e:
+            results[index] = _result(item, error=str(e))
+
+    with transaction.atomic():
+        users = {
+            model: model.objects.in_bulk(
+                {user_id for _, _, m, user_id, _ in requests if m is model}, field_name='user_id'
+            )
+            for model in USER_MODELS.values()
+        }
+        books = Book.objects.select_for_update().in_bulk({book_id for *_, book_id in requests})
+        open_loans = _load_open_loans(users, list(books))
+
+        now = timezone.now()
+        stock = {book_id: book.quantity for book_id, book in books.items()}
+        deltas = defaultdict(int)
+        new_loans = []
+        pending = {}  # Loans opened by this batch and not yet returned
+        closing = []
+        borrowed = returned = 0
+
+        for index, action, model, user_id, book_id in requests:
+            item = items[index]
+            user = users[model].get(user_id)
+            book = books.get(book_id)
+            if user is None:
+                results[index] = _result(item, error=f"No {model._meta.verbose_name} with ID {user_id}.")
+                continue
+            if book is None:
+                results[index] = _result(item, error=f"No book with ID {book_id}.")
+                continue
+
+            key = (model.borrower_type, user.pk, book.pk)
+            if action == 'borrow':
+                error = Library.borrow_refusal(user, book)
+                if error is None and stock[book.pk] <= 0:
+                    error = "This book is not available."
+                if error is None and (key in open_loans or key in pending):
+                    error = "This user has already borrowed this book."
+                if error is None:
+                    loan = Loan(borrower_type=model.borrower_type, book_id=book.pk, borrowed_at=now,
+                                **{f'{model.borrower_type}_id': user.pk})
+                    new_loans.append(loan)
+                    pending[key] = loan
+                    stock[book.pk] -= 1
+                    deltas[book.pk] -= 1
+                    borrowed += 1
+            else:
+                error = None
+                if key in pending:
+                    pending.pop(key).returned_at = now
+                elif key in open_loans:
+                    closing.append(open_loans.pop(key))
+                else:
+                    error = "This user has not borrowed this book."
+                if error is None:
+                    stock[book.pk] += 1
+                    deltas[book.pk] += 1
+                    returned += 1
+            results[index] = _result(item, error=error, quantity=stock[book.pk])
+
+        # Close returned loans first: the batch may lend the same book to the same
+        # user again, and only one open loan per user and book is allowed
+        if closing:
+            closed = Loan.objects.filter(id__in=closing, returned_at__isnull=True).update(returned_at=now)
+            if closed != len(closing):
+                raise BatchConflict("A loan in the batch was returned by another request.")
+        try:
+            Loan.objects.bulk_create(new_loans)
+        except IntegrityError:
+            # Someone else opened one of these loans since we looked
+            raise BatchConflict("A loan in the batch was opened by another request.")
+        _apply_stock(deltas)
+
+        # Set-based updates send no signals
+        if borrowed or returned:
+            cache.invalidate_books(*deltas)
+
+    report = {
+        'results': results,
+        'borrowed': borrowed,
+        'returned': returned,
+        'failed': len(items) - borrowed - returned,
+    }
+    logger.info("Checkout batch processed", extra={
+        'items': len(items), 'borrowed': borrowed, 'returned': returned, 'failed': report['failed'],
+    })
+    return report
+
+
+def process_batch(items):
+    """
+    Borrow and return the books in ``items`` in one transaction.
+
+    Items are applied in order, so a batch may return a book and lend it
+    straight out again. Each item succeeds or fails on its own; the result
+    for each carries either the book's remaining quantity or an error.
+    Raises BatchError if ``items`` is not a list of acceptable length, and
+    BatchConflict if concurrent changes kept the batch from applying.
+    """
+    if not isinstance(items, list):
+        raise BatchError("Expected a list of items.")
+    if len(items) > get_max_items():
+        raise BatchError(f"A batch may contain at most {get_max_items()} items.")
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return _run(items)
+        except BatchConflict as e:
+            if attempt == MAX_ATTEMPTS:
+                logger.warning("Checkout batch abandoned after conflicts", extra={
+                    'event': 'checkout.conflict', 'attempts': attempt, 'items': len(items), 'reason': str(e),
+                })
+                raise
+            logger.warning("Checkout batch conflicted; retrying", extra={
+                'event': 'checkout.retry', 'attempt': attempt, 'items': len(items), 'reason': str(e),
+            })
+            time.sleep(RETRY_BACKOFF_SECONDS * attempt)
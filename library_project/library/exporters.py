@@ -0,0 +1,46 @@
+# library/exporters.py
+import csv
+import io
+
+from django.conf import settings
+
+from .models import Book
+
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Column order matches the full format read back by importers.parse_book_line.
+# Its quantity column is the number of copies owned, on the shelf or on loan,
+# as importers and load_books read it.
+FULL_COLUMNS = ('title', 'author', 'isbn', 'year', 'total_copies', 'label')
+BASIC_COLUMNS = ('title', 'label')
+
+
+def get_chunk_size():
+    return getattr(settings, 'LIBRARY_EXPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def iter_books_txt(columns=FULL_COLUMNS, chunk_size=None, encoding='utf-8'):
+    """
+    Yield the books TXT export as encoded chunks.
+
+    Rows are read with a server-side iterator over values_list() so only
+    one chunk of books is held in memory at a time, however big the table.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    rows = Book.objects.order_by('id').values_list(*columns).iterator(chunk_size=chunk_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue().encode(encoding)
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if pending:
+        yield buffer.getvalue().encode(encoding)
@@ -1,7 +1,7 @@
 # library/forms.py
 from django import forms
+from . import user_ids
 from .models import Book, Student, Pupil
-import re
 
 
 class BookForm(forms.ModelForm):
@@ -10,33 +10,28 @@ class BookForm(forms.ModelForm):
         fields = ['title', 'author', 'isbn', 'year', 'quantity', 'label']
 
 
-class StudentForm(forms.ModelForm):
-    class Meta:
-        model = Student
-        fields = ['user_id', 'name', 'surname', 'group']
+class UserIdFormMixin:
+    """Checks user_id against the range of the form's model (Student or Pupil)."""
 
     def clean_user_id(self):
         user_id = self.cleaned_data['user_id']
-        if not re.match(r'^\d{5}$', user_id):
-            raise forms.ValidationError("User ID must be a 5-digit number.")
-        if not user_id.startswith('2'):
-            raise forms.ValidationError("Student ID must start with '2'.")
+        error = user_ids.error_for(user_id, self._meta.model.borrower_type)
+        if error:
+            raise forms.ValidationError(error)
         return user_id
 
 
-class PupilForm(forms.ModelForm):
+class StudentForm(UserIdFormMixin, forms.ModelForm):
+    class Meta:
+        model = Student
+        fields = ['user_id', 'name', 'surname', 'group']
+
+
+class PupilForm(UserIdFormMixin, forms.ModelForm):
     class Meta:
         model = Pupil
         fields = ['user_id', 'name', 'surname', 'group', 'age']
 
-    def clean_user_id(self):
-        user_id = self.cleaned_data['user_id']
-        if not re.match(r'^\d{5}$', user_id):
-            raise forms.ValidationError("User ID must be a 5-digit number.")
-        if not user_id.startswith('1'):
-            raise forms.ValidationError("Pupil ID must start with '1'.")
-        return user_id
-
 
 class BorrowForm(forms.Form):
     USER_TYPES = [
@@ -59,4 +54,50 @@ class ReturnForm(forms.Form):
 
 
 class UserTypeCheckForm(forms.Form):
-    user_id = forms.CharField(max_length=5)
\ No newline at end of file
+    user_id = forms.CharField(max_length=5)
+
+class BookFilterForm(forms.Form):
+    SORT_CHOICES = [
+        ('title', 'Title (A-Z)'),
+        ('-title', 'Title (Z-A)'),
+        ('author', 'Author'),
+        ('year', 'Year (oldest first)'),
+        ('-year', 'Year (newest first)'),
+        ('quantity', 'Quantity'),
+        ('id', 'ID'),
+    ]
+    q = forms.CharField(
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Search title, author or ISBN'})
+    )
+    title = forms.CharField(
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Title'})
+    )
+    author = forms.CharField(
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Author'})
+    )
+    label = forms.ChoiceField(
+        choices=[('', 'Any label')] + Book.LABEL_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    year_min = forms.IntegerField(
+        required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'From year'})
+    )
+    year_max = forms.IntegerField(
+        required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'To year'})
+    )
+    sort = forms.ChoiceField(
+        choices=SORT_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+
+
+class BorrowedBooksFilterForm(forms.Form):
+    # Bounded to the id column's range, so an oversized value is invalid rather than overflowing the query
+    book_id = forms.IntegerField(required=False, min_value=1, max_value=2 ** 63 - 1)
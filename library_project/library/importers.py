@@ -0,0 +1,242 @@
+# library/importers.py
+import csv
+import gzip
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+
+from . import cache
+from .models import Book
+
+
+DEFAULT_BATCH_SIZE = 1000
+# Keep the report readable on huge files; the counts stay exact
+MAX_REPORTED_ERRORS = 100
+
+LABELS = {choice for choice, _ in Book.LABEL_CHOICES}
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def get_batch_size():
+    return getattr(settings, 'LIBRARY_IMPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def generate_isbn():
+    """Generate a placeholder ISBN for imported books that don't carry one."""
+    # 'IMP' + 17 hex digits fits Book.isbn and won't collide with earlier imports
+    return f"IMP{uuid.uuid4().hex[:17].upper()}"
+
+
+def clean_book_fields(title, author, isbn, year, quantity, label, make_isbn=generate_isbn):
+    """
+    Validate one book's raw field values and return them ready for Book().
+
+    Raises ValueError if the book cannot be imported. A missing ISBN is
+    replaced by make_isbn().
+    """
+    title = str(title).strip()
+    author = str(author).strip()
+    isbn = str(isbn or '').strip()
+    label = str(label).strip()
+
+    if not title:
+        raise ValueError("title is empty")
+    if len(title) > 255 or len(author) > 255:
+        raise ValueError("title or author is longer than 255 characters")
+    if len(isbn) > 20:
+        raise ValueError("ISBN is longer than 20 characters")
+
+    try:
+        year = int(year)
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        raise ValueError("year and quantity must be whole numbers")
+    if quantity < 0:
+        raise ValueError("quantity cannot be negative")
+
+    # Make sure label is valid
+    if label not in LABELS:
+        label = 'general'  # Default to general if invalid
+
+    return {
+        'title': title,
+        'author': author,
+        'isbn': isbn or make_isbn(),
+        'year': year,
+        'quantity': quantity,
+        'label': label,
+    }
+
+
+def parse_book_line(line, make_isbn=generate_isbn):
+    """
+    Parse one line of a books TXT file into Book field values.
+
+    Supported formats:
+        title,label
+        title,author,year,quantity,label
+        title,author,isbn,year,quantity,label   (as written by export_books_txt)
+
+    Fields may be double-quoted CSV-style, so titles can contain commas.
+    Raises ValueError if the line cannot be imported.
+    """
+    try:
+        parts = [part.strip() for part in next(csv.reader([line]))]
+    except (csv.Error, StopIteration):
+        raise ValueError("line is not valid comma-separated text")
+
+    if len(parts) >= 6:  # Full format including ISBN
+        title, author, isbn, year, quantity, label = parts[:6]
+    elif len(parts) == 5:  # Full format with all fields but ISBN
+        title, author, year, quantity, label = parts
+        isbn = ''
+    elif len(parts) >= 2:  # Basic format with just title and label
+        title, label = parts[0], parts[1]
+        author = "Imported Author"  # Default
+        isbn = ''
+        year = 2023  # Default
+        quantity = 1  # Default
+    else:
+        raise ValueError("expected at least title and label")
+
+    return clean_book_fields(title, author, isbn, year, quantity, label, make_isbn)
+
+
+def parse_book_record(record, make_isbn=generate_isbn):
+    """
+    Parse a mapping of field name to value (a JSON object or a CSV row read
+    with a header) into Book field values, with the same defaults as the
+    basic TXT format. Raises ValueError if the book cannot be imported.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    return clean_book_fields(
+        record.get('title') or '',
+        record.get('author') or "Imported Author",
+        record.get('isbn') or '',
+        record.get('year') if record.get('year') not in (None, '') else 2023,
+        record.get('quantity') if record.get('quantity') not in (None, '') else 1,
+        record.get('label') or 'general',
+        make_isbn,
+    )
+
+
+def open_text_file(path):
+    """Open a UTF-8 text file for reading, decompressing it if it is gzipped."""
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def iter_lines(uploaded_file, encoding='utf-8'):
+    """
+    Yield decoded lines from an uploaded file one chunk at a time.
+
+    A gzipped upload is decompressed as it is read, like open_text_file()
+    does; a corrupt or truncated one raises gzip.BadGzipFile.
+    """
+    compressed = uploaded_file.read(2) == GZIP_MAGIC
+    uploaded_file.seek(0)
+    if compressed:
+        uploaded_file = gzip.GzipFile(fileobj=uploaded_file)
+    try:
+        for raw_line in uploaded_file:
+            yield raw_line.decode(encoding).rstrip('\r\n')
+    except (EOFError, zlib.error) as e:
+        raise gzip.BadGzipFile(str(e)) from e
+
+
+def _save_batch(batch, report):
+    started = time.perf_counter()
+    rejected = 0
+
+    # One query per batch to skip ISBNs that already exist
+    existing = set(
+        Book.objects.filter(isbn__in=[isbn for _, isbn, _ in batch]).values_list('isbn', flat=True)
+    )
+    books = []
+    seen = set()
+    for line_number, isbn, fields in batch:
+        if isbn in existing or isbn in seen:
+            rejected += 1
+            _record_error(report, line_number, f"ISBN {isbn} already exists")
+            continue
+        seen.add(isbn)
+        books.append(Book(**fields))
+
+    Book.objects.bulk_create(books, batch_size=len(books) or None)
+    return len(books), rejected, time.perf_counter() - started
+
+
+def _record_error(report, line_number, reason):
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_number, 'error': reason})
+
+
+def import_books(lines, batch_size=None):
+    """
+    Import books from an iterable of text lines using batched bulk inserts.
+
+    Lines are parsed and validated as they stream in; each full batch is
+    written with a single bulk_create, and the whole import runs in one
+    transaction. Returns a report dict with per-batch and total counts.
+    """
+    batch_size = batch_size or get_batch_size()
+    report = {
+        'batches': [],
+        'accepted': 0,
+        'rejected': 0,
+        'errors': [],
+        'seconds': 0.0,
+        'rows_per_second': 0.0,
+    }
+    started = time.perf_counter()
+    batch = []
+    parse_rejected = 0
+
+    def flush():
+        nonlocal parse_rejected
+        accepted, rejected, seconds = _save_batch(batch, report)
+        rejected += parse_rejected
+        report['batches'].append({
+            'number': len(report['batches']) + 1,
+            'accepted': accepted,
+            'rejected': rejected,
+            'seconds': seconds,
+        })
+        report['accepted'] += accepted
+        report['rejected'] += rejected
+        batch.clear()
+        parse_rejected = 0
+
+    with transaction.atomic():
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():  # Skip empty lines
+                continue
+            try:
+                fields = parse_book_line(line)
+            except ValueError as e:
+                parse_rejected += 1
+                _record_error(report, line_number, str(e))
+                continue
+
+            batch.append((line_number, fields['isbn'], fields))
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch or parse_rejected:
+            flush()
+
+        # bulk_create() sends no post_save signals
+        if report['accepted']:
+            cache.invalidate(cache.BOOKS)
+
+    report['seconds'] = time.perf_counter() - started
+    if report['seconds'] > 0:
+        report['rows_per_second'] = (report['accepted'] + report['rejected']) / report['seconds']
+    return report
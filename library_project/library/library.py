@@ -1,65 +1,109 @@
 # library/library.py (updated with fixed method name)
-import re
-from django.core.exceptions import ValidationError
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import cache, user_ids
+from .models import Book, Loan
+
+
+logger = logging.getLogger(__name__)
 
 
 class Library:
     @staticmethod
     def get_user_type(user_id):
-        if not re.match(r'^\d{5}$', user_id):
-            raise ValueError("User ID must be a 5-digit number.")
+        """Return "Student" or "Pupil"; raises ValueError for an invalid ID."""
+        return user_ids.user_type(user_id).capitalize()
 
-        if user_id.startswith('2'):
-            return "Student"
-        elif user_id.startswith('1'):
-            return "Pupil"
-        else:
-            raise ValueError("Invalid user ID range. Student IDs start with '2', Pupil IDs start with '1'.")
+    @staticmethod
+    def borrow_refusal(user, book):
+        """Return why ``user`` may not borrow ``book``, or None if they may."""
+        if user.can_borrow(book):
+            return None
+        if hasattr(user, 'age') and user.age < 7:
+            return "Pupils under 7 years old cannot borrow books."
+        elif hasattr(user, 'age') and book.label != 'for children':
+            return "Pupils can only borrow books labeled as 'for children'."
+        return "This user cannot borrow this book."
 
     @staticmethod
     def process_borrowing(user, book):
-        if not user.can_borrow(book):
-            if hasattr(user, 'age') and user.age < 7:
-                return False, "Pupils under 7 years old cannot borrow books."
-            elif hasattr(user, 'age') and book.label != 'for children':
-                return False, "Pupils can only borrow books labeled as 'for children'."
-            return False, "This user cannot borrow this book."
+        refusal = Library.borrow_refusal(user, book)
+        if refusal:
+            return False, refusal
 
         if book.quantity <= 0:
             return False, "This book is not available."
 
-        from django.db import transaction
-
         try:
             with transaction.atomic():
+                # borrow_book() updates book.quantity from the UPDATE itself
                 if user.borrow_book(book):
-                    # Force a refresh from database to get updated quantity
-                    book.refresh_from_db()
                     return True, f"Book '{book.title}' borrowed successfully. Remaining copies: {book.quantity}"
-                return False, "Failed to borrow the book."
+                return False, "This book is not available."
         except Exception as e:
-            print(f"Error during borrowing process: {str(e)}")
+            logger.exception("Borrowing failed", extra={'user_id': user.user_id, 'book_id': book.id})
             return False, f"An error occurred: {str(e)}"
 
     @staticmethod
     def process_return(user, book):
         """Process a book return request with proper validation."""
-        # Print debug information
-        print(f"Processing return request: User {user.user_id}, Book {book.id}, Current quantity: {book.quantity}")
+        logger.debug("Processing return", extra={
+            'user_id': user.user_id, 'book_id': book.id, 'quantity': book.quantity,
+        })
 
-        if book not in user.borrowed_books.all():
+        if not user.loans.active().filter(book=book).exists():
             return False, "This user has not borrowed this book."
 
         # Use Django transaction to ensure database consistency
-        from django.db import transaction
-
         try:
             with transaction.atomic():
+                # return_book() updates book.quantity from the UPDATE itself
                 if user.return_book(book):
-                    # Force a refresh from database to get updated quantity
-                    book.refresh_from_db()
                     return True, f"Book '{book.title}' returned successfully. New quantity: {book.quantity}"
                 return False, "Failed to return the book."
         except Exception as e:
-            print(f"Error during return process: {str(e)}")
-            return False, f"An error occurred: {str(e)}"
\ No newline at end of file
+            logger.exception("Return failed", extra={'user_id': user.user_id, 'book_id': book.id})
+            return False, f"An error occurred: {str(e)}"
+
+    @staticmethod
+    def return_all_books(users):
+        """
+        Return every book on loan to ``users`` (a Student or Pupil queryset)
+        in one transaction.
+
+        The loans are closed with one UPDATE, counted per book with one
+        aggregate query, and the copies go back on the shelf with one
+        UPDATE per distinct count. Returns (books returned, users who had
+        books), both exact.
+        """
+        borrower_type = users.model.borrower_type
+        now = timezone.now()
+        with transaction.atomic():
+            loans = Loan.objects.filter(**{f'{borrower_type}__in': users.values('pk')})
+            returned = loans.active().update(returned_at=now)
+            if not returned:
+                return 0, 0
+
+            # The rows just closed are the ones stamped with this return time
+            closed = loans.filter(returned_at=now).order_by()
+            by_count = defaultdict(list)
+            for book_id, copies in closed.values('book').annotate(copies=Count('id')).values_list('book', 'copies'):
+                by_count[copies].append(book_id)
+            for copies, book_ids in by_count.items():
+                Book.objects.filter(pk__in=book_ids).update(
+                    quantity=F('quantity') + copies, active_loans=F('active_loans') - copies
+                )
+            borrowers = closed.values(borrower_type).distinct().count()
+
+            # Set-based updates send no signals
+            cache.invalidate(cache.BOOKS)
+
+        logger.info("Books returned in bulk", extra={
+            'borrower_type': borrower_type, 'returned': returned, 'borrowers': borrowers,
+        })
+        return returned, borrowers
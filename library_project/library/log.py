@@ -0,0 +1,142 @@
+# library/log.py
+"""
+Structured, non-blocking logging.
+
+Library modules log through ordinary per-module loggers
+(``logging.getLogger(__name__)``) and pass identifiers as extras:
+
+    logger.info("Loan opened", extra={'event': 'loan.opened', 'user_id': ..., 'book_id': ...})
+
+The handler configured in settings.LOGGING is a QueueHandler. Request
+threads only copy the record onto an in-memory queue; a QueueListener
+thread formats it as one JSON object per line and does the actual I/O.
+Filters on the queue handler run in the request thread: one stamps the
+current request id, another samples high-volume events before they are
+ever queued.
+
+Under manage.py test the handlers are detached (see library.test_runner),
+so the JSON lines don't interleave with the test output.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+
+request_id = ContextVar('library_request_id', default=None)
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the id of the request being handled, if any."""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of high-volume events.
+
+    Records carrying ``extra={'event': name}`` are kept with the probability
+    given for that name in ``rates`` (or settings.LIBRARY_LOG_SAMPLE_RATES).
+    Other events, and anything at WARNING or above, are always kept.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        rates = self.rates if self.rates is not None else getattr(settings, 'LIBRARY_LOG_SAMPLE_RATES', {})
+        rate = rates.get(event, 1.0)
+        if rate >= 1.0:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: standard fields plus every extra."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that owns the QueueListener draining it.
+
+    The listener writes to ``stream`` (stderr by default) through a
+    StreamHandler that uses this handler's formatter, so formatting happens
+    on the listener thread. Python 3.11's dictConfig can't wire a listener
+    itself, hence the self-contained handler.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+        atexit.register(self.stop_listener)
+
+    def setFormatter(self, fmt):
+        # The formatter is used where the output happens
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Merge the message and render any traceback now, while the
+        # arguments and exception are still live, but leave the JSON
+        # formatting to the listener thread
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging; drop instead
+            pass
+
+    def stop_listener(self):
+        """Flush the queue and stop the listener thread; safe to call twice."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self.stop_listener()
+        super().close()
@@ -0,0 +1,138 @@
+# library/management/commands/benchmark.py
+"""
+Run the hot-path benchmarks against a freshly seeded throwaway database.
+
+    python manage.py benchmark --scale 100k --output results/100k.json
+    python manage.py benchmark --scale 100k --compare results/100k.json
+
+The database is created the same way the test runner creates one, so the
+real database is never touched. The same --seed always produces the same
+data and the same sequence of operations.
+"""
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from library import benchmarks
+from library.models import Book
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+class Command(BaseCommand):
+    help = "Benchmark the library's hot paths on seeded synthetic data and report ops/sec, queries and memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', default='10k',
+                            help="Number of books: 10k, 100k, 1m or a plain number (default 10k).")
+        parser.add_argument('--seed', type=int, default=benchmarks.DEFAULT_SEED)
+        parser.add_argument('--repeat', type=int, default=3, help="Timed runs per case; the median is kept.")
+        parser.add_argument('--operations', type=int, default=200,
+                            help="Borrow/return pairs per run, and a tenth of the lines imported.")
+        parser.add_argument('--only', action='append', choices=benchmarks.case_names(),
+                            help="Run only this case; repeat for several.")
+        parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc run.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--compare', help="Compare against the results in this JSON file.")
+        parser.add_argument('--keepdb', action='store_true',
+                            help="Reuse the benchmark database between runs (must match --scale and --seed).")
+
+    def handle(self, *args, **options):
+        try:
+            books = benchmarks.dataset_size(options['scale'])
+        except ValueError:
+            raise CommandError(f"Unknown scale: {options['scale']}")
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = {result['name']: result for result in json.load(f)['results']}
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            started = time.perf_counter()
+            if options['keepdb'] and Book.objects.exists():
+                dataset = None
+                self.stdout.write("Reusing the existing benchmark database.")
+            else:
+                self.stdout.write(f"Seeding {books:,} books (seed {options['seed']})...")
+                dataset = benchmarks.seed_library(books, options['seed'])
+            seed_seconds = time.perf_counter() - started
+
+            self.stdout.write(f"{'case':<26} {'ops/s':>11} {'queries/op':>11} {'peak MB':>9} {'output MB':>10}")
+            results = benchmarks.run_benchmarks(
+                names=options['only'],
+                repeat=options['repeat'],
+                seed=options['seed'],
+                operations=options['operations'],
+                memory=not options['no_memory'],
+                progress=lambda result: self.print_result(result, baseline),
+            )
+            vendor = connection.vendor
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'revision': git_revision(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': vendor,
+                'scale': options['scale'],
+                'books': books,
+                'seed': options['seed'],
+                'repeat': options['repeat'],
+                'operations': options['operations'],
+                'dataset': dataset,
+                'seed_seconds': seed_seconds,
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def print_result(self, result, baseline):
+        ops = result['ops_per_second']
+        queries = result['queries_per_op']
+        peak = result['peak_memory_bytes']
+        output = result['output_bytes']
+        line = (
+            f"{result['name']:<26} "
+            f"{ops if ops is not None else 0:>11.1f} "
+            f"{queries if queries is not None else 0:>11.2f} "
+            f"{peak / 2 ** 20 if peak is not None else 0:>9.1f} "
+            f"{output / 2 ** 20 if output is not None else 0:>10.2f}"
+        )
+        previous = (baseline or {}).get(result['name'])
+        if previous and previous['ops_per_second'] and ops:
+            line += f"   {ops / previous['ops_per_second']:.2f}x ops/s"
+            if previous['queries_per_op'] is not None and queries is not None:
+                line += f", {queries - previous['queries_per_op']:+.2f} queries/op"
+        self.stdout.write(line)
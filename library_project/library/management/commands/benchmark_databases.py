@@ -0,0 +1,126 @@
+# library/management/commands/benchmark_databases.py
+"""
+Compare concurrent borrow/return throughput across database profiles.
+
+    python manage.py benchmark_databases
+    python manage.py benchmark_databases --threads 16 --profile sqlite-wal --profile postgresql-pool
+
+Each profile is a set of the environment variables read by
+library_project/database.py. It runs in its own process, because the
+settings are built from the environment at startup. That process creates
+a throwaway database, seeds it and runs
+benchmarks.concurrent_borrow_throughput().
+
+The SQLite profiles use a temporary file, not the in-memory test
+database, so journaling and locking behave as they do in production. The
+PostgreSQL profiles take the server from your LIBRARY_DB_* variables,
+create a test database on it, and need psycopg (psycopg[pool] for
+postgresql-pool).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from library import benchmarks
+
+
+PROFILES = {
+    # What settings used before database.py: rollback journal, deferred transactions
+    'sqlite-rollback': {
+        'LIBRARY_DB_ENGINE': 'sqlite',
+        'LIBRARY_SQLITE_JOURNAL_MODE': 'DELETE',
+        'LIBRARY_SQLITE_SYNCHRONOUS': 'FULL',
+        'LIBRARY_SQLITE_TRANSACTION_MODE': 'DEFERRED',
+    },
+    'sqlite-wal': {'LIBRARY_DB_ENGINE': 'sqlite', 'LIBRARY_SQLITE_WAL': '1'},
+    'postgresql': {'LIBRARY_DB_ENGINE': 'postgresql', 'LIBRARY_DB_POOL': '0'},
+    'postgresql-pool': {'LIBRARY_DB_ENGINE': 'postgresql', 'LIBRARY_DB_POOL': '1'},
+}
+DEFAULT_PROFILES = ('sqlite-rollback', 'sqlite-wal')
+BOOKS = 1000
+
+
+class Command(BaseCommand):
+    help = "Measure concurrent borrow/return throughput under each database profile."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', action='append', dest='profiles', choices=PROFILES,
+                            help=f"Profile to run; repeat for several (default {', '.join(DEFAULT_PROFILES)}).")
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent borrowers (default 8).")
+        parser.add_argument('--operations', type=int, default=100,
+                            help="Borrow/return pairs per borrower (default 100).")
+        parser.add_argument('--seed', type=int, default=benchmarks.DEFAULT_SEED)
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+        # Set in the per-profile process
+        parser.add_argument('--in-profile', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['in_profile']:
+            self.stdout.write(json.dumps(self.measure(options)))
+            return
+
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name in options['profiles'] or DEFAULT_PROFILES:
+                self.stderr.write(f"Running {name}...")
+                results[name] = self.run_profile(name, directory, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.print_table(results)
+
+    def run_profile(self, name, directory, options):
+        env = {**os.environ, **PROFILES[name]}
+        if env['LIBRARY_DB_ENGINE'] == 'sqlite':
+            env['LIBRARY_DB_TEST_NAME'] = os.path.join(directory, f'{name}.sqlite3')
+        command = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_databases', '--in-profile',
+            '--threads', str(options['threads']), '--operations', str(options['operations']),
+            '--seed', str(options['seed']),
+        ]
+        process = subprocess.run(command, env=env, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise CommandError(f"Profile {name} failed:\n{process.stderr.strip()}")
+        return json.loads(process.stdout.strip().splitlines()[-1])
+
+    def measure(self, options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            benchmarks.seed_library(max(BOOKS, options['threads']), options['seed'])
+            result = benchmarks.concurrent_borrow_throughput(
+                threads=options['threads'], operations=options['operations'], seed=options['seed'],
+            )
+            result['vendor'] = connection.vendor
+            if connection.vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    result['journal_mode'] = cursor.fetchone()[0]
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+        return result
+
+    def print_table(self, results):
+        header = f"{'profile':<16} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for name, row in results.items():
+            self.stdout.write(
+                f"{name:<16} {row['ops_per_second'] or 0:>9.1f} {row['p50_ms']:>9.1f} "
+                f"{row['p99_ms']:>9.1f} {row['errors']:>7}"
+            )
+        for name, row in results.items():
+            if row['first_error']:
+                self.stdout.write(f"{name}: first error: {row['first_error']}")
@@ -0,0 +1,50 @@
+# library/management/commands/drop_all_data.py
+"""
+Delete every loan, book, student and pupil.
+
+    python manage.py drop_all_data
+    python manage.py drop_all_data --noinput --chunk-size 20000
+
+See library.purge. Everything is deleted in one transaction, so an
+interrupted run deletes nothing.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from library.purge import count_rows, purge_all
+
+
+class Command(BaseCommand):
+    help = "Delete all library data in bounded chunks, in one transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help="Rows per DELETE (default LIBRARY_PURGE_CHUNK_SIZE).")
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help="Do not ask for confirmation.")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        if options['interactive']:
+            counts = count_rows()
+            answer = input(
+                f"This deletes {counts['books']:,} books, {counts['students']:,} students, "
+                f"{counts['pupils']:,} pupils and {counts['loans']:,} loans.\n"
+                "Type 'yes' to continue, or 'no' to cancel: "
+            )
+            if answer != 'yes':
+                self.stdout.write("Cancelled; nothing was deleted.")
+                return
+
+        verbosity = options['verbosity']
+
+        def progress(table, deleted, total):
+            # Every chunk at -v 2, otherwise just each table's last one
+            if verbosity >= 2 or deleted == total:
+                self.stdout.write(f"  {table}: {deleted:,} of {total:,}")
+
+        counts = purge_all(options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {counts['books']:,} books, {counts['students']:,} students, "
+            f"{counts['pupils']:,} pupils and {counts['loans']:,} loans."
+        ))
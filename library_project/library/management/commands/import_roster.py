@@ -0,0 +1,56 @@
+# library/management/commands/import_roster.py
+"""
+Import a start-of-term roster of students and pupils.
+
+    python manage.py import_roster roster.csv
+    python manage.py import_roster roster.jsonl.gz --batch-size 5000
+
+See library.rosters for the file formats. The import runs in one
+transaction, so a file that can't be read imports nothing; rows that fail
+validation are reported and skipped.
+"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library.importers import open_text_file
+from library.rosters import FORMATS, RosterError, import_roster, roster_format
+
+
+MAX_SHOWN_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = "Bulk-create students and pupils from a CSV or JSONL roster (optionally gzipped)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="File format; guessed from the extension by default.")
+        parser.add_argument('--batch-size', type=int, help="Rows per bulk insert (default LIBRARY_IMPORT_BATCH_SIZE).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"No such file: {path}")
+
+        try:
+            with open_text_file(path) as f:
+                lines = (line.rstrip('\r\n') for line in f)
+                report = import_roster(lines, options['format'] or roster_format(path), options['batch_size'])
+        except UnicodeDecodeError:
+            raise CommandError("The roster must be UTF-8 encoded text; nothing was imported.")
+        except RosterError as e:
+            raise CommandError(f"{e} Nothing was imported.")
+        except (OSError, EOFError) as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report['students']:,} students and {report['pupils']:,} pupils; "
+            f"{report['rejected']:,} rejected, in {report['seconds']:.1f}s "
+            f"({report['rows_per_second']:,.0f} rows/s)."
+        ))
+        shown = report['errors'][:MAX_SHOWN_ERRORS]
+        for error in shown:
+            self.stderr.write(f"  line {error['line']}: {error['error']}")
+        if report['rejected'] > len(shown):
+            self.stderr.write(f"  ... and {report['rejected'] - len(shown):,} more rejected lines")
@@ -0,0 +1,286 @@
+# library/management/commands/load_books.py
+"""
+Load a catalogue file straight into the database, without the HTTP upload.
+
+    python manage.py load_books catalogue.txt.gz --workers 4
+    python manage.py load_books catalogue.jsonl --dry-run
+    python manage.py load_books catalogue.csv --resume
+
+Supported formats, optionally gzip-compressed:
+    txt    the import_books_txt format (title,label ... title,author,isbn,year,quantity,label)
+    csv    comma-separated with a header row naming the columns
+    jsonl  one JSON object per line with title, author, isbn, year, quantity, label
+
+Lines are parsed and validated in a worker pool, then written batch by
+batch with bulk_create, upserting on ISBN. A file's quantity is the number
+of copies the library owns, as export_books_txt writes it, so an updated
+book keeps its copies on loan out of its shelf stock (Book.quantity). A
+line owning fewer copies than are out on loan is rejected. Each batch commits on its own
+and the line it ended on is saved to a checkpoint file, so an interrupted
+load can pick up where it stopped with --resume.
+"""
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from library import cache
+from library.importers import (
+    MAX_REPORTED_ERRORS, get_batch_size, open_text_file, parse_book_line, parse_book_record,
+)
+from library.models import Book
+
+
+FORMATS = ('txt', 'csv', 'jsonl')
+EXTENSIONS = {'.txt': 'txt', '.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+UPDATE_FIELDS = ['title', 'author', 'year', 'quantity', 'label']
+PROGRESS_INTERVAL = 2.0
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+
+def placeholder_isbn(source, line_number):
+    """
+    A stable stand-in for a missing ISBN.
+
+    Derived from the file name and line rather than random, so loading
+    the same file again (or resuming it) updates these books instead of
+    adding them twice.
+    """
+    digest = hashlib.sha1(f'{source}:{line_number}'.encode('utf-8')).hexdigest()
+    return f"IMP{digest[:17].upper()}"
+
+
+def parse_chunk(task):
+    """Parse one chunk of lines; runs in a worker process."""
+    file_format, source, header, last_line, chunk = task
+    rows = []
+    errors = []
+    for line_number, text in chunk:
+        def make_isbn():
+            return placeholder_isbn(source, line_number)
+        try:
+            if file_format == 'txt':
+                fields = parse_book_line(text, make_isbn)
+            elif file_format == 'csv':
+                values = next(csv.reader([text]))
+                fields = parse_book_record(dict(zip(header, values)), make_isbn)
+            else:
+                try:
+                    record = json.loads(text)
+                except ValueError:
+                    raise ValueError("line is not valid JSON")
+                fields = parse_book_record(record, make_isbn)
+        except (ValueError, csv.Error) as e:
+            errors.append((line_number, str(e)))
+            continue
+        rows.append((line_number, fields))
+    return rows, errors, last_line
+
+
+class Command(BaseCommand):
+    help = "Stream a TXT, CSV or JSONL catalogue file (optionally gzipped) into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="File format; guessed from the extension by default.")
+        parser.add_argument('--batch-size', type=int, help="Rows per bulk write (default LIBRARY_IMPORT_BATCH_SIZE).")
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                            help="Parser processes; 0 parses in this process.")
+        parser.add_argument('--on-conflict', choices=('update', 'skip'), default='update',
+                            help="What to do with books whose ISBN already exists (default update).")
+        parser.add_argument('--dry-run', action='store_true', help="Parse and validate only; write nothing.")
+        parser.add_argument('--checkpoint', help="Checkpoint file (default PATH.checkpoint).")
+        parser.add_argument('--resume', action='store_true', help="Continue after the line in the checkpoint.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"No such file: {path}")
+        file_format = options['format'] or detect_format(path)
+        if file_format is None:
+            raise CommandError("Cannot tell the file format from its name; pass --format.")
+
+        self.batch_size = options['batch_size'] or get_batch_size()
+        self.on_conflict = options['on_conflict']
+        self.dry_run = options['dry_run']
+        self.checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        self.source = {'path': os.path.abspath(path), 'size': os.path.getsize(path)}
+
+        self.totals = {'line': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0}
+        if options['resume']:
+            self.load_checkpoint()
+        self.errors = []
+
+        self.started = time.perf_counter()
+        self.last_progress = self.started
+        self.processed = 0
+
+        tasks = self.read_chunks(path, file_format, start_after=self.totals['line'])
+        try:
+            for rows, errors, last_line in self.parse(tasks, options['workers']):
+                self.processed += len(rows) + len(errors)
+                errors = sorted(errors + self.write(rows))
+                self.totals['rejected'] += len(errors)
+                self.errors.extend(errors[:MAX_REPORTED_ERRORS - len(self.errors)])
+                self.totals['line'] = last_line
+                if not self.dry_run:
+                    self.save_checkpoint()
+                self.progress()
+        except UnicodeDecodeError:
+            raise CommandError(f"The file must be UTF-8 encoded text (stopped after line {self.totals['line']}).")
+        except (OSError, EOFError) as e:
+            raise CommandError(f"Cannot read {path}: {e} (stopped after line {self.totals['line']}).")
+
+        self.progress(final=True)
+        if not self.dry_run and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.report()
+
+    def read_chunks(self, path, file_format, start_after=0):
+        """Yield parse tasks of up to batch_size non-empty lines, skipping lines already loaded."""
+        source = os.path.basename(path)
+        header = None
+        chunk = []
+        line_number = 0
+        with open_text_file(path) as f:
+            for line_number, line in enumerate(f, start=1):
+                text = line.rstrip('\r\n')
+                if not text.strip():
+                    continue
+                if file_format == 'csv' and header is None:
+                    header = [name.strip().lower() for name in next(csv.reader([text]))]
+                    continue
+                if line_number <= start_after:
+                    continue
+                chunk.append((line_number, text))
+                if len(chunk) >= self.batch_size:
+                    yield file_format, source, header, line_number, chunk
+                    chunk = []
+        if chunk:
+            yield file_format, source, header, line_number, chunk
+
+    def parse(self, tasks, workers):
+        """Parse tasks in order, keeping only a few chunks in flight so memory stays flat."""
+        if workers <= 0:
+            for task in tasks:
+                yield parse_chunk(task)
+            return
+
+        # Spawned rather than forked, so no worker inherits an open database
+        # connection. Each worker sets Django up before it unpickles its
+        # first task, since that imports this module and the models.
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=django.setup) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(parse_chunk, (task,)))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def write(self, rows):
+        """Write one batch; returns the (line, error) pairs of rows it rejected."""
+        # A later line with the same ISBN wins, as if loaded one by one
+        by_isbn = {}
+        for line_number, fields in rows:
+            by_isbn[fields['isbn']] = (line_number, fields)
+        repeated = len(rows) - len(by_isbn)
+
+        errors = []
+        with transaction.atomic():
+            # Locked so no loan opens or closes between this check and the update
+            on_loan = dict(
+                Book.objects.select_for_update().filter(isbn__in=list(by_isbn)).values_list('isbn', 'active_loans')
+            )
+            if self.on_conflict == 'update':
+                for isbn, loaned in on_loan.items():
+                    line_number, fields = by_isbn[isbn]
+                    if fields['quantity'] < loaned:
+                        errors.append((line_number, f"quantity {fields['quantity']} is less than "
+                                                    f"the {loaned} copies of ISBN {isbn} on loan"))
+                        del by_isbn[isbn]
+            existing = on_loan.keys() & by_isbn.keys()
+
+            if not self.dry_run and by_isbn:
+                books = [Book(**fields) for _, fields in by_isbn.values()]
+                if self.on_conflict == 'update':
+                    Book.objects.bulk_create(
+                        books, update_conflicts=True, unique_fields=['isbn'], update_fields=UPDATE_FIELDS
+                    )
+                    # The upsert set quantity to the owned total; copies on loan aren't on the shelf
+                    Book.objects.filter(isbn__in=existing, active_loans__gt=0).update(
+                        quantity=F('quantity') - F('active_loans')
+                    )
+                else:
+                    Book.objects.bulk_create(books, ignore_conflicts=True)
+                # bulk_create() sends no post_save signals
+                cache.invalidate(cache.BOOKS)
+
+        self.totals['inserted'] += len(by_isbn) - len(existing)
+        key = 'updated' if self.on_conflict == 'update' else 'skipped'
+        self.totals[key] += len(existing) + repeated
+        return errors
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            raise CommandError(f"No checkpoint at {self.checkpoint_path}; run without --resume.")
+        except ValueError:
+            raise CommandError(f"Checkpoint {self.checkpoint_path} is not valid JSON.")
+        if checkpoint.get('source') != self.source:
+            raise CommandError("The checkpoint was written for a different or changed file.")
+        self.totals.update(checkpoint['totals'])
+        self.stdout.write(f"Resuming after line {self.totals['line']:,}.")
+
+    def save_checkpoint(self):
+        # Write then rename, so a crash never leaves a half-written checkpoint
+        temporary = f'{self.checkpoint_path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump({'source': self.source, 'totals': self.totals}, f)
+        os.replace(temporary, self.checkpoint_path)
+
+    def progress(self, final=False):
+        now = time.perf_counter()
+        if not final and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        rate = self.processed / elapsed if elapsed else 0.0
+        line = (
+            f"line {self.totals['line']:,}: {self.totals['inserted']:,} new, "
+            f"{self.totals['updated'] + self.totals['skipped']:,} existing, "
+            f"{self.totals['rejected']:,} rejected, {rate:,.0f} rows/s"
+        )
+        if self.stdout.isatty() and not final:
+            self.stdout.write(line, ending='\r')
+            self.stdout.flush()
+        else:
+            self.stdout.write(line)
+
+    def report(self):
+        verb = "Would load" if self.dry_run else "Loaded"
+        existing = 'skipped' if self.on_conflict == 'skip' else 'updated'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {self.totals['inserted']:,} new books; {self.totals[existing]:,} {existing}, "
+            f"{self.totals['rejected']:,} rejected, in {time.perf_counter() - self.started:.1f}s."
+        ))
+        shown = self.errors[:20]
+        for line_number, error in shown:
+            self.stderr.write(f"  line {line_number}: {error}")
+        if self.totals['rejected'] > len(shown):
+            self.stderr.write(f"  ... and {self.totals['rejected'] - len(shown):,} more rejected lines")
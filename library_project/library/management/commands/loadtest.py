@@ -0,0 +1,195 @@
+# library/management/commands/loadtest.py
+"""
+Load-test the catalogue endpoints under WSGI and ASGI.
+
+By default this starts the project under gunicorn (WSGI) and then under
+uvicorn (ASGI), fires the same requests at each, and prints requests/sec
+and latency percentiles side by side:
+
+    python manage.py loadtest --requests 2000 --concurrency 50
+
+Use --url to measure a server that is already running instead, e.g. one
+behind your real proxy. The client is a pool of keep-alive threads, so on a
+single machine it competes with the servers for CPU; compare deployments
+against each other rather than reading the numbers as absolute capacity.
+"""
+import http.client
+import json
+import shlex
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from library.models import Student, Pupil
+
+
+DEFAULT_WSGI_COMMAND = (
+    'gunicorn library_project.wsgi:application --bind 127.0.0.1:{port} '
+    '--workers {workers} --threads 4 --log-level warning'
+)
+DEFAULT_ASGI_COMMAND = (
+    'uvicorn library_project.asgi:application --port {port} '
+    '--workers {workers} --log-level warning'
+)
+STARTUP_TIMEOUT = 30
+WARMUP_REQUESTS = 10
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(path, latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'path': path,
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'requests_per_second': (len(latencies) + errors) / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+class Client:
+    """Keep-alive HTTP client with one connection per worker thread."""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return self._local.connection
+
+    def get(self, path):
+        """Return (seconds, ok) for one GET request."""
+        started = time.perf_counter()
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request('GET', self.prefix + path)
+                response = connection.getresponse()
+                response.read()
+                if response.will_close:
+                    connection.close()
+                    self._local.connection = None
+                return time.perf_counter() - started, response.status < 400
+            except (OSError, http.client.HTTPException):
+                # The server closed a kept-alive connection; retry once on a new one
+                connection.close()
+                self._local.connection = None
+        return time.perf_counter() - started, False
+
+
+class Command(BaseCommand):
+    help = "Compare requests/sec and p99 latency of the catalogue views under WSGI and ASGI."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Measure this already-running server only.")
+        parser.add_argument('--requests', type=int, default=500, help="Requests per path (default 500).")
+        parser.add_argument('--concurrency', type=int, default=20, help="Concurrent clients (default 20).")
+        parser.add_argument('--path', action='append', dest='paths',
+                            help="Path to request; repeat for several. Defaults to the catalogue views.")
+        parser.add_argument('--workers', type=int, default=2, help="Server worker processes (default 2).")
+        parser.add_argument('--port', type=int, default=8765, help="Port for the servers started here.")
+        parser.add_argument('--wsgi-command', default=DEFAULT_WSGI_COMMAND)
+        parser.add_argument('--asgi-command', default=DEFAULT_ASGI_COMMAND)
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or self.default_paths()
+
+        if options['url']:
+            results = {options['url']: self.measure(options['url'], paths, options)}
+        else:
+            results = {}
+            for name in ('wsgi', 'asgi'):
+                command = options[f'{name}_command'].format(port=options['port'], workers=options['workers'])
+                with self.server(command, options['port']):
+                    results[name] = self.measure(f"http://127.0.0.1:{options['port']}", paths, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.print_table(results)
+
+    def default_paths(self):
+        paths = [reverse('book_list'), reverse('borrowed_books'), reverse('check_user_type')]
+        for user_type, model in (('student', Student), ('pupil', Pupil)):
+            user_id = model.objects.values_list('user_id', flat=True).first()
+            if user_id:
+                paths.append(reverse('user_books', args=[user_type, user_id]))
+        return paths
+
+    @contextmanager
+    def server(self, command, port):
+        self.stdout.write(f"Starting: {command}")
+        try:
+            process = subprocess.Popen(shlex.split(command), cwd=settings.BASE_DIR)
+        except FileNotFoundError as e:
+            raise CommandError(f"Cannot start server ({e}); install it or pass --url.")
+        try:
+            self.wait_for_port(port, process)
+            yield process
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def wait_for_port(self, port, process):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"Server exited with status {process.returncode}.")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f"Server did not start listening on port {port}.")
+
+    def measure(self, base_url, paths, options):
+        client = Client(base_url)
+        summaries = []
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for path in paths:
+                # Warm up connections, caches and lazy imports before timing
+                list(pool.map(client.get, [path] * WARMUP_REQUESTS))
+
+                started = time.perf_counter()
+                outcomes = list(pool.map(client.get, [path] * options['requests']))
+                seconds = time.perf_counter() - started
+
+                latencies = [latency for latency, ok in outcomes if ok]
+                summaries.append(summarize(path, latencies, len(outcomes) - len(latencies), seconds))
+        return summaries
+
+    def print_table(self, results):
+        header = f"{'deployment':<12} {'path':<36} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for deployment, summaries in results.items():
+            for row in summaries:
+                self.stdout.write(
+                    f"{deployment[:12]:<12} {row['path'][:36]:<36} {row['requests_per_second']:>9.1f} "
+                    f"{row['p50_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['errors']:>7}"
+                )
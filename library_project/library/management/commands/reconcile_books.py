@@ -0,0 +1,69 @@
+# library/management/commands/reconcile_books.py
+"""
+Recount every book's active_loans from the Loan table and report drift.
+
+    python manage.py reconcile_books
+    python manage.py reconcile_books --dry-run
+
+The borrow and return paths keep the counter in step with quantity, but
+loans opened or removed some other way (the Django shell, deleting a
+borrower, raw SQL) bypass it. total_copies is generated from quantity and
+active_loans, so correcting one corrects the other.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Abs
+
+from library import cache
+from library.models import Book
+
+
+MAX_SHOWN = 20
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Recompute Book.active_loans (and so total_copies) from open loans and report drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without correcting it.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = (
+                Book.objects.annotate(actual_loans=Book.objects.loan_count_subquery())
+                .exclude(active_loans=F('actual_loans'))
+            )
+            summary = drifted.aggregate(books=Count('id'), loans=Sum(Abs(F('actual_loans') - F('active_loans'))))
+            shown = list(drifted.order_by('id').values_list('id', 'title', 'active_loans', 'actual_loans')[:MAX_SHOWN])
+
+            corrected = 0
+            if summary['books'] and not options['dry_run']:
+                corrected = Book.objects.sync_active_loans()
+                cache.invalidate(cache.BOOKS)
+
+        if not summary['books']:
+            self.stdout.write(self.style.SUCCESS("All book counters match the loan table."))
+            return
+
+        for book_id, title, stored, actual in shown:
+            self.stdout.write(f"  book {book_id} ({title}): active_loans {stored} -> {actual}")
+        if summary['books'] > len(shown):
+            self.stdout.write(f"  ... and {summary['books'] - len(shown):,} more books")
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(
+                f"{summary['books']:,} books have drifted by {summary['loans']:,} loans in total; nothing changed."
+            ))
+            return
+
+        logger.warning("Book loan counters corrected", extra={
+            'event': 'books.reconciled', 'books': corrected, 'loans': summary['loans'],
+        })
+        self.stdout.write(self.style.SUCCESS(
+            f"Corrected {corrected:,} books that had drifted by {summary['loans']:,} loans in total."
+        ))
@@ -0,0 +1,185 @@
+# library/metrics.py
+"""
+Per-view request metrics, exposed in the Prometheus text format.
+
+MetricsMiddleware times every request and records, under the name of the
+URL pattern that served it, the wall time, the number of SQL queries, the
+time spent in SQL and the response size. Queries are counted by an
+execute wrapper installed on each database connection as it is opened,
+which adds to the stats of the request running in the current context, so
+queries made from async views and streamed responses are counted too.
+
+The lookup cache's hit and miss counts (library.cache.stats()) are
+exported alongside.
+
+Metrics live in process memory: under several workers each one reports
+its own, and Prometheus sums them when it scrapes every worker.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from . import cache
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_BUDGET = 50
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNRESOLVED = '<unresolved>'
+
+_current = ContextVar('library_request_stats', default=None)
+
+
+class RequestStats:
+    """Queries and SQL time of one request, filled in by the execute wrapper."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+        self.over_budget = 0
+
+
+_metrics = defaultdict(ViewMetrics)
+_lock = threading.Lock()
+
+
+def get_query_budget(view):
+    """The most queries ``view`` may run before a warning is logged, or None."""
+    budgets = getattr(settings, 'LIBRARY_QUERY_BUDGETS', {})
+    if view in budgets:
+        return budgets[view]
+    return getattr(settings, 'LIBRARY_QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+
+
+def _instrument(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+def _install_wrapper(sender, connection, **kwargs):
+    # connect() runs again after a connection is closed; wrap it only once
+    if _instrument not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_instrument)
+
+
+connection_created.connect(_install_wrapper)
+
+
+def start():
+    """Begin collecting stats for a request in the current context."""
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def activate(stats):
+    return _current.set(stats)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def record(view, stats):
+    """Add a finished request's stats to the totals of ``view``."""
+    seconds = time.perf_counter() - stats.started
+    budget = get_query_budget(view)
+    over_budget = budget is not None and stats.queries > budget
+
+    with _lock:
+        metrics = _metrics[view]
+        metrics.requests += 1
+        metrics.seconds += seconds
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                metrics.buckets[index] += 1
+        metrics.queries += stats.queries
+        metrics.sql_seconds += stats.sql_seconds
+        metrics.response_bytes += stats.response_bytes
+        metrics.over_budget += over_budget
+
+    if over_budget:
+        logger.warning(
+            "%s ran %d SQL queries (budget %d) in %.1f ms",
+            view, stats.queries, budget, seconds * 1000,
+        )
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def snapshot():
+    """A copy of the per-view totals, keyed by view name."""
+    with _lock:
+        return {view: vars(metrics).copy() for view, metrics in _metrics.items()}
+
+
+def _label(view):
+    escaped = view.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'view="{escaped}"'
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    views = sorted(snapshot().items())
+    lines = []
+
+    def family(name, kind, help_text, field):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for view, metrics in views:
+            lines.append(f'{name}{{{_label(view)}}} {metrics[field]}')
+
+    family('library_requests_total', 'counter', 'Requests handled, by URL name.', 'requests')
+
+    lines.append('# HELP library_request_duration_seconds Wall time of requests, by URL name.')
+    lines.append('# TYPE library_request_duration_seconds histogram')
+    for view, metrics in views:
+        label = _label(view)
+        for bound, count in zip(DURATION_BUCKETS, metrics['buckets']):
+            lines.append(f'library_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'library_request_duration_seconds_bucket{{{label},le="+Inf"}} {metrics["requests"]}')
+        lines.append(f'library_request_duration_seconds_sum{{{label}}} {metrics["seconds"]}')
+        lines.append(f'library_request_duration_seconds_count{{{label}}} {metrics["requests"]}')
+
+    family('library_db_queries_total', 'counter', 'SQL queries run, by URL name.', 'queries')
+    family('library_db_query_seconds_total', 'counter', 'Time spent in SQL, by URL name.', 'sql_seconds')
+    family('library_response_bytes_total', 'counter', 'Response body bytes sent, by URL name.', 'response_bytes')
+    family('library_query_budget_exceeded_total', 'counter',
+           'Requests that ran more SQL queries than their budget, by URL name.', 'over_budget')
+
+    cache_stats = cache.stats()
+    for name, field, help_text in (
+        ('library_cache_hits_total', 'hits', 'Catalogue and user lookups served from the cache.'),
+        ('library_cache_misses_total', 'misses', 'Catalogue and user lookups that went to the database.'),
+    ):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {cache_stats[field]}')
+    return '\n'.join(lines) + '\n'
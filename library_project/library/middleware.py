@@ -0,0 +1,178 @@
+# library/middleware.py
+import re
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import log, metrics, routing
+
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# Accept a caller's id only if it can't garble a log line
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else metrics.UNRESOLVED
+
+
+def _count_stream(content, view, stats):
+    iterator = iter(content)
+    try:
+        while True:
+            # Queries made while producing a chunk belong to this request
+            token = metrics.activate(stats)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                metrics.deactivate(token)
+            stats.response_bytes += len(chunk)
+            yield chunk
+    finally:
+        metrics.record(view, stats)
+
+
+async def _acount_stream(content, view, stats):
+    iterator = aiter(content)
+    try:
+        while True:
+            token = metrics.activate(stats)
+            try:
+                chunk = await anext(iterator)
+            except StopAsyncIteration:
+                break
+            finally:
+                metrics.deactivate(token)
+            stats.response_bytes += len(chunk)
+            yield chunk
+    finally:
+        metrics.record(view, stats)
+
+
+class MetricsMiddleware:
+    """
+    Record wall time, SQL queries, SQL time and response size per URL name.
+
+    Works in both sync and async stacks so async views aren't pushed back
+    onto a thread. Streamed responses are recorded once the last chunk has
+    been sent, since that is when their queries run.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token = metrics.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats, token = metrics.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.deactivate(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        view = _view_name(request)
+        if response.streaming:
+            count = _acount_stream if response.is_async else _count_stream
+            response.streaming_content = count(response.streaming_content, view, stats)
+        else:
+            stats.response_bytes = len(response.content)
+            metrics.record(view, stats)
+        return response
+
+
+class RequestIdMiddleware:
+    """
+    Give every request an id, available to log records as ``request_id``.
+
+    An incoming X-Request-ID header (e.g. from a proxy) is reused when it
+    looks safe; otherwise a new id is generated. The id is echoed back in
+    the response's X-Request-ID header.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    def start(self, request):
+        incoming = request.headers.get(REQUEST_ID_HEADER, '')
+        request.request_id = incoming if REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex
+        return log.request_id.set(request.request_id)
+
+
+class ReadYourWritesMiddleware:
+    """
+    Keep a user's reads off the read replica just after they write.
+
+    Responses to unsafe methods, and to any request that wrote library rows
+    through the ORM, carry a cookie for LIBRARY_REPLICA_LAG_SECONDS that
+    @replica_reads views honour by reading from the primary. Does nothing
+    when no replica is configured.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        writes, token = routing.track_writes()
+        try:
+            response = self.get_response(request)
+        finally:
+            routing.stop_tracking(token)
+        return routing.pin_after_write(request, response, writes)
+
+    async def __acall__(self, request):
+        writes, token = routing.track_writes()
+        try:
+            response = await self.get_response(request)
+        finally:
+            routing.stop_tracking(token)
+        return routing.pin_after_write(request, response, writes)
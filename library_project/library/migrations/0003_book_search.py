@@ -0,0 +1,82 @@
+from django.db import migrations
+
+
+# The SQL is spelled out here rather than imported, so that later changes to
+# library.search can never alter what this migration did. library.search
+# queries the same expression.
+PG_VECTOR = "to_tsvector('simple', title || ' ' || author || ' ' || isbn)"
+
+SQLITE_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS library_book_fts USING fts5(
+        title, author, isbn,
+        content='library_book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO library_book_fts(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_au AFTER UPDATE OF title, author, isbn ON library_book BEGIN
+        INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+        INSERT INTO library_book_fts(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+    # Index any books that already exist
+    "INSERT INTO library_book_fts(library_book_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE_SQL = [
+    "DROP TRIGGER IF EXISTS library_book_fts_au",
+    "DROP TRIGGER IF EXISTS library_book_fts_ad",
+    "DROP TRIGGER IF EXISTS library_book_fts_ai",
+    "DROP TABLE IF EXISTS library_book_fts",
+]
+
+POSTGRES_SQL = [
+    f"CREATE INDEX IF NOT EXISTS book_search_idx ON library_book USING GIN ({PG_VECTOR})",
+]
+
+POSTGRES_REVERSE_SQL = [
+    "DROP INDEX IF EXISTS book_search_idx",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_SQL
+    elif vendor == 'postgresql':
+        statements = POSTGRES_SQL
+    else:
+        # Other backends search with icontains
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_REVERSE_SQL
+    elif vendor == 'postgresql':
+        statements = POSTGRES_REVERSE_SQL
+    else:
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0002_book_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:45
+
+import django.db.models.deletion
+import django.utils.timezone
+import library.models
+from django.db import migrations, models
+
+
+def copy_borrowings(apps, schema_editor):
+    """Turn every row of the old borrowed_books M2M tables into an open Loan."""
+    Loan = apps.get_model('library', 'Loan')
+    db_alias = schema_editor.connection.alias
+    now = django.utils.timezone.now()
+    due = library.models.default_due_at()
+    for user_type in ('student', 'pupil'):
+        through = apps.get_model('library', user_type.capitalize()).borrowed_books.through
+        rows = through.objects.using(db_alias).values_list(f'{user_type}_id', 'book_id').iterator(chunk_size=2000)
+        batch = []
+        for user_pk, book_id in rows:
+            batch.append(Loan(
+                borrower_type=user_type,
+                book_id=book_id,
+                borrowed_at=now,
+                due_at=due,
+                **{f'{user_type}_id': user_pk}
+            ))
+            if len(batch) >= 2000:
+                Loan.objects.using(db_alias).bulk_create(batch)
+                batch = []
+        Loan.objects.using(db_alias).bulk_create(batch)
+
+
+def copy_loans_back(apps, schema_editor):
+    Loan = apps.get_model('library', 'Loan')
+    db_alias = schema_editor.connection.alias
+    for user_type in ('student', 'pupil'):
+        through = apps.get_model('library', user_type.capitalize()).borrowed_books.through
+        loans = Loan.objects.using(db_alias).filter(borrower_type=user_type, returned_at__isnull=True)
+        through.objects.using(db_alias).bulk_create(
+            [through(book_id=book_id, **{f'{user_type}_id': user_pk})
+             for user_pk, book_id in loans.values_list(f'{user_type}_id', 'book_id')],
+            batch_size=2000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_book_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Loan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('borrower_type', models.CharField(choices=[('student', 'Student'), ('pupil', 'Pupil')], max_length=10)),
+                ('borrowed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('due_at', models.DateTimeField(default=library.models.default_due_at)),
+                ('returned_at', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loans', to='library.book')),
+                ('pupil', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='loans', to='library.pupil')),
+                ('student', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='loans', to='library.student')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', 'returned_at'], name='loan_book_returned_idx'), models.Index(fields=['student', 'returned_at'], name='loan_student_returned_idx'), models.Index(fields=['pupil', 'returned_at'], name='loan_pupil_returned_idx'), models.Index(fields=['returned_at', 'due_at'], name='loan_returned_due_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('borrower_type', 'student'), ('pupil__isnull', True), ('student__isnull', False)), models.Q(('borrower_type', 'pupil'), ('pupil__isnull', False), ('student__isnull', True)), _connector='OR'), name='loan_single_borrower'), models.UniqueConstraint(condition=models.Q(('returned_at__isnull', True)), fields=('student', 'book'), name='loan_active_student_book'), models.UniqueConstraint(condition=models.Q(('returned_at__isnull', True)), fields=('pupil', 'book'), name='loan_active_pupil_book')],
+            },
+        ),
+        migrations.RunPython(copy_borrowings, copy_loans_back),
+    ]
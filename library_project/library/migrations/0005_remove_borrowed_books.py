@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:46
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_loan'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='pupil',
+            name='borrowed_books',
+        ),
+        migrations.RemoveField(
+            model_name='student',
+            name='borrowed_books',
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:09
+
+import django.db.models.expressions
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# Copied from 0003_book_search rather than imported, so this migration never changes
+SQLITE_TRIGGER_SQL = [
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO library_book_fts(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS library_book_fts_au AFTER UPDATE OF title, author, isbn ON library_book BEGIN
+        INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+        INSERT INTO library_book_fts(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+]
+
+
+def count_active_loans(apps, schema_editor):
+    """Fill active_loans for every book with one correlated UPDATE."""
+    Book = apps.get_model('library', 'Book')
+    Loan = apps.get_model('library', 'Loan')
+    db_alias = schema_editor.connection.alias
+    counts = (
+        Loan.objects.filter(book=OuterRef('pk'), returned_at__isnull=True)
+        .order_by()
+        .values('book')
+        .annotate(total=Count('*'))
+        .values('total')
+    )
+    Book.objects.using(db_alias).update(active_loans=Coalesce(Subquery(counts, output_field=IntegerField()), 0))
+
+
+def restore_search_triggers(apps, schema_editor):
+    """Adding the stored generated column rebuilds library_book on SQLite, dropping its triggers."""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in SQLITE_TRIGGER_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_remove_borrowed_books'),
+    ]
+
+    operations = [
+        # Undoing the migration rebuilds the table as well
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='book',
+            name='active_loans',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_active_loans, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='book',
+            name='total_copies',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(models.F('quantity'), '+', models.F('active_loans')), output_field=models.IntegerField()),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
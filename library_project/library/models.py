@@ -1,7 +1,59 @@
 # library/models.py (updated with dynamic related_name)
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.conf import settings
 from django.core.exceptions import ValidationError
-import re
+from django.db.models import Q
+from django.dispatch import Signal
+from django.utils import timezone
+from datetime import timedelta
+import logging
+
+from . import user_ids
+
+
+logger = logging.getLogger(__name__)
+
+# Sent with book_id whenever Book.adjust_quantity() changes stock in the database.
+# Raw UPDATEs don't fire post_save, so caches listen for this instead.
+stock_changed = Signal()
+
+
+def _count_subquery(queryset, field):
+    """Correlated COUNT(*) of ``queryset`` rows whose ``field`` matches the outer pk."""
+    counts = (
+        queryset.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(total=Count('*'))
+        .values('total')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+class BookQuerySet(models.QuerySet):
+    def with_borrower_counts(self):
+        """Annotate student_count and pupil_count of active loans with one subquery each."""
+        return self.annotate(
+            student_count=_count_subquery(Loan.objects.active().filter(borrower_type='student'), 'book'),
+            pupil_count=_count_subquery(Loan.objects.active().filter(borrower_type='pupil'), 'book'),
+        )
+
+    def loan_count_subquery(self):
+        """The number of active loans of each book, counted from the Loan table."""
+        return _count_subquery(Loan.objects.active(), 'book')
+
+    def sync_active_loans(self):
+        """Recount active_loans from the Loan table in one UPDATE; returns the rows corrected."""
+        actual = self.loan_count_subquery()
+        return self.filter(~Q(active_loans=actual)).update(active_loans=actual)
+
+
+class UserQuerySet(models.QuerySet):
+    def with_borrowed_count(self):
+        """Annotate borrowed_count, the number of books each user currently has."""
+        return self.annotate(borrowed_count=Count('loans', filter=Q(loans__returned_at__isnull=True)))
 
 
 class Book(models.Model):
@@ -16,10 +68,66 @@ class Book(models.Model):
     year = models.IntegerField()
     quantity = models.IntegerField()
     label = models.CharField(max_length=20, choices=LABEL_CHOICES, default='general')
+    # Copies out on loan. The borrow and return paths move it in the same
+    # UPDATE as quantity; `manage.py reconcile_books` repairs any drift.
+    active_loans = models.IntegerField(default=0, editable=False)
+    # Copies the library owns, on the shelf or on loan
+    total_copies = models.GeneratedField(
+        expression=F('quantity') + F('active_loans'),
+        output_field=models.IntegerField(),
+        db_persist=True,
+    )
+
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Sort keys for book_list keyset pagination
+            models.Index(fields=['title'], name='book_title_idx'),
+            models.Index(fields=['year'], name='book_year_idx'),
+            models.Index(fields=['author', 'title'], name='book_author_title_idx'),
+            # Availability pickers filter on label and stock together
+            models.Index(fields=['label', 'quantity'], name='book_label_quantity_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def adjust_quantity(cls, book_id, delta):
+        """
+        Atomically put ``delta`` copies back on the shelf in a single UPDATE.
+
+        A negative ``delta`` lends copies out. active_loans moves by the
+        opposite amount in the same statement, so total_copies stays put.
+        The update only applies while the stock stays non-negative, so two
+        concurrent borrows can never both take the last copy. Returns the new
+        quantity, or None when the book is missing or out of stock.
+        """
+        if connection.vendor in ('sqlite', 'postgresql'):
+            # UPDATE ... RETURNING hands back the new count in the same statement
+            table = connection.ops.quote_name(cls._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {table} SET quantity = quantity + %s, active_loans = active_loans - %s "
+                    f"WHERE id = %s AND quantity + %s >= 0 RETURNING quantity",
+                    [delta, delta, book_id, delta]
+                )
+                row = cursor.fetchone()
+            new_quantity = row[0] if row else None
+        else:
+            with transaction.atomic():
+                updated = cls.objects.filter(pk=book_id, quantity__gte=-delta).update(
+                    quantity=F('quantity') + delta, active_loans=F('active_loans') - delta
+                )
+                new_quantity = None
+                if updated:
+                    new_quantity = cls.objects.filter(pk=book_id).values_list('quantity', flat=True).get()
+
+        if new_quantity is not None:
+            stock_changed.send(sender=cls, book_id=book_id)
+        return new_quantity
+
 
 class User(models.Model):
     user_id = models.CharField(max_length=5, unique=True)
@@ -27,84 +135,181 @@ class User(models.Model):
     surname = models.CharField(max_length=100)
     group = models.CharField(max_length=50)
 
-    # Note: this field is now defined in the child classes, not in the abstract User class
+    objects = UserQuerySet.as_manager()
+
+    # Set by subclasses; names both Loan.borrower_type and the Loan foreign key
+    borrower_type = None
 
     class Meta:
         abstract = True
 
+    @property
+    def borrowed_books(self):
+        """Books this user currently has on loan."""
+        return Book.objects.filter(**{
+            f'loans__{self.borrower_type}': self,
+            'loans__returned_at__isnull': True,
+        })
+
     def clean(self):
-        # Validate user_id is 5 digits
-        if not re.match(r'^\d{5}$', self.user_id):
-            raise ValidationError("User ID must be a 5-digit number.")
+        # Validate user_id is 5 digits in this kind of user's range
+        error = user_ids.error_for(self.user_id, self.borrower_type)
+        if error:
+            raise ValidationError(error)
 
     def borrow_book(self, book):
-        if self.can_borrow(book) and book.quantity > 0:
-            self.borrowed_books.add(book)
-            book.quantity -= 1
-            book.save()
-            return True
-        return False
+        """Borrow a book, taking one copy with a conditional database-side decrement."""
+        if not self.can_borrow(book):
+            return False
+
+        try:
+            with transaction.atomic():
+                new_quantity = Book.adjust_quantity(book.pk, -1)
+                if new_quantity is None:
+                    return False
+                Loan.objects.create(borrower_type=self.borrower_type, book=book, **{self.borrower_type: self})
+        except IntegrityError:
+            # Already has this book on loan; the decrement was rolled back
+            return False
+
+        # Keep the in-memory instance in step without re-reading it
+        book.quantity = new_quantity
+        logger.info("Loan opened", extra={
+            'event': 'loan.opened', 'user_id': self.user_id, 'book_id': book.pk, 'quantity': new_quantity,
+        })
+        return True
 
     def return_book(self, book):
         """Return a borrowed book and update its quantity."""
-        if book in self.borrowed_books.all():
-            # First remove the book from the user's borrowed books
-            self.borrowed_books.remove(book)
-
-            # Then update the quantity
-            book.quantity += 1
-            book.save()
+        with transaction.atomic():
+            # Closing the loan first means a double return only counts once
+            returned = self.loans.active().filter(book=book).update(returned_at=timezone.now())
+            if not returned:
+                return False
 
-            # Debug print statement (optional, remove in production)
-            print(f"Book '{book.title}' returned. New quantity: {book.quantity}")
+            new_quantity = Book.adjust_quantity(book.pk, 1)
 
-            return True
-        return False
+        book.quantity = new_quantity
+        logger.info("Loan closed", extra={
+            'event': 'loan.closed', 'user_id': self.user_id, 'book_id': book.pk, 'quantity': new_quantity,
+        })
+        return True
     def check_user_type(self):
-        if self.user_id.startswith('2'):
-            return "This is a student"
-        elif self.user_id.startswith('1'):
-            return "This is a pupil"
-        else:
+        kind = user_ids.classify(self.user_id)
+        if kind is None:
             return "Unknown user type"
+        return f"This is a {kind}"
 
     def can_borrow(self, book):
         # To be overridden in subclasses
         return False
 
+    def borrowable_books(self):
+        """The books can_borrow() allows, as a queryset; overridden alongside it."""
+        return Book.objects.none()
+
     def __str__(self):
         return f"{self.name} {self.surname} ({self.group})"
 
 
 class Student(User):
-    # Define borrowed_books here with a unique related_name
-    borrowed_books = models.ManyToManyField(Book, blank=True, related_name='borrowed_by_students')
-
-    def clean(self):
-        super().clean()
-        # Validate student ID starts with 2
-        if not self.user_id.startswith('2'):
-            raise ValidationError("Student ID must start with '2' (20000-29999).")
+    borrower_type = user_ids.STUDENT
 
     def can_borrow(self, book):
         # Students can borrow any book
         return True
 
+    def borrowable_books(self):
+        return Book.objects.all()
+
 
 class Pupil(User):
-    # Define borrowed_books here with a unique related_name
-    borrowed_books = models.ManyToManyField(Book, blank=True, related_name='borrowed_by_pupils')
+    borrower_type = user_ids.PUPIL
     age = models.IntegerField(default=7)
 
-    def clean(self):
-        super().clean()
-        # Validate pupil ID starts with 1
-        if not self.user_id.startswith('1'):
-            raise ValidationError("Pupil ID must start with '1' (10000-19999).")
-
     def can_borrow(self, book):
         # Pupils can only borrow books labeled as "for children"
         # Optional: Age validation
         if self.age < 7:
             return False
-        return book.label == 'for children'
\ No newline at end of file
+        return book.label == 'for children'
+
+    def borrowable_books(self):
+        if self.age < 7:
+            return Book.objects.none()
+        return Book.objects.filter(label='for children')
+
+
+def default_due_at():
+    return timezone.now() + timedelta(days=getattr(settings, 'LIBRARY_LOAN_DAYS', 14))
+
+
+class LoanQuerySet(models.QuerySet):
+    def active(self):
+        """Loans whose book has not been returned yet."""
+        return self.filter(returned_at__isnull=True)
+
+    def overdue(self, now=None):
+        return self.active().filter(due_at__lt=now or timezone.now())
+
+
+class Loan(models.Model):
+    """One copy of a book lent to a student or a pupil."""
+    BORROWER_TYPES = [
+        ('student', 'Student'),
+        ('pupil', 'Pupil'),
+    ]
+
+    borrower_type = models.CharField(max_length=10, choices=BORROWER_TYPES)
+    # Exactly one of these is set, matching borrower_type
+    student = models.ForeignKey(Student, null=True, blank=True, on_delete=models.CASCADE, related_name='loans')
+    pupil = models.ForeignKey(Pupil, null=True, blank=True, on_delete=models.CASCADE, related_name='loans')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='loans')
+    borrowed_at = models.DateTimeField(default=timezone.now)
+    due_at = models.DateTimeField(default=default_due_at)
+    returned_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LoanQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=(
+                    Q(borrower_type='student', student__isnull=False, pupil__isnull=True)
+                    | Q(borrower_type='pupil', pupil__isnull=False, student__isnull=True)
+                ),
+                name='loan_single_borrower',
+            ),
+            # A borrower holds at most one active loan of the same book
+            models.UniqueConstraint(
+                fields=['student', 'book'],
+                condition=Q(returned_at__isnull=True),
+                name='loan_active_student_book',
+            ),
+            models.UniqueConstraint(
+                fields=['pupil', 'book'],
+                condition=Q(returned_at__isnull=True),
+                name='loan_active_pupil_book',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'returned_at'], name='loan_book_returned_idx'),
+            models.Index(fields=['student', 'returned_at'], name='loan_student_returned_idx'),
+            models.Index(fields=['pupil', 'returned_at'], name='loan_pupil_returned_idx'),
+            models.Index(fields=['returned_at', 'due_at'], name='loan_returned_due_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Callers may set only the foreign key
+        if self.student_id and not self.pupil_id:
+            self.borrower_type = 'student'
+        elif self.pupil_id and not self.student_id:
+            self.borrower_type = 'pupil'
+        super().save(*args, **kwargs)
+
+    @property
+    def borrower(self):
+        return self.student if self.borrower_type == 'student' else self.pupil
+
+    def __str__(self):
+        return f"{self.book} -> {self.borrower}"
@@ -0,0 +1,123 @@
+# library/pagination.py
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+
+class KeysetPage:
+    """One page of keyset-paginated results plus the cursor for the next page."""
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string; returns None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    return values
+
+
+def _cursor_position(queryset, field, cursor):
+    """
+    The (sort value, pk) a cursor points after, converted to the types of
+    ``field`` and the pk, or None if it is missing or doesn't fit them.
+    """
+    position = decode_cursor(cursor)
+    if position is None:
+        return None
+    value, pk = position
+    annotation = queryset.query.annotations.get(field)
+    sort_field = annotation.output_field if annotation is not None else queryset.model._meta.get_field(field)
+    # clean() also applies the database's range limits to integers
+    try:
+        if value is None or isinstance(value, bool) or isinstance(pk, bool):
+            raise ValidationError("cursor value is null or boolean")
+        return sort_field.clean(value, None), queryset.model._meta.pk.clean(pk, None)
+    except ValidationError:
+        return None
+
+
+def _keyset_slice(queryset, ordering, cursor, per_page):
+    descending = ordering.startswith('-')
+    field = ordering.lstrip('-')
+    queryset = queryset.order_by(ordering, '-pk' if descending else 'pk')
+
+    # A cursor that doesn't fit the sort starts from the first page, like a missing one
+    position = _cursor_position(queryset, field, cursor)
+    if position is not None:
+        value, pk = position
+        if descending:
+            queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'pk__lt': pk}))
+        else:
+            queryset = queryset.filter(Q(**{f'{field}__gt': value}) | Q(**{field: value, 'pk__gt': pk}))
+
+    # One extra row tells us whether there is a next page
+    return queryset[:per_page + 1]
+
+
+def _keyset_page(rows, ordering, per_page):
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, ordering.lstrip('-')), last.pk])
+    return KeysetPage(rows, next_cursor)
+
+
+def keyset_paginate(queryset, ordering, cursor=None, per_page=50):
+    """
+    Return a KeysetPage of ``queryset`` sorted by ``ordering`` then pk.
+
+    ``ordering`` is a field name, optionally prefixed with '-'. Instead of
+    OFFSET, the cursor carries the sort value and pk of the last row seen,
+    so every page is a bounded index range scan however deep it is.
+    """
+    rows = list(_keyset_slice(queryset, ordering, cursor, per_page))
+    return _keyset_page(rows, ordering, per_page)
+
+
+async def akeyset_paginate(queryset, ordering, cursor=None, per_page=50):
+    """Async version of keyset_paginate()."""
+    rows = [row async for row in _keyset_slice(queryset, ordering, cursor, per_page)]
+    return _keyset_page(rows, ordering, per_page)
+
+
+async def aget_page(queryset, per_page, number):
+    """
+    Async Paginator(queryset, per_page).get_page(number).
+
+    The count and the page rows are fetched with the async ORM, so the
+    returned Page can be rendered without touching the database again.
+    """
+    paginator = Paginator(queryset, per_page)
+    # Assigning the cached property stops the paginator counting synchronously
+    paginator.count = await queryset.acount()
+    page = paginator.get_page(number)
+    page.object_list = [row async for row in page.object_list]
+    return page
@@ -0,0 +1,86 @@
+# library/purge.py
+"""
+Delete all library data without loading it into memory.
+
+QuerySet.delete() collects every row, and every row related to it, in
+Python before deleting anything, so it can cascade and send signals. On a
+large library that means millions of objects in memory. purge_all()
+deletes table by table in dependency order instead, loans first so nothing
+is left to cascade. PostgreSQL truncates all four tables in one
+statement; other backends delete in primary-key chunks with plain SQL.
+No signals are sent, so the caches are invalidated explicitly.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import cache
+from .models import Book, Student, Pupil, Loan
+
+
+DEFAULT_CHUNK_SIZE = 5000
+# Referencing tables come before the tables they reference
+TABLES = {
+    'loans': Loan,
+    'books': Book,
+    'students': Student,
+    'pupils': Pupil,
+}
+
+
+def get_chunk_size():
+    return getattr(settings, 'LIBRARY_PURGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def count_rows():
+    """Rows in each table, keyed like TABLES, from a single query."""
+    counts = ', '.join(f'(SELECT COUNT(*) FROM {_table(model)})' for model in TABLES.values())
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {counts}')
+        return dict(zip(TABLES, cursor.fetchone()))
+
+
+def _delete_in_chunks(cursor, model, chunk_size):
+    """Yield the running total of rows deleted from ``model``'s table, one chunk at a time."""
+    table = _table(model)
+    pk = connection.ops.quote_name(model._meta.pk.column)
+    deleted = 0
+    while True:
+        cursor.execute(f'SELECT {pk} FROM {table} ORDER BY {pk} LIMIT %s', [chunk_size])
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(f'DELETE FROM {table} WHERE {pk} IN ({placeholders})', ids)
+        deleted += len(ids)
+        yield deleted
+
+
+def purge_all(chunk_size=None, progress=None):
+    """
+    Delete every loan, book, student and pupil in one transaction.
+
+    ``progress(table, deleted, total)`` is called after each chunk, with
+    table names as in TABLES. Returns the rows deleted per table.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    with transaction.atomic():
+        counts = count_rows()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('TRUNCATE ' + ', '.join(_table(model) for model in TABLES.values()))
+                if progress:
+                    for name, total in counts.items():
+                        progress(name, total, total)
+            else:
+                for name, model in TABLES.items():
+                    for deleted in _delete_in_chunks(cursor, model, chunk_size):
+                        if progress:
+                            progress(name, deleted, counts[name])
+
+        # Raw deletes send no post_delete signals
+        cache.invalidate(*cache.ALL_NAMESPACES)
+    return counts
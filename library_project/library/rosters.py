@@ -0,0 +1,213 @@
+# library/rosters.py
+"""
+Bulk import of student and pupil rosters.
+
+A roster is CSV with a header row, or JSON Lines, with one user per row:
+
+    user_id,name,surname,group,age
+    20001,Ann,Lee,A1,
+    10001,Bob,Ray,1B,8
+
+The ID's range decides whether a row is a student or a pupil; an optional
+``type`` column must agree with it. ``age`` only applies to pupils and
+defaults to the model default.
+
+Rows stream in and are written in batches. Each batch classifies all its
+IDs in one pass, finds the ones already taken with a single query across
+both tables, and bulk-inserts the rest. The whole import runs in one
+transaction, and the report has the same shape as import_books()'s.
+"""
+import csv
+import json
+import time
+
+from django.db import transaction
+
+from . import user_ids
+from .importers import MAX_REPORTED_ERRORS, get_batch_size
+from .models import Student, Pupil
+
+
+FORMATS = ('csv', 'jsonl')
+MODELS = {user_ids.STUDENT: Student, user_ids.PUPIL: Pupil}
+TEXT_FIELDS = ('name', 'surname', 'group')
+
+
+class RosterError(ValueError):
+    """Raised when a roster file as a whole cannot be read."""
+
+
+def roster_format(filename):
+    """'jsonl' for .jsonl and .ndjson files, otherwise 'csv'."""
+    name = filename.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def clean_roster_record(record):
+    """
+    Check one row apart from its ID's range, which is checked per batch.
+
+    Returns (stated type or None, model field values). Raises ValueError
+    if the row cannot be imported.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+
+    fields = {'user_id': str(record.get('user_id') or '').strip()}
+    for name in TEXT_FIELDS:
+        value = str(record.get(name) or '').strip()
+        max_length = Student._meta.get_field(name).max_length
+        if not value:
+            raise ValueError(f"{name} is required")
+        if len(value) > max_length:
+            raise ValueError(f"{name} is longer than {max_length} characters")
+        fields[name] = value
+
+    age = record.get('age')
+    if age not in (None, ''):
+        try:
+            fields['age'] = int(age)
+        except (TypeError, ValueError):
+            raise ValueError("age must be a whole number")
+
+    stated = str(record.get('type') or '').strip().lower() or None
+    if stated is not None and stated not in MODELS:
+        raise ValueError("type must be 'student' or 'pupil'")
+    return stated, fields
+
+
+def _read_record(line, file_format, header):
+    if file_format == 'jsonl':
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise ValueError("line is not valid JSON")
+    return dict(zip(header, next(csv.reader([line]))))
+
+
+def _save_batch(batch, report, seen):
+    started = time.perf_counter()
+    rejected = 0
+
+    kinds = user_ids.classify_many([fields['user_id'] for _, _, fields in batch])
+    rows = {kind: [] for kind in MODELS}
+    for (line_number, stated, fields), kind in zip(batch, kinds):
+        if kind is None or stated not in (None, kind):
+            rejected += 1
+            _record_error(report, line_number, user_ids.error_for(fields['user_id'], stated))
+            continue
+        rows[kind].append((line_number, fields))
+
+    # One query over both tables for the IDs already taken
+    lookups = [
+        MODELS[kind].objects.filter(user_id__in=[fields['user_id'] for _, fields in kind_rows])
+        .values_list('user_id', flat=True)
+        for kind, kind_rows in rows.items() if kind_rows
+    ]
+    existing = set(lookups[0].union(*lookups[1:])) if lookups else set()
+
+    accepted = {}
+    for kind, kind_rows in rows.items():
+        model = MODELS[kind]
+        users = []
+        for line_number, fields in kind_rows:
+            user_id = fields['user_id']
+            if user_id in existing:
+                rejected += 1
+                _record_error(report, line_number, f"user ID {user_id} already exists")
+                continue
+            if user_id in seen:
+                rejected += 1
+                _record_error(report, line_number, f"user ID {user_id} appears earlier in the file")
+                continue
+            seen.add(user_id)
+            if model is Student:
+                fields.pop('age', None)
+            users.append(model(**fields))
+        model.objects.bulk_create(users, batch_size=len(users) or None)
+        accepted[kind] = len(users)
+
+    return accepted, rejected, time.perf_counter() - started
+
+
+def _record_error(report, line_number, reason):
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_number, 'error': reason})
+
+
+def import_roster(lines, file_format='csv', batch_size=None):
+    """
+    Import students and pupils from an iterable of CSV or JSONL text lines.
+
+    Returns a report dict with per-batch and total counts, the accepted
+    rows split into students and pupils, and the first rejected lines.
+    Raises RosterError, and imports nothing, if the file can't be read.
+    """
+    if file_format not in FORMATS:
+        raise RosterError(f"Unknown roster format: {file_format}")
+    batch_size = batch_size or get_batch_size()
+    report = {
+        'batches': [],
+        'accepted': 0,
+        'rejected': 0,
+        'students': 0,
+        'pupils': 0,
+        'errors': [],
+        'seconds': 0.0,
+        'rows_per_second': 0.0,
+    }
+    started = time.perf_counter()
+    batch = []
+    parse_rejected = 0
+    seen = set()
+    header = None
+
+    def flush():
+        nonlocal parse_rejected
+        accepted, rejected, seconds = _save_batch(batch, report, seen)
+        rejected += parse_rejected
+        report['batches'].append({
+            'number': len(report['batches']) + 1,
+            'accepted': sum(accepted.values()),
+            'rejected': rejected,
+            'seconds': seconds,
+        })
+        report['students'] += accepted[user_ids.STUDENT]
+        report['pupils'] += accepted[user_ids.PUPIL]
+        report['accepted'] += sum(accepted.values())
+        report['rejected'] += rejected
+        batch.clear()
+        parse_rejected = 0
+
+    with transaction.atomic():
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():  # Skip empty lines
+                continue
+            if file_format == 'csv' and header is None:
+                header = [name.strip().lower() for name in next(csv.reader([line]))]
+                if 'user_id' not in header:
+                    raise RosterError("The CSV header must name a user_id column.")
+                continue
+            try:
+                stated, fields = clean_roster_record(_read_record(line, file_format, header))
+            except (ValueError, csv.Error) as e:
+                parse_rejected += 1
+                _record_error(report, line_number, str(e))
+                continue
+
+            batch.append((line_number, stated, fields))
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch or parse_rejected:
+            flush()
+        # No cache invalidation: user lookups never cache a miss
+
+    # Parse errors are found before a batch's ID errors; list them in file order
+    report['errors'].sort(key=lambda error: error['line'])
+    report['seconds'] = time.perf_counter() - started
+    if report['seconds'] > 0:
+        report['rows_per_second'] = (report['accepted'] + report['rejected']) / report['seconds']
+    return report
@@ -0,0 +1,158 @@
+# library/routing.py
+"""
+Send the heavy read-only views to a read replica.
+
+Views decorated with @replica_reads read library models from the
+database aliased by settings.LIBRARY_REPLICA_DATABASE, when that alias is
+configured (see library_project/database.py). Everything else, and
+every write, goes to the primary.
+
+A replica lags behind, so a user must see their own writes.
+library.middleware.ReadYourWritesMiddleware sets a short-lived cookie on every response to
+a POST (or other unsafe method), and on any response whose request wrote
+through the ORM. While that cookie is present, the user's reads stay on
+the primary. LIBRARY_REPLICA_LAG_SECONDS should exceed the replica's
+worst normal lag.
+
+Only the library app is routed. Sessions, auth and admin always use the
+primary.
+"""
+import functools
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+
+DEFAULT_REPLICA = 'replica'
+DEFAULT_LAG_SECONDS = 10
+PRIMARY_COOKIE = 'library_read_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# The alias reads go to in the current context, or None for the default
+_read_alias = ContextVar('library_read_alias', default=None)
+# Set by ReadYourWritesMiddleware for the request being handled; see track_writes()
+_request_writes = ContextVar('library_request_writes', default=None)
+
+
+class RequestWrites:
+    """Whether the request being handled has written library rows through the ORM."""
+
+    def __init__(self):
+        self.wrote = False
+
+
+def get_replica_alias():
+    """The configured replica alias, or None if there isn't one."""
+    alias = getattr(settings, 'LIBRARY_REPLICA_DATABASE', DEFAULT_REPLICA)
+    return alias if alias in settings.DATABASES else None
+
+
+def get_lag_seconds():
+    return getattr(settings, 'LIBRARY_REPLICA_LAG_SECONDS', DEFAULT_LAG_SECONDS)
+
+
+def _replica_for(request):
+    """The alias ``request`` may read from, or None if it must use the primary."""
+    if request.method not in SAFE_METHODS or PRIMARY_COOKIE in request.COOKIES:
+        return None
+    return get_replica_alias()
+
+
+def track_writes():
+    """Begin noting library writes for a request in the current context."""
+    writes = RequestWrites()
+    return writes, _request_writes.set(writes)
+
+
+def stop_tracking(token):
+    _request_writes.reset(token)
+
+
+def pin_after_write(request, response, writes):
+    """Keep the user's reads on the primary for a while if this request may have written."""
+    if get_replica_alias() and (writes.wrote or request.method not in SAFE_METHODS):
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=get_lag_seconds(), httponly=True, samesite='Lax')
+    return response
+
+
+def _iterate_on(alias, content):
+    iterator = iter(content)
+    while True:
+        # Streamed chunks are produced after the view returns
+        token = _read_alias.set(alias)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _read_alias.reset(token)
+        yield chunk
+
+
+async def _aiterate_on(alias, content):
+    iterator = aiter(content)
+    while True:
+        token = _read_alias.set(alias)
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        finally:
+            _read_alias.reset(token)
+        yield chunk
+
+
+def _keep_streaming_on(alias, response):
+    if response.streaming:
+        iterate = _aiterate_on if response.is_async else _iterate_on
+        response.streaming_content = iterate(alias, response.streaming_content)
+    return response
+
+
+def replica_reads(view):
+    """Read library models from the replica in ``view``, unless the user has just written."""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            alias = _replica_for(request)
+            if alias is None:
+                return await view(request, *args, **kwargs)
+            token = _read_alias.set(alias)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _read_alias.reset(token)
+            return _keep_streaming_on(alias, response)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            alias = _replica_for(request)
+            if alias is None:
+                return view(request, *args, **kwargs)
+            token = _read_alias.set(alias)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _read_alias.reset(token)
+            return _keep_streaming_on(alias, response)
+    return wrapper
+
+
+class ReplicaRouter:
+    """Route library reads to the replica inside @replica_reads views; everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'library':
+            return _read_alias.get()
+        return None
+
+    def db_for_write(self, model, **hints):
+        writes = _request_writes.get()
+        if writes is not None and model._meta.app_label == 'library':
+            writes.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
@@ -0,0 +1,84 @@
+# library/search.py
+"""
+Full-text search over the Book catalogue.
+
+On SQLite the index is an FTS5 table, ``library_book_fts``, that uses
+library_book as external content and is kept in sync by triggers, so
+bulk_create() and queryset.update() are covered too. On PostgreSQL a GIN
+index over a tsvector expression serves the same queries. Other backends
+fall back to icontains lookups.
+
+The index and its triggers are created by migration 0003_book_search,
+which spells out its own SQL. SQLite drops the triggers whenever a
+migration rebuilds library_book, so such a migration must create them
+again afterwards, as 0006 does.
+"""
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+
+FTS_TABLE = 'library_book_fts'
+
+# Must match the expression indexed in migration 0003_book_search
+PG_VECTOR = "to_tsvector('simple', {table}title || ' ' || {table}author || ' ' || {table}isbn)"
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query or '')
+
+
+def search_ordering():
+    """The ordering that puts the best matches first for the current backend."""
+    # bm25() is lower-is-better, ts_rank() is higher-is-better
+    return '-search_rank' if connection.vendor == 'postgresql' else 'search_rank'
+
+
+def search_books(queryset, query):
+    """
+    Filter a Book queryset to rows matching every word of ``query`` as a prefix.
+
+    The result is annotated with ``search_rank``; order by search_ordering()
+    to get the best matches first.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    if connection.vendor == 'sqlite':
+        # Each token quoted and starred: "harr"* "pot"* means harr* AND pot*
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        # Join the index once and rank from the same MATCH; a correlated
+        # bm25() subquery would re-run the MATCH for every candidate row
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f"{FTS_TABLE}.rowid = library_book.id", f"{FTS_TABLE} MATCH %s"],
+            params=[match],
+        ).annotate(
+            # FTS5's rank column is bm25() with the default weights
+            search_rank=RawSQL(f"{FTS_TABLE}.rank", (), output_field=FloatField())
+        )
+
+    if connection.vendor == 'postgresql':
+        ts_query = ' & '.join(f'{token}:*' for token in tokens)
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT id FROM library_book WHERE {PG_VECTOR.format(table='')} @@ to_tsquery('simple', %s)",
+                (ts_query,),
+            )
+        ).annotate(
+            search_rank=RawSQL(
+                f"ts_rank({PG_VECTOR.format(table='library_book.')}, to_tsquery('simple', %s))",
+                (ts_query,),
+                output_field=FloatField(),
+            )
+        )
+
+    condition = Q()
+    for token in tokens:
+        condition &= Q(title__icontains=token) | Q(author__icontains=token) | Q(isbn__icontains=token)
+    return queryset.filter(condition).annotate(search_rank=Value(0.0, output_field=FloatField()))
@@ -0,0 +1,323 @@
+# library/snapshot.py
+"""
+Streaming library snapshots.
+
+A snapshot is a JSON Lines file, gzip-compressed by default:
+
+    {"format": "library-snapshot", "version": 3}
+    {"table": "books", "columns": ["isbn", "title", ...]}
+    [["9780000000001", "Some Title", ...], ["9780000000002", ...], ...]
+    ...
+    {"table": "loans", "columns": ["borrower_type", "user_id", "isbn", ...]}
+    [["student", "20001", "9780000000001", "2025-04-01T10:00:00+00:00", ...], ...]
+    ...
+    {"end": true, "counts": {"books": 1, ...}}
+
+Each table section is a header followed by lines of up to chunk_size
+rows, each row a JSON array, so column names are written once per table
+rather than once per row. A whole line is encoded in one call to a shared
+JSONEncoder; encoding row by row spent most of the snapshot's time
+setting up the encoder. Loan dates are read as text in UTC, as the
+database stores them, rather than converted to datetimes and back, and
+a date without an offset is read back as UTC. Loans are stored by
+user_id and ISBN so a snapshot can be restored into any database.
+
+Version 2 snapshots held one row per line. Version 1 snapshots, written
+before the Loan table existed, also stored borrowings as "student_books"
+and "pupil_books" tables; they are read as open loans.
+"""
+import gzip
+import io
+import json
+import zlib
+from datetime import timezone
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import CharField, F
+from django.db.models.functions import Cast, Coalesce
+from django.utils.dateparse import parse_datetime
+
+from . import cache
+from .models import Book, Student, Pupil, Loan
+
+
+SNAPSHOT_FORMAT = 'library-snapshot'
+SNAPSHOT_VERSION = 3
+READABLE_VERSIONS = (1, 2, 3)
+# From this version on, each row line holds a list of rows
+BATCHED_VERSION = 3
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_RESTORE_BATCH_SIZE = 2000
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+LOAN_DATE_COLUMNS = ('borrowed_at', 'due_at', 'returned_at')
+# Level 4 compresses several times faster than the default 6, for a file about 10% larger
+COMPRESS_LEVEL = 4
+
+# (table name, rows factory, column names written to the snapshot)
+TABLES = (
+    ('books', lambda: Book.objects.order_by('id').values_list(
+        'isbn', 'title', 'author', 'year', 'quantity', 'label'),
+     ('isbn', 'title', 'author', 'year', 'quantity', 'label')),
+    ('students', lambda: Student.objects.order_by('id').values_list(
+        'user_id', 'name', 'surname', 'group'),
+     ('user_id', 'name', 'surname', 'group')),
+    ('pupils', lambda: Pupil.objects.order_by('id').values_list(
+        'user_id', 'name', 'surname', 'group', 'age'),
+     ('user_id', 'name', 'surname', 'group', 'age')),
+    ('loans', lambda: Loan.objects.order_by('id').values_list(
+        'borrower_type', Coalesce('student__user_id', 'pupil__user_id'), F('book__isbn'),
+        *(Cast(column, CharField()) for column in LOAN_DATE_COLUMNS)),
+     ('borrower_type', 'user_id', 'isbn') + LOAN_DATE_COLUMNS),
+)
+
+# Version 1 borrow tables and the borrower type of their rows
+LEGACY_BORROW_TABLES = {
+    'student_books': 'student',
+    'pupil_books': 'pupil',
+}
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file is malformed or of an unsupported version."""
+
+
+def get_chunk_size():
+    return getattr(settings, 'LIBRARY_SNAPSHOT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def get_restore_batch_size():
+    return getattr(settings, 'LIBRARY_RESTORE_BATCH_SIZE', DEFAULT_RESTORE_BATCH_SIZE)
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def _dumps(value):
+    return _encoder.encode(value)
+
+
+def _parse_date(value):
+    """A snapshot date as an aware datetime; dates written without an offset are UTC."""
+    if not value:
+        return None
+    date = parse_datetime(value)
+    if date is not None and date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def iter_snapshot_lines(chunk_size=None):
+    """Yield the snapshot as text chunks, one chunk per batch of rows."""
+    chunk_size = chunk_size or get_chunk_size()
+    counts = {}
+
+    yield _dumps({'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION}) + '\n'
+
+    for table, get_rows, columns in TABLES:
+        yield _dumps({'table': table, 'columns': columns}) + '\n'
+
+        rows = get_rows().iterator(chunk_size=chunk_size)
+        count = 0
+        while chunk := list(islice(rows, chunk_size)):
+            count += len(chunk)
+            yield _dumps(chunk) + '\n'
+        counts[table] = count
+
+    yield _dumps({'end': True, 'counts': counts}) + '\n'
+
+
+def iter_snapshot(compress=True, chunk_size=None):
+    """Yield the snapshot as encoded bytes, gzip-compressed unless compress is False."""
+    if not compress:
+        for text in iter_snapshot_lines(chunk_size):
+            yield text.encode('utf-8')
+        return
+
+    # wbits=31 writes a gzip container that gzip.open() and zcat can read
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    for text in iter_snapshot_lines(chunk_size):
+        data = compressor.compress(text.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _open_text(fileobj):
+    head = fileobj.read(2)
+    fileobj.seek(0)
+    if head == GZIP_MAGIC:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return io.TextIOWrapper(fileobj, encoding='utf-8')
+
+
+def iter_snapshot_rows(fileobj):
+    """
+    Read a snapshot from a binary file object, plain or gzip-compressed.
+
+    Yields (table, row) pairs where row is a dict keyed by column name.
+    Raises SnapshotError if the file is not a complete snapshot.
+    """
+    lines = iter(_open_text(fileobj))
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError, OSError, EOFError):
+        raise SnapshotError("Not a library snapshot file.")
+    if not isinstance(header, dict) or header.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError("Not a library snapshot file.")
+    if header.get('version') not in READABLE_VERSIONS:
+        raise SnapshotError(f"Unsupported snapshot version: {header.get('version')}.")
+    batched = header['version'] >= BATCHED_VERSION
+
+    known_tables = {table for table, _, _ in TABLES} | set(LEGACY_BORROW_TABLES)
+    table = columns = None
+    try:
+        for line in lines:
+            record = json.loads(line)
+            if isinstance(record, list):
+                for values in record if batched else [record]:
+                    if columns is None or not isinstance(values, list) or len(values) != len(columns):
+                        raise SnapshotError("Snapshot row does not match its table header.")
+                    row = dict(zip(columns, values))
+                    if table in LEGACY_BORROW_TABLES:
+                        row['borrower_type'] = LEGACY_BORROW_TABLES[table]
+                        yield 'loans', row
+                    else:
+                        yield table, row
+            elif record.get('end'):
+                return
+            elif record.get('table') in known_tables:
+                table, columns = record['table'], record['columns']
+            else:
+                raise SnapshotError(f"Unknown snapshot table: {record.get('table')}.")
+    except SnapshotError:
+        raise
+    except (ValueError, OSError, EOFError, AttributeError) as e:
+        raise SnapshotError(f"Corrupt snapshot file: {e}")
+
+    raise SnapshotError("Snapshot file is truncated.")
+
+
+# Models upserted from each snapshot table, keyed on their natural key
+UPSERT_TABLES = {
+    'books': (Book, 'isbn'),
+    'students': (Student, 'user_id'),
+    'pupils': (Pupil, 'user_id'),
+}
+BORROWER_MODELS = {
+    'student': Student,
+    'pupil': Pupil,
+}
+
+
+class SnapshotRestore:
+    """
+    Set-based restore of a snapshot into the database.
+
+    Books, students and pupils are upserted on their natural keys with
+    bulk_create(update_conflicts=True). Loans are resolved through one
+    ISBN -> id map and one user_id -> pk map per user model, then
+    bulk-inserted. Everything runs in one transaction.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or get_restore_batch_size()
+        self.counts = {table: 0 for table in list(UPSERT_TABLES) + ['loans']}
+        self.missing = 0
+        self._book_ids = None
+        self._user_pks = {}
+        self._restored_users = {model: [] for model in BORROWER_MODELS.values()}
+
+    def run(self, fileobj):
+        with transaction.atomic():
+            table = None
+            batch = []
+            for row_table, row in iter_snapshot_rows(fileobj):
+                if row_table != table or len(batch) >= self.batch_size:
+                    self._flush(table, batch)
+                    table, batch = row_table, []
+                batch.append(row)
+            self._flush(table, batch)
+
+            # Restored users without any loan rows still lose stale loans
+            for model in BORROWER_MODELS.values():
+                if model not in self._user_pks and self._restored_users[model]:
+                    self._load_users(model)
+
+            # Loans were inserted and deleted in bulk, so recount them per book
+            Book.objects.sync_active_loans()
+
+            # Bulk upserts bypass the model signals the cache listens to
+            cache.invalidate(*cache.ALL_NAMESPACES)
+        return self.counts
+
+    def _flush(self, table, rows):
+        if not rows:
+            return
+        if table in UPSERT_TABLES:
+            self._upsert(table, rows)
+        else:
+            self._insert_loans(rows)
+        self.counts[table] += len(rows)
+
+    def _upsert(self, table, rows):
+        model, key = UPSERT_TABLES[table]
+        update_fields = [column for column in rows[0] if column != key]
+        model.objects.bulk_create(
+            [model(**row) for row in rows],
+            update_conflicts=True,
+            unique_fields=[key],
+            update_fields=update_fields,
+        )
+        if model in self._restored_users:
+            self._restored_users[model].extend(row[key] for row in rows)
+
+    def _insert_loans(self, rows):
+        if self._book_ids is None:
+            self._book_ids = dict(Book.objects.values_list('isbn', 'id'))
+
+        loans = []
+        for row in rows:
+            model = BORROWER_MODELS.get(row['borrower_type'])
+            if model is None:
+                self.missing += 1
+                continue
+            if model not in self._user_pks:
+                self._load_users(model)
+
+            user_pk = self._user_pks[model].get(row['user_id'])
+            book_id = self._book_ids.get(row['isbn'])
+            if user_pk is None or book_id is None:
+                self.missing += 1
+                continue
+
+            # Version 1 rows carry no dates; the model defaults fill them in
+            dates = {column: _parse_date(row[column]) for column in LOAN_DATE_COLUMNS if column in row}
+            loans.append(Loan(
+                borrower_type=row['borrower_type'],
+                book_id=book_id,
+                **{f"{row['borrower_type']}_id": user_pk},
+                **dates
+            ))
+        Loan.objects.bulk_create(loans, ignore_conflicts=True)
+
+    def _load_users(self, model):
+        self._user_pks[model] = dict(model.objects.values_list('user_id', 'pk'))
+
+        # Loans of restored users come from the snapshot only
+        user_pks = self._user_pks[model]
+        restored = [user_pks[user_id] for user_id in self._restored_users[model] if user_id in user_pks]
+        for start in range(0, len(restored), self.batch_size):
+            Loan.objects.filter(
+                **{f'{model.borrower_type}_id__in': restored[start:start + self.batch_size]}
+            ).delete()
+
+
+def restore_snapshot(fileobj, batch_size=None):
+    """Restore a snapshot file; returns (counts per table, skipped loans)."""
+    restore = SnapshotRestore(batch_size)
+    counts = restore.run(fileobj)
+    return counts, restore.missing
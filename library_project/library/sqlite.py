@@ -0,0 +1,38 @@
+# library/sqlite.py
+"""
+Per-connection SQLite tuning.
+
+busy_timeout and synchronous apply to one connection only, so they are
+set on every connection as it opens, from settings.LIBRARY_SQLITE_PRAGMAS
+(see library_project/database.py). journal_mode is stored in the database
+file itself and is only set when LIBRARY_SQLITE_WAL is on:
+
+journal_mode=WAL
+    Readers no longer block the writer, or the writer the readers.
+synchronous=NORMAL
+    Set with WAL, and safe with it. A power cut can lose the last
+    commits but never corrupts the database, and commits skip an fsync.
+busy_timeout
+    A connection waits this many milliseconds for the write lock before
+    raising "database is locked".
+
+Other backends are left alone.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def get_pragmas():
+    return getattr(settings, 'LIBRARY_SQLITE_PRAGMAS', {})
+
+
+def _configure(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in get_pragmas().items():
+            # PRAGMA takes no bound parameters; names and values come from settings only
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(_configure)
@@ -0,0 +1,27 @@
+# library/test_runner.py
+"""
+The test runner named by settings.TEST_RUNNER.
+
+The library's log handler writes JSON lines to stderr, where they would
+interleave with the test runner's output. While tests run, the handler is
+swapped for a NullHandler. Tests that check what was logged use
+assertLogs(), which attaches its own handler and so still sees every
+record.
+"""
+import logging
+
+from django.test.runner import DiscoverRunner
+
+
+class QuietLoggingRunner(DiscoverRunner):
+    """Django's default runner, with the library logger's handlers detached."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._logger = logging.getLogger('library')
+        self._handlers = self._logger.handlers
+        self._logger.handlers = [logging.NullHandler()]
+
+    def teardown_test_environment(self, **kwargs):
+        self._logger.handlers = self._handlers
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1306 @@
-from django.test import TestCase
+import copy
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import F
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from library_project.database import database_config, sqlite_pragmas
+
+from . import benchmarks, cache, log, metrics, routing
+from .exporters import iter_books_txt
+from .forms import StudentForm
+from .importers import import_books
+from .library import Library
+from .log import JsonFormatter, QueueListenerHandler, RequestContextFilter, SamplingFilter
+from .models import Book, Student, Pupil, Loan
+from .pagination import encode_cursor
+from .purge import count_rows, purge_all
+from .rosters import import_roster
+from .search import search_books, search_ordering
+from .user_ids import PUPIL, STUDENT, classify_many, error_for
+from .snapshot import SnapshotError, iter_snapshot_rows, restore_snapshot
+
+
+def make_book(**kwargs):
+    defaults = {
+        'title': 'Test Book',
+        'author': 'Test Author',
+        'isbn': '9780000000001',
+        'year': 2020,
+        'quantity': 1,
+        'label': 'general',
+    }
+    defaults.update(kwargs)
+    return Book.objects.create(**defaults)
+
+
+def lend(user, *books):
+    """Open loans directly, without touching stock."""
+    for book in books:
+        Loan.objects.create(borrower_type=user.borrower_type, book=book, **{user.borrower_type: user})
+        Book.objects.filter(pk=book.pk).update(active_loans=F('active_loans') + 1)
+        book.active_loans += 1
+
+
+class BorrowReturnTests(TestCase):
+    def setUp(self):
+        self.book = make_book(quantity=2, label='for children')
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=8)
+
+    def test_borrow_decrements_in_place(self):
+        success, message = Library.process_borrowing(self.student, self.book)
+        self.assertTrue(success)
+        self.assertEqual(self.book.quantity, 1)
+        self.assertIn('Remaining copies: 1', message)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).quantity, 1)
+
+    def test_borrow_uses_database_stock_not_stale_instance(self):
+        Book.objects.filter(pk=self.book.pk).update(quantity=0)
+        # self.book still believes two copies are left
+        self.assertFalse(self.student.borrow_book(self.book))
+        self.assertFalse(self.student.borrowed_books.exists())
+        self.assertEqual(Book.objects.get(pk=self.book.pk).quantity, 0)
+
+    def test_return_increments_once(self):
+        self.pupil.borrow_book(self.book)
+        self.assertTrue(self.pupil.return_book(self.book))
+        self.assertFalse(self.pupil.return_book(self.book))
+        self.assertEqual(self.book.quantity, 2)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).quantity, 2)
+
+    def test_return_closes_the_loan_and_keeps_history(self):
+        self.student.borrow_book(self.book)
+        self.student.return_book(self.book)
+        loan = Loan.objects.get(student=self.student, book=self.book)
+        self.assertIsNotNone(loan.returned_at)
+        self.assertFalse(self.student.borrowed_books.exists())
+
+        # The closed loan doesn't stop the book being borrowed again
+        self.assertTrue(self.student.borrow_book(self.book))
+        self.assertEqual(self.student.loans.count(), 2)
+
+    def test_second_active_loan_of_same_book_is_rejected(self):
+        self.assertTrue(self.student.borrow_book(self.book))
+        self.assertFalse(self.student.borrow_book(self.book))
+        self.assertEqual(Book.objects.get(pk=self.book.pk).quantity, 1)
+        self.assertEqual(self.student.loans.active().count(), 1)
+
+    def test_counters_move_with_quantity(self):
+        self.student.borrow_book(self.book)
+        self.pupil.borrow_book(self.book)
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.quantity, book.active_loans, book.total_copies), (0, 2, 2))
+
+        self.pupil.return_book(self.book)
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.quantity, book.active_loans, book.total_copies), (1, 1, 2))
+
+    def test_delete_book_refused_while_on_loan(self):
+        self.student.borrow_book(self.book)
+        self.client.post(reverse('delete_book', args=[self.book.pk]))
+        self.assertTrue(Book.objects.filter(pk=self.book.pk).exists())
+
+        self.student.return_book(self.book)
+        self.client.post(reverse('delete_book', args=[self.book.pk]))
+        self.assertFalse(Book.objects.filter(pk=self.book.pk).exists())
+
+    def test_delete_book_refused_for_loan_the_counter_missed(self):
+        # Opened directly, without touching active_loans
+        Loan.objects.create(borrower_type='student', student=self.student, book=self.book)
+        self.client.post(reverse('delete_book', args=[self.book.pk]))
+        self.assertTrue(Loan.objects.active().filter(book=self.book).exists())
+
+    def test_process_return_rejects_unborrowed_book(self):
+        success, message = Library.process_return(self.student, self.book)
+        self.assertFalse(success)
+        self.assertEqual(message, "This user has not borrowed this book.")
+
+
+class ReturnAllBooksTests(TestCase):
+    def setUp(self):
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        self.books = [make_book(isbn=f'ISBN-{i}', quantity=3, label='for children') for i in range(3)]
+        self.pupils = [
+            Pupil.objects.create(user_id=f'1000{i}', name='P', surname=str(i), group='1B', age=8) for i in range(4)
+        ]
+        for pupil in self.pupils[:3]:
+            pupil.borrow_book(self.books[0])
+        self.pupils[0].borrow_book(self.books[1])
+
+    def test_returns_everything_set_based(self):
+        # Savepoint, close, aggregate, one stock UPDATE per distinct count (3 and 1),
+        # count borrowers, release
+        with self.assertNumQueries(7):
+            returned, borrowers = Library.return_all_books(Pupil.objects.all())
+        self.assertEqual((returned, borrowers), (4, 3))
+        self.assertFalse(Loan.objects.active().exists())
+        self.assertEqual(
+            list(Book.objects.order_by('isbn').values_list('quantity', 'active_loans', 'total_copies')),
+            [(3, 0, 3)] * 3,
+        )
+
+    def test_admin_action_reports_exact_totals(self):
+        response = self.client.post(reverse('admin:library_pupil_changelist'), {
+            'action': 'return_all_books',
+            '_selected_action': [self.pupils[0].pk, self.pupils[1].pk, self.pupils[3].pk],
+        }, follow=True)
+        self.assertContains(response, '3 books returned from 2 of 3 selected pupils.')
+        self.assertEqual(list(self.pupils[2].borrowed_books), [self.books[0]])
+        self.assertEqual(Book.objects.get(pk=self.books[0].pk).active_loans, 1)
+
+
+class AdminLoanInlineTests(TestCase):
+    """The user admin's loan inline must not move loans behind the stock counters."""
+
+    def setUp(self):
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        self.book = make_book(isbn='ISBN-1', quantity=2)
+        self.other = make_book(isbn='ISBN-2', quantity=2)
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.student.borrow_book(self.book)
+        self.loan = Loan.objects.get()
+        self.url = reverse('admin:library_student_change', args=[self.student.pk])
+
+    def post(self, **loan_fields):
+        data = {'user_id': '20001', 'name': 'Ann', 'surname': 'Lee', 'group': 'A1',
+                'loans-TOTAL_FORMS': '2', 'loans-INITIAL_FORMS': '1',
+                'loans-MIN_NUM_FORMS': '0', 'loans-MAX_NUM_FORMS': '1000',
+                'loans-0-id': self.loan.pk, 'loans-0-student': self.student.pk,
+                'loans-0-due_at_0': '2030-01-01', 'loans-0-due_at_1': '12:00:00',
+                'loans-0-DELETE': 'on',
+                'loans-1-student': self.student.pk, 'loans-1-book': self.other.pk,
+                'loans-1-due_at_0': '2030-01-01', 'loans-1-due_at_1': '12:00:00'}
+        data.update(loan_fields)
+        return self.client.post(self.url, data)
+
+    def counters(self):
+        return list(Book.objects.order_by('isbn').values_list('quantity', 'active_loans', 'total_copies'))
+
+    def test_inline_only_changes_the_due_date(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, reverse('edit_borrowing', args=['student', '20001', self.book.pk]))
+
+        response = self.post()
+        self.assertEqual(response.status_code, 302)
+        # Neither the extra row nor the delete went through; the counters still match the loans
+        self.assertEqual(list(Loan.objects.values_list('book', flat=True)), [self.book.pk])
+        self.assertEqual(self.counters(), [(1, 1, 2), (2, 0, 2)])
+        self.assertEqual(Loan.objects.get().due_at.year, 2030)
+
+
+class ReconcileBooksTests(TestCase):
+    def setUp(self):
+        self.book = make_book(isbn='ISBN-1', quantity=3)
+        self.other = make_book(isbn='ISBN-2', quantity=1)
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.student.borrow_book(self.book)
+        # Loans made behind the counters' back
+        Loan.objects.create(borrower_type='student', student=self.student, book=self.other)
+        Book.objects.filter(pk=self.book.pk).update(active_loans=4)
+
+    def reconcile(self, **options):
+        out = io.StringIO()
+        call_command('reconcile_books', stdout=out, **options)
+        return out.getvalue()
+
+    def counters(self):
+        return dict(Book.objects.values_list('isbn', 'active_loans'))
+
+    def test_dry_run_reports_drift_without_changing_it(self):
+        output = self.reconcile(dry_run=True)
+        self.assertIn('2 books have drifted by 4 loans in total', output)
+        self.assertEqual(self.counters(), {'ISBN-1': 4, 'ISBN-2': 0})
+
+    def test_corrects_drift_with_one_update(self):
+        with self.assertLogs('library.management.commands.reconcile_books', 'WARNING'):
+            output = self.reconcile()
+        self.assertIn('Corrected 2 books', output)
+        self.assertEqual(self.counters(), {'ISBN-1': 1, 'ISBN-2': 1})
+        self.assertEqual(Book.objects.get(isbn='ISBN-2').total_copies, 2)
+        self.assertIn('All book counters match', self.reconcile())
+
+
+class UserIdTests(TestCase):
+    def test_classify_many(self):
+        ids = ['20001', '10001', '29999', '30000', '09999', '2001', '200011', '20001\n', '２0001', None]
+        self.assertEqual(classify_many(ids), [STUDENT, PUPIL, STUDENT] + [None] * 7)
+
+    def test_errors_match_the_forms_and_models(self):
+        self.assertEqual(error_for('2x001'), "User ID must be a 5-digit number.")
+        self.assertIn("Invalid user ID range", error_for('30000'))
+        self.assertIsNone(error_for('10001', PUPIL))
+        self.assertEqual(error_for('10001', STUDENT), "Student ID must start with '2' (20000-29999).")
+
+        form = StudentForm(data={'user_id': '10001', 'name': 'A', 'surname': 'B', 'group': 'G'})
+        self.assertEqual(form.errors['user_id'], ["Student ID must start with '2' (20000-29999)."])
+        with self.assertRaises(ValidationError):
+            Pupil(user_id='20001', name='A', surname='B', group='G').clean()
+        with self.assertRaisesMessage(ValueError, "must be a 5-digit number"):
+            Library.get_user_type('1234')
+        self.assertEqual(Library.get_user_type('10001'), 'Pupil')
+
+
+class ConcurrentBorrowTests(TransactionTestCase):
+    """Many threads race for the same few copies; stock must never be oversold."""
+
+    STOCK = 5
+    BORROWERS = 40
+
+    def test_no_oversell_under_contention(self):
+        book = make_book(quantity=self.STOCK)
+        students = Student.objects.bulk_create([
+            Student(user_id=f'2{i:04d}', name='S', surname=str(i), group='G')
+            for i in range(self.BORROWERS)
+        ])
+
+        barrier = threading.Barrier(self.BORROWERS)
+        results = []
+        lock = threading.Lock()
+
+        def borrow(student):
+            # Each thread works on its own stale copy of the book
+            local_book = copy.copy(book)
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        outcome = student.borrow_book(local_book)
+                        break
+                    except OperationalError:
+                        # SQLite reports write contention instead of queuing
+                        continue
+                with lock:
+                    results.append(outcome)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=borrow, args=(s,)) for s in students]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), self.BORROWERS)
+        self.assertEqual(results.count(True), self.STOCK)
+        self.assertEqual(Book.objects.get(pk=book.pk).quantity, 0)
+        self.assertEqual(Loan.objects.active().filter(book=book).count(), self.STOCK)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_profile_is_the_default(self):
+        config = database_config({}, Path('/srv/library'))
+        self.assertEqual(config['NAME'], Path('/srv/library/db.sqlite3'))
+        self.assertEqual(config['OPTIONS'], {'transaction_mode': 'IMMEDIATE'})
+        # The journal mode sticks to the file, so it's left alone unless asked for
+        self.assertEqual(sqlite_pragmas({}), {'busy_timeout': 5000})
+        self.assertEqual(sqlite_pragmas({'LIBRARY_SQLITE_WAL': '1', 'LIBRARY_SQLITE_SYNCHRONOUS': 'FULL'}),
+                         {'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000})
+
+    def test_postgresql_profiles(self):
+        environ = {'LIBRARY_DB_ENGINE': 'postgresql', 'LIBRARY_DB_HOST': 'db', 'LIBRARY_DB_TEST_NAME': 'library_ci'}
+        persistent = database_config(environ)
+        self.assertEqual(persistent['CONN_MAX_AGE'], 60)
+        self.assertTrue(persistent['CONN_HEALTH_CHECKS'])
+        self.assertEqual(persistent['TEST'], {'NAME': 'library_ci'})
+        self.assertNotIn('OPTIONS', persistent)
+
+        pooled = database_config({**environ, 'LIBRARY_DB_POOL': 'on', 'LIBRARY_DB_POOL_MAX_SIZE': '20'})
+        # Django refuses a pool together with persistent connections
+        self.assertEqual(pooled['CONN_MAX_AGE'], 0)
+        self.assertEqual(pooled['OPTIONS'], {'pool': {'min_size': 2, 'max_size': 20, 'timeout': 10}})
+
+        with self.assertRaises(ValueError):
+            database_config({'LIBRARY_DB_ENGINE': 'oracle'})
+
+    @override_settings(LIBRARY_SQLITE_PRAGMAS=sqlite_pragmas({'LIBRARY_SQLITE_WAL': 'on'}))
+    def test_new_sqlite_connections_are_tuned(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = SQLiteDatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'wal.sqlite3')})
+            try:
+                with wrapper.cursor() as cursor:
+                    values = {}
+                    for name in ('journal_mode', 'synchronous', 'busy_timeout'):
+                        cursor.execute(f'PRAGMA {name}')
+                        values[name] = cursor.fetchone()[0]
+            finally:
+                wrapper.close()
+        # synchronous=NORMAL reads back as 1
+        self.assertEqual(values, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000})
+
+    def test_default_connections_keep_the_rollback_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'plain.sqlite3')
+            wrapper = SQLiteDatabaseWrapper({**connection.settings_dict, 'NAME': path})
+            try:
+                with wrapper.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    journal_mode = cursor.fetchone()[0]
+            finally:
+                wrapper.close()
+            self.assertEqual(journal_mode, 'delete')
+            self.assertFalse(os.path.exists(path + '-wal'))
+
+
+class ReplicaRoutingTests(TestCase):
+    """A second SQLite file stands in for the replica; it only "replicates" what a test writes to it."""
+
+    REPLICA = 'test_replica'
+
+    @classmethod
+    def setUpClass(cls):
+        # Added here, not in the class body, so the test runner doesn't try to create it
+        cls.databases = {'default', cls.REPLICA}
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.settings[cls.REPLICA] = {
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(cls.directory.name, 'replica.sqlite3'),
+        }
+        call_command('migrate', database=cls.REPLICA, verbosity=0)
+        cls.enterClassContext(override_settings(LIBRARY_REPLICA_DATABASE=cls.REPLICA))
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[cls.REPLICA].close()
+        del connections[cls.REPLICA]
+        del connections.settings[cls.REPLICA]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.book = make_book(isbn='ISBN-PRIMARY', title='Fresh')
+        Book.objects.using(self.REPLICA).create(
+            title='Stale', author='A', isbn='ISBN-REPLICA', year=2000, quantity=1, label='general'
+        )
+
+    def listed_isbns(self):
+        return [book.isbn for book in self.client.get(reverse('book_list')).context['page']]
+
+    def test_report_views_read_from_the_replica(self):
+        self.assertEqual(self.listed_isbns(), ['ISBN-REPLICA'])
+        # Streamed responses keep reading from the replica after the view returns
+        snapshot = b''.join(self.client.get(reverse('serialize_library'), {'compress': 'none'}).streaming_content)
+        self.assertIn(b'ISBN-REPLICA', snapshot)
+        self.assertNotIn(b'ISBN-PRIMARY', snapshot)
+        # Views without the annotation stay on the primary
+        self.assertContains(self.client.get(reverse('edit_book', args=[self.book.pk])), 'Fresh')
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        response = self.client.post(reverse('add_book'), {
+            'title': 'New', 'author': 'B', 'isbn': 'ISBN-NEW', 'year': 2001, 'quantity': 1, 'label': 'general',
+        })
+        self.assertEqual(response.cookies[routing.PRIMARY_COOKIE]['max-age'], routing.get_lag_seconds())
+        self.assertEqual(sorted(self.listed_isbns()), ['ISBN-NEW', 'ISBN-PRIMARY'])
+
+        self.client.cookies.pop(routing.PRIMARY_COOKIE)
+        self.assertEqual(self.listed_isbns(), ['ISBN-REPLICA'])
+
+    def test_without_a_replica_everything_uses_the_primary(self):
+        with self.settings(LIBRARY_REPLICA_DATABASE='missing'):
+            response = self.client.post(reverse('add_book'), {})
+            self.assertNotIn(routing.PRIMARY_COOKIE, response.cookies)
+            self.assertEqual(self.listed_isbns(), ['ISBN-PRIMARY'])
+
+
+class ImportBooksTests(TestCase):
+    def test_import_batches_and_rejects_bad_rows(self):
+        make_book(isbn='DUP-1')
+        lines = [
+            'Alpha,for children',
+            'Beta,Author B,1999,3,general',
+            'Gamma,Author C,DUP-1,2001,2,general',
+            'Delta,Author D,not-a-year,1,general',
+            '',
+            'Epsilon,Author E,ISBN-E,2005,4,for children',
+        ]
+        report = import_books(lines, batch_size=2)
+
+        self.assertEqual(report['accepted'], 3)
+        self.assertEqual(report['rejected'], 2)
+        self.assertEqual([b['accepted'] for b in report['batches']], [2, 1])
+        self.assertEqual(sum(b['rejected'] for b in report['batches']), 2)
+        self.assertEqual(Book.objects.get(isbn='ISBN-E').quantity, 4)
+
+    def test_generated_isbns_do_not_collide_across_imports(self):
+        import_books(['Alpha,general', 'Beta,general'])
+        import_books(['Alpha,general', 'Beta,general'])
+        self.assertEqual(Book.objects.count(), 4)
+
+
+class LoadBooksTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, lines, compress=False):
+        path = os.path.join(self.directory, name)
+        opener = gzip.open if compress else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def load(self, path, **options):
+        out = io.StringIO()
+        call_command('load_books', path, workers=0, stdout=out, stderr=io.StringIO(), **options)
+        return out.getvalue()
+
+    def test_gzipped_txt_upserts_on_isbn(self):
+        make_book(isbn='ISBN-1', quantity=1)
+        path = self.write('catalogue.txt.gz', [
+            'Alpha,for children',
+            'Beta,Author B,ISBN-1,1999,7,general',
+            'Gamma,Author C,ISBN-2,2001,2,general',
+            'Gamma again,Author C,ISBN-2,2001,3,general',
+        ], compress=True)
+
+        output = self.load(path, batch_size=2)
+        self.assertIn('Loaded 2 new books; 2 updated, 0 rejected', output)
+        self.assertEqual(Book.objects.get(isbn='ISBN-1').quantity, 7)
+        self.assertEqual(Book.objects.get(isbn='ISBN-2').title, 'Gamma again')
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+        # Placeholder ISBNs are derived from the line, so a reload adds nothing
+        self.load(path)
+        self.assertEqual(Book.objects.count(), 3)
+
+    def test_update_keeps_loaned_copies_off_the_shelf(self):
+        book = make_book(isbn='ISBN-1', quantity=3)
+        Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1').borrow_book(book)
+        path = self.write('catalogue.txt', ['Beta,Author B,ISBN-1,1999,7,general'])
+
+        self.load(path)
+        book = Book.objects.get(isbn='ISBN-1')
+        self.assertEqual((book.quantity, book.active_loans, book.total_copies), (6, 1, 7))
+
+    def test_export_round_trips_with_books_on_loan(self):
+        book = make_book(isbn='ISBN-1', quantity=1)
+        lend(Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1'), book)
+        lend(Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=9), book)
+        content = b''.join(self.client.get(reverse('export_books_txt')).streaming_content).decode('utf-8')
+        self.assertIn(',ISBN-1,2020,3,', content)
+
+        self.load(self.write('books.txt', content.splitlines()))
+        book = Book.objects.get(isbn='ISBN-1')
+        self.assertEqual((book.quantity, book.active_loans, book.total_copies), (1, 2, 3))
+
+    def test_update_below_copies_on_loan_is_rejected(self):
+        book = make_book(isbn='ISBN-1', quantity=1)
+        lend(Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1'), book)
+        lend(Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=9), book)
+        path = self.write('catalogue.txt', ['Beta,Author B,ISBN-1,1999,1,general', 'Gamma,C,ISBN-2,2001,2,general'])
+
+        output = self.load(path)
+        self.assertIn('Loaded 1 new books; 0 updated, 1 rejected', output)
+        book = Book.objects.get(isbn='ISBN-1')
+        self.assertEqual((book.title, book.quantity, book.total_copies), ('Test Book', 1, 3))
+
+    def test_jsonl_rejects_bad_lines_and_dry_run_writes_nothing(self):
+        path = self.write('catalogue.jsonl', [
+            json.dumps({'title': 'Alpha', 'isbn': 'J-1', 'label': 'general'}),
+            '{not json',
+            json.dumps({'title': 'Beta', 'isbn': 'J-2', 'year': 'soon'}),
+        ])
+
+        output = self.load(path, dry_run=True)
+        self.assertIn('Would load 1 new books; 0 updated, 2 rejected', output)
+        self.assertFalse(Book.objects.exists())
+
+        self.load(path)
+        book = Book.objects.get()
+        self.assertEqual((book.isbn, book.author, book.quantity), ('J-1', 'Imported Author', 1))
+
+    def test_resume_continues_after_checkpoint(self):
+        path = self.write('catalogue.csv', [
+            'title,author,isbn,year,quantity,label',
+            'Alpha,A,C-1,2001,1,general',
+            'Beta,B,C-2,2002,1,general',
+            'Gamma,C,C-3,2003,1,general',
+        ])
+        totals = {'line': 3, 'inserted': 2, 'updated': 0, 'skipped': 0, 'rejected': 0}
+        with open(path + '.checkpoint', 'w', encoding='utf-8') as f:
+            json.dump({'source': {'path': os.path.abspath(path), 'size': os.path.getsize(path)},
+                       'totals': totals}, f)
+
+        output = self.load(path, resume=True)
+        self.assertIn('Loaded 3 new books', output)
+        self.assertEqual(list(Book.objects.values_list('isbn', flat=True)), ['C-3'])
+
+    def test_worker_pool_parses_in_order(self):
+        path = self.write('catalogue.txt', [f'Book {i},Author,P-{i},2000,1,general' for i in range(50)])
+        call_command('load_books', path, workers=2, batch_size=10, stdout=io.StringIO())
+        self.assertEqual(Book.objects.count(), 50)
+
+
+class RosterImportTests(TestCase):
+    def test_upload_validates_ids_and_reports_rows(self):
+        Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        roster = '\n'.join([
+            'user_id,name,surname,group,age,type',
+            '20002,Cat,Kim,A1,,',
+            '10001,Bob,Ray,1B,9,pupil',
+            '10002,Dan,Fox,1B,,',
+            '20001,Ann,Lee,A1,,',
+            '10002,Dan,Again,1B,,',
+            '30000,Eve,Out,X,,',
+            '20003,Fay,Mix,A1,,pupil',
+            '20004,,NoName,A1,,',
+            '1000x,Gus,Bad,1B,,',
+        ]).encode('utf-8')
+        upload = SimpleUploadedFile('roster.csv', roster, content_type='text/csv')
+        response = self.client.post(reverse('import_roster'), {'roster_file': upload})
+
+        report = response.context['report']
+        self.assertEqual((report['students'], report['pupils'], report['rejected']), (1, 2, 6))
+        self.assertEqual([error['line'] for error in report['errors']], [5, 6, 7, 8, 9, 10])
+        self.assertEqual(report['errors'][0]['error'], "user ID 20001 already exists")
+        self.assertEqual(report['errors'][1]['error'], "user ID 10002 appears earlier in the file")
+        self.assertEqual(report['errors'][3]['error'], "Pupil ID must start with '1' (10000-19999).")
+        self.assertEqual(Pupil.objects.get(user_id='10001').age, 9)
+        self.assertEqual(Pupil.objects.get(user_id='10002').age, 7)
+
+    def test_batches_use_one_lookup_query_for_both_tables(self):
+        lines = [json.dumps({'user_id': f'{1 + i % 2}{i:04d}', 'name': 'N', 'surname': 'S', 'group': 'G'})
+                 for i in range(20)]
+        # Savepoint, then per batch one existence query and one insert per table, then release
+        with self.assertNumQueries(2 + 2 * 3):
+            report = import_roster(lines, 'jsonl', batch_size=10)
+        self.assertEqual((report['students'], report['pupils']), (10, 10))
+
+    def test_upload_reads_gzipped_jsonl(self):
+        roster = json.dumps({'user_id': '10001', 'name': 'Bob', 'surname': 'Ray', 'group': '1B'}) + '\n'
+        upload = SimpleUploadedFile('roster.jsonl.gz', gzip.compress(roster.encode('utf-8')))
+        response = self.client.post(reverse('import_roster'), {'roster_file': upload})
+        self.assertEqual(response.context['report']['pupils'], 1)
+        self.assertTrue(Pupil.objects.filter(user_id='10001').exists())
+
+        upload = SimpleUploadedFile('roster.csv.gz', gzip.compress(b'user_id,name\n')[:-4])
+        response = self.client.post(reverse('import_roster'), {'roster_file': upload})
+        self.assertContains(response, "The roster file is not a valid gzip file.")
+
+    def test_command_reads_gzipped_jsonl(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'roster.jsonl.gz')
+            with gzip.open(path, 'wt', encoding='utf-8') as f:
+                f.write(json.dumps({'user_id': '10001', 'name': 'Bob', 'surname': 'Ray', 'group': '1B'}) + '\n')
+                f.write('not json\n')
+            out = io.StringIO()
+            call_command('import_roster', path, stdout=out, stderr=io.StringIO())
+        self.assertIn('Imported 0 students and 1 pupils; 1 rejected', out.getvalue())
+        self.assertTrue(Pupil.objects.filter(user_id='10001').exists())
+
+
+class ExportBooksTests(TestCase):
+    def test_export_streams_and_round_trips_through_import(self):
+        make_book(title='War, and Peace', author='Tolstoy', isbn='ISBN-1', year=1869, quantity=3)
+        make_book(title='Matilda', author='Dahl', isbn='ISBN-2', year=1988, quantity=1, label='for children')
+
+        response = self.client.get(reverse('export_books_txt'))
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('"War, and Peace",Tolstoy,ISBN-1,1869,3,general', content)
+
+        Book.objects.all().delete()
+        report = import_books(content.splitlines())
+        self.assertEqual(report['accepted'], 2)
+        book = Book.objects.get(isbn='ISBN-1')
+        self.assertEqual((book.title, book.year, book.quantity), ('War, and Peace', 1869, 3))
+        self.assertEqual(Book.objects.get(isbn='ISBN-2').label, 'for children')
+
+    def test_export_chunks_rows(self):
+        for i in range(5):
+            make_book(isbn=f'ISBN-{i}')
+        chunks = list(iter_books_txt(chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.book = make_book(isbn='ISBN-1', quantity=2, label='for children')
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=9)
+        lend(self.student, self.book)
+        lend(self.pupil, self.book)
+
+    def snapshot(self, **params):
+        response = self.client.get(reverse('serialize_library'), params)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_snapshot_includes_borrowings(self):
+        rows = list(iter_snapshot_rows(io.BytesIO(self.snapshot())))
+        loans = [(row['borrower_type'], row['user_id'], row['isbn'], row['returned_at'])
+                 for table, row in rows if table == 'loans']
+        self.assertEqual(sorted(loans), [('pupil', '10001', 'ISBN-1', None), ('student', '20001', 'ISBN-1', None)])
+        self.assertIn(('pupils', {'user_id': '10001', 'name': 'Bob', 'surname': 'Ray', 'group': '1B', 'age': 9}), rows)
+
+    def test_plain_and_gzip_snapshots_read_the_same(self):
+        plain = self.snapshot(compress='none')
+        self.assertTrue(plain.startswith(b'{"format":"library-snapshot","version":3}'))
+        self.assertEqual(
+            list(iter_snapshot_rows(io.BytesIO(plain))),
+            list(iter_snapshot_rows(io.BytesIO(self.snapshot())))
+        )
+
+    def test_version_1_snapshot_restores_as_open_loans(self):
+        Loan.objects.all().delete()
+        legacy = (
+            b'{"format":"library-snapshot","version":1}\n'
+            b'{"table":"student_books","columns":["user_id","isbn"]}\n'
+            b'["20001","ISBN-1"]\n'
+            b'{"end":true,"counts":{"student_books":1}}\n'
+        )
+        counts, missing = restore_snapshot(io.BytesIO(legacy))
+        self.assertEqual((counts['loans'], missing), (1, 0))
+        self.assertEqual(list(self.student.borrowed_books), [self.book])
+
+    def test_version_2_snapshot_restores_one_row_per_line(self):
+        Loan.objects.all().delete()
+        unbatched = (
+            b'{"format":"library-snapshot","version":2}\n'
+            b'{"table":"loans","columns":["borrower_type","user_id","isbn","borrowed_at","due_at","returned_at"]}\n'
+            b'["student","20001","ISBN-1","2025-04-01T10:00:00+00:00","2025-04-15T10:00:00+00:00",null]\n'
+            b'["pupil","10001","ISBN-1","2025-04-02T10:00:00+00:00","2025-04-16T10:00:00+00:00",null]\n'
+            b'{"end":true,"counts":{"loans":2}}\n'
+        )
+        counts, missing = restore_snapshot(io.BytesIO(unbatched))
+        self.assertEqual((counts['loans'], missing), (2, 0))
+        self.assertEqual(Loan.objects.get(student=self.student).borrowed_at,
+                         datetime.datetime(2025, 4, 1, 10, tzinfo=datetime.timezone.utc))
+
+    def test_restore_keeps_loan_dates(self):
+        Loan.objects.update(due_at=datetime.datetime(2025, 4, 15, 10, 30, 0, 123456, tzinfo=datetime.timezone.utc))
+        dates = set(Loan.objects.values_list('borrowed_at', 'due_at'))
+        data = self.snapshot()
+        Loan.objects.all().delete()
+        restore_snapshot(io.BytesIO(data))
+        self.assertEqual(set(Loan.objects.values_list('borrowed_at', 'due_at')), dates)
+
+    def test_truncated_snapshot_is_rejected(self):
+        plain = self.snapshot(compress='none')
+        truncated = plain[:plain.rindex(b'{"end"')]
+        with self.assertRaises(SnapshotError):
+            list(iter_snapshot_rows(io.BytesIO(truncated)))
+
+    def test_deserialize_restores_snapshot(self):
+        data = self.snapshot()
+        Book.objects.all().delete()
+        Student.objects.all().delete()
+        Pupil.objects.all().delete()
+
+        upload = SimpleUploadedFile('library.jsonl.gz', data)
+        self.client.post(reverse('deserialize_library'), {'library_file': upload})
+
+        student = Student.objects.get(user_id='20001')
+        self.assertEqual(list(student.borrowed_books.values_list('isbn', flat=True)), ['ISBN-1'])
+        self.assertEqual(Pupil.objects.get(user_id='10001').borrowed_books.count(), 1)
+        self.assertEqual(Book.objects.get(isbn='ISBN-1').quantity, 2)
+
+    def test_restore_upserts_and_replaces_borrowings_in_bounded_queries(self):
+        data = self.snapshot()
+        other = make_book(isbn='ISBN-2')
+        Book.objects.filter(isbn='ISBN-1').update(title='Renamed', quantity=9)
+        Loan.objects.all().delete()
+        lend(self.student, other)
+
+        # Savepoint, three upserts, the key maps, stale-borrowing deletes and link inserts
+        with self.assertNumQueries(12):
+            counts, missing = restore_snapshot(io.BytesIO(data))
+
+        self.assertEqual(missing, 0)
+        self.assertEqual(counts['loans'], 2)
+        book = Book.objects.get(isbn='ISBN-1')
+        self.assertEqual((book.title, book.quantity), ('Test Book', 2))
+        self.assertEqual(list(self.student.borrowed_books.all()), [book])
+        self.assertEqual(list(self.pupil.borrowed_books.all()), [book])
+
+
+class PurgeTests(TestCase):
+    def setUp(self):
+        self.books = [make_book(isbn=f'ISBN-{i}', title=f'Dragon {i}') for i in range(3)]
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=9)
+        lend(self.student, *self.books)
+        lend(self.pupil, self.books[0])
+
+    def test_deletes_everything_in_bounded_chunks(self):
+        progress = []
+        # Savepoint, counts, per table one SELECT and DELETE per chunk plus an empty SELECT, release
+        with self.assertNumQueries(1 + 1 + (2 * 2 + 1) + (2 * 2 + 1) + 3 + 3 + 1):
+            counts = purge_all(chunk_size=2, progress=lambda *args: progress.append(args))
+        self.assertEqual(counts, {'loans': 4, 'books': 3, 'students': 1, 'pupils': 1})
+        self.assertEqual(progress, [
+            ('loans', 2, 4), ('loans', 4, 4), ('books', 2, 3), ('books', 3, 3),
+            ('students', 1, 1), ('pupils', 1, 1),
+        ])
+        self.assertEqual(count_rows(), {'loans': 0, 'books': 0, 'students': 0, 'pupils': 0})
+        # The search index is kept in step by the database, not by signals
+        self.assertFalse(search_books(Book.objects.all(), 'dragon').exists())
+
+    def test_failure_part_way_deletes_nothing(self):
+        def fail(table, deleted, total):
+            if table == 'books':
+                raise RuntimeError('interrupted')
+
+        with self.assertRaises(RuntimeError):
+            purge_all(chunk_size=2, progress=fail)
+        self.assertEqual(count_rows(), {'loans': 4, 'books': 3, 'students': 1, 'pupils': 1})
+
+    def test_confirmation_page_counts_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('drop_all_data'))
+        self.assertEqual(len([q for q in queries if 'COUNT' in q['sql']]), 1)
+        self.assertContains(response, 'All borrowing records (4 records)')
+
+    def test_view_clears_data_and_invalidates_caches(self):
+        caches['default'].clear()
+        self.assertIsNotNone(cache.get_book(self.books[0].pk))
+        with self.assertLogs('library.views', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('drop_all_data'), follow=True)
+        self.assertContains(response, '3 books, 1 students, 1 pupils and 4 borrowing records')
+        self.assertFalse(Book.objects.exists())
+        self.assertIsNone(cache.get_book(self.books[0].pk))
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('drop_all_data', interactive=False, chunk_size=3, stdout=out)
+        self.assertIn('Deleted 3 books, 1 students, 1 pupils and 4 loans.', out.getvalue())
+        self.assertFalse(Loan.objects.exists())
+
+
+class BorrowedBooksViewTests(TestCase):
+    def setUp(self):
+        self.books = [make_book(isbn=f'ISBN-{i}', title=f'Book {i}', quantity=5, label='for children') for i in range(3)]
+        for i in range(4):
+            student = Student.objects.create(user_id=f'2000{i}', name=f'Student{i}', surname='S', group='G')
+            lend(student, *self.books)
+            pupil = Pupil.objects.create(user_id=f'1000{i}', name=f'Pupil{i}', surname='P', group='G', age=8)
+            lend(pupil, self.books[0])
+
+    def test_report_is_sorted_and_paginated_in_the_database(self):
+        with self.settings(LIBRARY_BORROWINGS_PER_PAGE=5):
+            response = self.client.get(reverse('borrowed_books'))
+        borrowings = list(response.context['borrowings'])
+        self.assertEqual(len(borrowings), 5)
+        self.assertEqual(response.context['total_borrowings'], 16)
+        self.assertEqual(response.context['unique_borrowers'], 8)
+        self.assertEqual(borrowings[0]['user_name'], 'Pupil0 P')
+        self.assertEqual(borrowings[0]['book_label'], 'For Children')
+
+    def test_query_count_does_not_grow_with_borrowings(self):
+        # Page query, page count and the two unique-borrower counts
+        with self.assertNumQueries(3):
+            self.client.get(reverse('borrowed_books'))
+
+    def test_book_filter(self):
+        response = self.client.get(reverse('borrowed_books'), {'book_id': self.books[1].id})
+        self.assertEqual(response.context['total_borrowings'], 4)
+        self.assertTrue(all(b['user_type'] == 'student' for b in response.context['borrowings']))
+
+    def test_invalid_book_filter_is_ignored(self):
+        for book_id in ('99999999999999999999999', '-1', 'abc'):
+            with self.subTest(book_id=book_id):
+                response = self.client.get(reverse('borrowed_books'), {'book_id': book_id})
+                self.assertEqual(response.status_code, 200)
+                self.assertIsNone(response.context['book'])
+                self.assertEqual(response.context['total_borrowings'], 16)
+
+
+class BorrowerCountQueryTests(TestCase):
+    def setUp(self):
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+
+    def add_rows(self, count, offset):
+        for i in range(offset, offset + count):
+            book = make_book(isbn=f'ISBN-{i}', label='for children')
+            lend(Student.objects.create(user_id=f'2{i:04d}', name='S', surname=str(i), group='G'), book)
+            lend(Pupil.objects.create(user_id=f'1{i:04d}', name='P', surname=str(i), group='G', age=8), book)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assert_constant_queries(self, url):
+        self.add_rows(2, 0)
+        small = self.count_queries(url)
+        self.add_rows(20, 2)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_user_list(self):
+        self.assert_constant_queries(reverse('user_list'))
+
+    def test_book_changelist(self):
+        self.assert_constant_queries(reverse('admin:library_book_changelist'))
+
+    def test_student_changelist(self):
+        self.assert_constant_queries(reverse('admin:library_student_changelist'))
+
+    def test_pupil_changelist(self):
+        self.assert_constant_queries(reverse('admin:library_pupil_changelist'))
+
+    def test_annotated_counts(self):
+        self.add_rows(1, 0)
+        book = Book.objects.with_borrower_counts().get()
+        self.assertEqual((book.student_count, book.pupil_count), (1, 1))
+        self.assertEqual(Student.objects.with_borrowed_count().get().borrowed_count, 1)
+
+
+class AsyncCatalogueViewTests(TestCase):
+    """The read-only catalogue views run natively under ASGI."""
+
+    def setUp(self):
+        self.book = make_book(isbn='ISBN-1', quantity=2, label='for children')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=8)
+        lend(self.pupil, self.book)
+
+    async def test_views_render_without_sync_database_access(self):
+        # Any lazy query left for the template would raise SynchronousOnlyOperation here
+        response = await self.async_client.get(reverse('book_list'), {'q': 'test'})
+        self.assertContains(response, 'Test Book')
+
+        response = await self.async_client.get(reverse('user_books', args=['pupil', '10001']))
+        self.assertContains(response, 'Test Book')
+
+        response = await self.async_client.get(reverse('borrowed_books'), {'book_id': self.book.id})
+        self.assertEqual(response.context['unique_borrowers'], 1)
+        self.assertEqual(len(response.context['borrowings']), 1)
+
+        response = await self.async_client.post(reverse('check_user_type'), {'user_id': '20001'})
+        self.assertContains(response, 'ID 20001 belongs to a Student.')
+
+    async def test_unknown_user_is_404(self):
+        response = await self.async_client.get(reverse('user_books', args=['student', '29999']))
+        self.assertEqual(response.status_code, 404)
+
+
+class EditBorrowingViewTests(TestCase):
+    def setUp(self):
+        self.current = make_book(isbn='ISBN-0', title='Current', label='for children')
+        self.held = make_book(isbn='ISBN-1', title='Held', label='for children')
+        make_book(isbn='ISBN-2', title='Grown-up', label='general')
+        make_book(isbn='ISBN-3', title='Gone', label='for children', quantity=0)
+        self.choice = make_book(isbn='ISBN-4', title='Dragon tales', label='for children')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=8)
+        self.pupil.borrow_book(self.current)
+        self.pupil.borrow_book(self.held)
+        self.url = reverse('edit_borrowing', args=['pupil', '10001', self.current.pk])
+
+    def picker(self, response):
+        return [book.isbn for book in response.context['available_books']]
+
+    def test_picker_is_limited_to_eligible_books_in_bounded_queries(self):
+        response = self.client.get(self.url)
+        self.assertEqual(self.picker(response), ['ISBN-4'])
+
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url)
+        for i in range(5, 40):
+            make_book(isbn=f'ISBN-{i}', title=f'Book {i}', label='for children')
+        with CaptureQueriesContext(connection) as large, self.settings(LIBRARY_PICKER_PER_PAGE=10):
+            response = self.client.get(self.url)
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(len(self.picker(response)), 10)
+        self.assertTrue(response.context['page'].has_next)
+
+    def test_picker_search(self):
+        make_book(isbn='ISBN-5', title='Pirate tales', label='for children')
+        response = self.client.get(self.url, {'q': 'drag'})
+        self.assertEqual(self.picker(response), ['ISBN-4'])
+
+    def test_swap(self):
+        response = self.client.post(self.url, {'new_book_id': self.choice.pk})
+        self.assertRedirects(response, reverse('user_books', args=['pupil', '10001']))
+        self.assertEqual(set(self.pupil.borrowed_books), {self.held, self.choice})
+
+    def test_book_not_on_loan_or_unknown_user(self):
+        response = self.client.get(reverse('edit_borrowing', args=['pupil', '10001', self.choice.pk]))
+        self.assertRedirects(response, reverse('user_books', args=['pupil', '10001']), fetch_redirect_response=False)
+        response = self.client.get(reverse('edit_borrowing', args=['pupil', '19999', self.current.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+class BookListViewTests(TestCase):
+    def setUp(self):
+        for i in range(7):
+            make_book(isbn=f'ISBN-{i}', title=f'Book {i % 3}', author=f'Author {i}', year=2000 + i,
+                      label='for children' if i % 2 else 'general')
+
+    def collect(self, params, per_page=3):
+        seen = []
+        cursor = None
+        with self.settings(LIBRARY_BOOKS_PER_PAGE=per_page):
+            while True:
+                query = dict(params, cursor=cursor) if cursor else params
+                response = self.client.get(reverse('book_list'), query)
+                page = response.context['page']
+                seen.extend(book.isbn for book in page)
+                if not page.has_next:
+                    return seen
+                cursor = page.next_cursor
+
+    def test_keyset_pages_cover_every_row_once_with_duplicate_sort_keys(self):
+        expected = list(Book.objects.order_by('title', 'pk').values_list('isbn', flat=True))
+        self.assertEqual(self.collect({}), expected)
+
+    def test_descending_sort(self):
+        expected = list(Book.objects.order_by('-year').values_list('isbn', flat=True))
+        self.assertEqual(self.collect({'sort': '-year'}), expected)
+
+    def test_filters(self):
+        isbns = self.collect({'label': 'for children', 'year_min': 2002, 'year_max': 2005})
+        self.assertEqual(sorted(isbns), ['ISBN-3', 'ISBN-5'])
+        self.assertEqual(self.collect({'author': 'Author 4'}), ['ISBN-4'])
+
+    def test_bad_cursor_starts_from_first_page(self):
+        response = self.client.get(reverse('book_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['page']), 7)
+
+    def test_cursor_of_the_wrong_types_starts_from_first_page(self):
+        crafted = [['abc', 1], [2001, 'x'], [None, 1], [2 ** 70, 1], [2001, 2 ** 70], [True, 1]]
+        for values in crafted:
+            with self.subTest(values=values):
+                response = self.client.get(reverse('book_list'), {'sort': 'year', 'cursor': encode_cursor(values)})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.context['page']), 7)
+        # A well-typed cursor still pages
+        response = self.client.get(reverse('book_list'), {'sort': 'year', 'cursor': encode_cursor([2003, 4])})
+        self.assertEqual(len(response.context['page']), 3)
+
+
+class BookSearchTests(TestCase):
+    def setUp(self):
+        make_book(isbn='ISBN-1', title='Harry Potter and the Stone', author='Rowling')
+        make_book(isbn='ISBN-2', title='The Hobbit', author='Tolkien')
+        make_book(isbn='ISBN-3', title='Potted Plants', author='Harriet Green')
+
+    def search(self, query):
+        return list(search_books(Book.objects.all(), query).order_by(search_ordering(), 'pk')
+                    .values_list('isbn', flat=True))
+
+    def test_prefix_terms_are_anded(self):
+        self.assertEqual(sorted(self.search('har pot')), ['ISBN-1', 'ISBN-3'])
+        self.assertEqual(self.search('hobb'), ['ISBN-2'])
+        self.assertEqual(self.search('   '), [])
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        Book.objects.bulk_create([Book(title='Dune', author='Herbert', isbn='ISBN-4', year=1965, quantity=1)])
+        self.assertEqual(self.search('dune'), ['ISBN-4'])
+        Book.objects.filter(isbn='ISBN-4').update(title='Children of Dune')
+        self.assertEqual(self.search('children'), ['ISBN-4'])
+        Book.objects.filter(isbn='ISBN-4').delete()
+        self.assertEqual(self.search('dune'), [])
+
+    def test_match_runs_once_and_drives_the_join(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("FTS5 query plan")
+        plan = search_books(Book.objects.all(), 'har pot').order_by(search_ordering(), 'pk')[:10].explain()
+        # The index is scanned once and books are fetched by rowid, with no per-row subquery
+        self.assertEqual(plan.count('VIRTUAL TABLE'), 1, plan)
+        self.assertIn('USING INTEGER PRIMARY KEY', plan)
+        self.assertNotIn('SUBQUERY', plan)
+
+    def test_book_list_and_admin_search(self):
+        response = self.client.get(reverse('book_list'), {'q': 'tolk'})
+        self.assertEqual([book.isbn for book in response.context['page']], ['ISBN-2'])
+
+        # Relevance-ordered results page through the rank cursor
+        with self.settings(LIBRARY_BOOKS_PER_PAGE=1):
+            first = self.client.get(reverse('book_list'), {'q': 'har'}).context['page']
+            second = self.client.get(reverse('book_list'), {'q': 'har', 'cursor': first.next_cursor}).context['page']
+        self.assertEqual([b.isbn for b in first] + [b.isbn for b in second], self.search('har'))
+        self.assertFalse(second.has_next)
+
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:library_book_changelist'), {'q': 'rowl'})
+        self.assertEqual([book.isbn for book in response.context['cl'].result_list], ['ISBN-1'])
+
+
+class LookupCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        cache.reset_stats()
+        self.book = make_book(isbn='ISBN-1', quantity=2, label='for children')
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+
+    def test_read_through_hits_and_misses(self):
+        with self.assertNumQueries(1):
+            cache.get_book(self.book.id)
+            cache.get_book(self.book.id)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertIsNone(cache.get_user(Pupil, '10001'))
+
+    def test_save_invalidates_on_commit(self):
+        cache.get_book(self.book.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.filter(pk=self.book.pk).update(title='Changed')
+            book = Book.objects.get(pk=self.book.pk)
+            book.save()
+        self.assertEqual(cache.get_book(self.book.id).title, 'Changed')
+
+    def test_borrow_and_return_invalidate_stock(self):
+        self.assertEqual(cache.get_book(self.book.id).quantity, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.borrow_book(self.book)
+            Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=9).borrow_book(self.book)
+        self.assertEqual(cache.get_book(self.book.id).quantity, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.return_book(self.book)
+        self.assertEqual(cache.get_book(self.book.id).quantity, 1)
+
+    def test_borrow_keeps_other_books_cached(self):
+        other = make_book(isbn='ISBN-2', quantity=1)
+        cache.get_book(other.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.borrow_book(self.book)
+        with self.assertNumQueries(0):
+            cache.get_book(other.id)
+
+    def test_counts_are_exported(self):
+        cache.get_book(self.book.id)
+        cache.get_book(self.book.id)
+        text = self.client.get(reverse('prometheus_metrics')).content.decode()
+        self.assertIn('library_cache_hits_total 1\n', text)
+        self.assertIn('library_cache_misses_total 1\n', text)
+
+    def test_rolled_back_change_does_not_invalidate(self):
+        cache.get_user(Student, '20001')
+        try:
+            with transaction.atomic():
+                Student.objects.filter(user_id='20001').update(name='Zed')
+                Student.objects.get(user_id='20001').save()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_user(Student, '20001').name, 'Ann')
+
+    def test_borrow_view_uses_cache(self):
+        data = {'user_type': 'student', 'user_id': '20001', 'book_id': self.book.id}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('borrow_book'), data)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).quantity, 1)
+        self.assertEqual(cache.get_book(self.book.id).quantity, 1)
+
+
+class CheckoutBatchTests(TestCase):
+    def setUp(self):
+        self.book = make_book(isbn='ISBN-1', quantity=1, label='for children')
+        self.general = make_book(isbn='ISBN-2', quantity=5, label='general')
+        self.student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        self.pupil = Pupil.objects.create(user_id='10001', name='Bob', surname='Ray', group='1B', age=8)
+
+    def post(self, items):
+        return self.client.post(
+            reverse('checkout_batch'), json.dumps({'items': items}), content_type='application/json'
+        )
+
+    def test_items_are_applied_in_order_with_per_item_results(self):
+        response = self.post([
+            {'action': 'borrow', 'user_id': '20001', 'book_id': self.book.id},
+            {'action': 'borrow', 'user_id': '10001', 'book_id': self.book.id},
+            {'action': 'return', 'user_id': '20001', 'book_id': self.book.id},
+            {'action': 'borrow', 'user_id': '10001', 'book_id': self.book.id},
+            {'action': 'borrow', 'user_id': '10001', 'book_id': self.general.id},
+            {'action': 'borrow', 'user_id': '20001', 'book_id': 999},
+            {'action': 'lend', 'user_id': '20001', 'book_id': self.book.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual([r['ok'] for r in report['results']], [True, False, True, True, False, False, False])
+        self.assertEqual(report['results'][1]['error'], "This book is not available.")
+        self.assertEqual(report['results'][3]['quantity'], 0)
+        self.assertEqual((report['borrowed'], report['returned'], report['failed']), (2, 1, 4))
+
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.quantity, book.active_loans, book.total_copies), (0, 1, 1))
+        self.assertEqual(list(self.pupil.borrowed_books), [self.book])
+        self.assertIsNotNone(Loan.objects.get(student=self.student).returned_at)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        books = [make_book(isbn=f'ISBN-X{i}', quantity=3) for i in range(30)]
+        Student.objects.bulk_create([
+            Student(user_id=f'2{i:04d}', name='S', surname=str(i), group='G') for i in range(2, 32)
+        ])
+        lend(self.student, *books[:10])
+        items = [{'action': 'return', 'user_id': '20001', 'book_id': b.id} for b in books[:10]]
+        items += [{'action': 'borrow', 'user_id': f'2{i + 2:04d}', 'book_id': b.id} for i, b in enumerate(books)]
+
+        # Savepoint, students, books, open loans, insert, close, stock, release
+        with self.assertNumQueries(8):
+            report = self.post(items).json()
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(Book.objects.get(pk=books[0].pk).quantity, 3)
+        self.assertEqual(Book.objects.get(pk=books[-1].pk).quantity, 2)
+
+    def test_returns_and_reborrows_an_existing_loan(self):
+        self.student.borrow_book(self.general)
+        response = self.post([
+            {'action': 'return', 'user_id': '20001', 'book_id': self.general.id},
+            {'action': 'borrow', 'user_id': '20001', 'book_id': self.general.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['failed'], 0)
+        loans = Loan.objects.filter(student=self.student, book=self.general)
+        self.assertEqual((loans.count(), loans.active().count()), (2, 1))
+        book = Book.objects.get(pk=self.general.pk)
+        self.assertEqual((book.quantity, book.active_loans), (4, 1))
+
+    def test_malformed_batches_are_rejected(self):
+        bad_json = self.client.post(reverse('checkout_batch'), 'not json', content_type='application/json')
+        self.assertEqual(bad_json.status_code, 400)
+        self.assertEqual(self.post('nope').status_code, 400)
+        with self.settings(LIBRARY_CHECKOUT_MAX_ITEMS=1):
+            self.assertEqual(self.post([{}, {}]).status_code, 400)
+        self.assertEqual(self.client.get(reverse('checkout_batch')).status_code, 405)
+
+    def test_desk_client_posts_with_a_csrf_token(self):
+        desk = Client(enforce_csrf_checks=True)
+        body = json.dumps({'items': [{'action': 'borrow', 'user_id': '20001', 'book_id': self.book.id}]})
+        url = reverse('checkout_batch')
+        self.assertEqual(desk.post(url, body, content_type='application/json').status_code, 403)
+
+        token = desk.get(reverse('checkout_csrf_token')).json()['csrf_token']
+        response = desk.post(url, body, content_type='application/json', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['borrowed'], 1)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        make_book(isbn='ISBN-1')
+
+    def test_records_queries_and_size_per_url_name(self):
+        response = self.client.get(reverse('book_list'))
+        stats = metrics.snapshot()['book_list']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['queries'], 1)
+        self.assertEqual(stats['response_bytes'], len(response.content))
+
+        text = self.client.get(reverse('prometheus_metrics')).content.decode()
+        self.assertIn('library_requests_total{view="book_list"} 1', text)
+        self.assertIn('library_db_queries_total{view="book_list"} 1', text)
+        self.assertIn('library_request_duration_seconds_bucket{view="book_list",le="+Inf"} 1', text)
+
+    def test_streamed_responses_are_recorded_when_consumed(self):
+        response = self.client.get(reverse('export_books_txt'))
+        self.assertNotIn('export_books_txt', metrics.snapshot())
+        body = b''.join(response.streaming_content)
+        stats = metrics.snapshot()['export_books_txt']
+        self.assertEqual(stats['response_bytes'], len(body))
+        self.assertGreaterEqual(stats['queries'], 1)
+
+    def test_query_budget_warning(self):
+        with self.settings(LIBRARY_QUERY_BUDGETS={'book_list': 0}):
+            with self.assertLogs('library.metrics', 'WARNING') as logs:
+                self.client.get(reverse('book_list'))
+        self.assertIn('book_list ran 1 SQL queries (budget 0)', logs.output[0])
+        self.assertEqual(metrics.snapshot()['book_list']['over_budget'], 1)
+
+    def test_endpoint_is_local_only(self):
+        response = self.client.get(reverse('prometheus_metrics'), REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(response.status_code, 404)
+
+
+class StructuredLoggingTests(TestCase):
+    def make_record(self, level=logging.INFO, **extra):
+        record = logging.makeLogRecord({'name': 'library.models', 'levelno': level,
+                                        'levelname': logging.getLevelName(level), 'msg': 'Loan %s', 'args': ('opened',)})
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_lines_carry_request_and_ids_through_the_queue(self):
+        stream = io.StringIO()
+        handler = QueueListenerHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(RequestContextFilter())
+        token = log.request_id.set('abc123')
+        try:
+            handler.handle(self.make_record(user_id='20001', book_id=7))
+        finally:
+            log.request_id.reset(token)
+            handler.close()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['message'], 'Loan opened')
+        self.assertEqual(entry['logger'], 'library.models')
+        self.assertEqual((entry['request_id'], entry['user_id'], entry['book_id']), ('abc123', '20001', 7))
+
+    def test_sampling_drops_only_sampled_info_events(self):
+        sampler = SamplingFilter({'loan.opened': 0.0})
+        self.assertFalse(sampler.filter(self.make_record(event='loan.opened')))
+        self.assertTrue(sampler.filter(self.make_record(logging.WARNING, event='loan.opened')))
+        self.assertTrue(sampler.filter(self.make_record(event='loan.closed')))
+
+    def test_request_id_header(self):
+        response = self.client.get(reverse('home'), HTTP_X_REQUEST_ID='desk-7.42')
+        self.assertEqual(response['X-Request-ID'], 'desk-7.42')
+        response = self.client.get(reverse('home'), HTTP_X_REQUEST_ID='bad id\n')
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    def test_borrow_logs_an_event(self):
+        book = make_book()
+        student = Student.objects.create(user_id='20001', name='Ann', surname='Lee', group='A1')
+        with self.assertLogs('library.models', 'INFO') as logs:
+            student.borrow_book(book)
+        self.assertEqual(logs.records[0].event, 'loan.opened')
+        self.assertEqual(logs.records[0].book_id, book.pk)
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_seeding_is_reproducible(self):
+        first = benchmarks.seed_library(40, seed=7)
+        titles = list(Book.objects.order_by('isbn').values_list('title', flat=True))
+        Loan.objects.all().delete()
+        Book.objects.all().delete()
+        Student.objects.all().delete()
+        Pupil.objects.all().delete()
+        self.assertEqual(benchmarks.seed_library(40, seed=7), first)
+        self.assertEqual(list(Book.objects.order_by('isbn').values_list('title', flat=True)), titles)
+        self.assertEqual((first['students'], first['pupils'], first['loans']), (28, 12, 4))
+
+    def test_cases_report_and_roll_back(self):
+        benchmarks.seed_library(40)
+        loans = Loan.objects.count()
+        results = benchmarks.run_benchmarks(
+            ['borrow_return', 'import_books_txt', 'serialize_library'], repeat=1, operations=10, memory=False
+        )
+        self.assertEqual([r['name'] for r in results], ['borrow_return', 'import_books_txt', 'serialize_library'])
+        self.assertTrue(all(r['ops'] > 0 and r['queries'] > 0 for r in results))
+        self.assertEqual(Loan.objects.count(), loans)
+        self.assertEqual(Book.objects.count(), 40)
+
+    def test_snapshot_cases_report_output_size(self):
+        benchmarks.seed_library(40)
+        results = benchmarks.run_benchmarks(
+            ['serialize_library', 'serialize_library_pickle'], repeat=1, operations=10, memory=False
+        )
+        snapshot, pickled = (r['output_bytes'] for r in results)
+        self.assertLess(snapshot, pickled)
@@ -13,6 +13,8 @@ urlpatterns = [
     path('books/borrow/', views.borrow_book, name='borrow_book'),
     path('books/return/', views.return_book, name='return_book'),
     path('books/borrowed/', views.borrowed_books, name='borrowed_books'),
+    path('books/checkout/', views.checkout_batch, name='checkout_batch'),
+    path('books/checkout/token/', views.checkout_csrf_token, name='checkout_csrf_token'),
 
     # User URLs
     path('users/', views.user_list, name='user_list'),
@@ -34,7 +36,11 @@ urlpatterns = [
     path('files/', views.file_management, name='file_management'),
     path('files/export-books-txt/', views.export_books_txt, name='export_books_txt'),
     path('files/import-books-txt/', views.import_books_txt, name='import_books_txt'),
+    path('files/import-roster/', views.import_roster_file, name='import_roster'),
     path('files/serialize-library/', views.serialize_library, name='serialize_library'),
     path('files/deserialize-library/', views.deserialize_library, name='deserialize_library'),
     path('files/drop-all-data/', views.drop_all_data, name='drop_all_data'),
+
+    # Monitoring
+    path('metrics/', views.prometheus_metrics, name='prometheus_metrics'),
 ]
\ No newline at end of file
@@ -1,34 +1,52 @@
 # library/views.py
-from django.shortcuts import render, redirect, get_object_or_404
+import gzip
+import json
+import logging
+
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from django.contrib import messages
 from django.core.exceptions import ValidationError
-from .models import Book, Student, Pupil
-from .forms import BookForm, StudentForm, PupilForm, BorrowForm, ReturnForm, UserTypeCheckForm
+from django.conf import settings
+from django.db import transaction
+from django.db.models import CharField, Exists, F, OuterRef, Value
+from django.db.models.functions import Coalesce, Concat
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import require_GET, require_POST
+from . import cache, metrics
+from .models import Book, Student, Pupil, Loan
+from .forms import (
+    BookForm, StudentForm, PupilForm, BorrowForm, ReturnForm, UserTypeCheckForm, BookFilterForm,
+    BorrowedBooksFilterForm,
+)
 from .library import Library
+from .checkout import BatchConflict, BatchError, process_batch
+from .exporters import BASIC_COLUMNS, FULL_COLUMNS, iter_books_txt
+from .importers import import_books, iter_lines
+from .rosters import RosterError, import_roster, roster_format
+from .snapshot import SnapshotError, iter_snapshot, restore_snapshot
+from .purge import count_rows, purge_all
+from .routing import replica_reads
+from .pagination import aget_page, akeyset_paginate, keyset_paginate
+from .search import search_books, search_ordering
 
 
-import pickle
-from django.http import HttpResponse
-from django.shortcuts import render, redirect
-from django.contrib import messages
-
+logger = logging.getLogger(__name__)
 
 
 # Text File Operations
+@replica_reads
 def export_books_txt(request):
     """Export books to a text file (books.txt)"""
-    books = Book.objects.all()
+    # ?format=basic keeps the old title,label layout
+    columns = BASIC_COLUMNS if request.GET.get('format') == 'basic' else FULL_COLUMNS
 
-    # Create text content
-    content = ""
-    for book in books:
-        content += f"{book.title},{book.label}\n"
-
-    # Create response with file
-    response = HttpResponse(content, content_type='text/plain')
+    # Stream the file in chunks instead of building it in memory
+    response = StreamingHttpResponse(iter_books_txt(columns), content_type='text/plain; charset=utf-8')
     response['Content-Disposition'] = 'attachment; filename="books.txt"'
 
-    messages.success(request, f"Successfully exported {books.count()} books to books.txt")
+    messages.success(request, "Successfully exported books to books.txt")
     return response
 
 
@@ -37,248 +55,145 @@ def import_books_txt(request):
     if request.method == 'POST' and request.FILES.get('books_file'):
         books_file = request.FILES['books_file']
 
-        # Read and process the file
-        lines = books_file.read().decode('utf-8').splitlines()
+        # Stream the upload line by line and insert in batches
+        try:
+            report = import_books(iter_lines(books_file))
+        except UnicodeDecodeError:
+            messages.error(request, "The books file must be UTF-8 encoded text.")
+            return render(request, 'library/import_books.html')
+        except gzip.BadGzipFile:
+            messages.error(request, "The books file is not a valid gzip file.")
+            return render(request, 'library/import_books.html')
+
+        for error in report['errors']:
+            # Log the error but continue processing
+            logger.info("Rejected import line", extra={
+                'event': 'import.rejected', 'line': error['line'], 'error': error['error'],
+            })
+        logger.info("Books imported", extra={
+            'accepted': report['accepted'], 'rejected': report['rejected'], 'seconds': report['seconds'],
+        })
 
-        books_created = 0
-        for line in lines:
-            if not line.strip():  # Skip empty lines
-                continue
+        messages.success(
+            request,
+            f"Successfully imported {report['accepted']} books "
+            f"({report['rejected']} rejected, {report['rows_per_second']:.0f} rows/sec)."
+        )
+        return render(request, 'library/import_books.html', {'report': report})
 
-            try:
-                # Parse line format: title,author,year,quantity,label
-                parts = line.split(',')
-
-                if len(parts) >= 5:  # Full format with all fields
-                    title = parts[0].strip()
-                    author = parts[1].strip()
-                    year = int(parts[2].strip())
-                    quantity = int(parts[3].strip())
-                    label = parts[4].strip()
-
-                elif len(parts) >= 2:  # Basic format with just title and label
-                    title = parts[0].strip()
-                    author = "Imported Author"  # Default
-                    year = 2023  # Default
-                    quantity = 1  # Default
-                    label = parts[1].strip()
-                else:
-                    continue  # Skip invalid lines
-
-                # Make sure label is valid
-                if label not in ['for children', 'general']:
-                    label = 'general'  # Default to general if invalid
-
-                # Create a new book
-                book = Book(
-                    title=title,
-                    author=author,
-                    isbn=f"IMP{books_created:06d}",  # Generate a unique ISBN
-                    year=year,
-                    quantity=quantity,
-                    label=label
-                )
-                book.save()
-                books_created += 1
-            except Exception as e:
-                # Log the error but continue processing
-                print(f"Error importing line: {line}. Error: {str(e)}")
+    return render(request, 'library/import_books.html')
+
+
+def import_roster_file(request):
+    """Import students and pupils from a CSV or JSONL roster"""
+    if request.method == 'POST' and request.FILES.get('roster_file'):
+        roster_file = request.FILES['roster_file']
+
+        try:
+            report = import_roster(iter_lines(roster_file), roster_format(roster_file.name))
+        except UnicodeDecodeError:
+            messages.error(request, "The roster file must be UTF-8 encoded text.")
+            return render(request, 'library/import_roster.html')
+        except gzip.BadGzipFile:
+            messages.error(request, "The roster file is not a valid gzip file.")
+            return render(request, 'library/import_roster.html')
+        except RosterError as e:
+            messages.error(request, str(e))
+            return render(request, 'library/import_roster.html')
+
+        for error in report['errors']:
+            logger.info("Rejected roster line", extra={
+                'event': 'import.rejected', 'line': error['line'], 'error': error['error'],
+            })
+        logger.info("Roster imported", extra={
+            'students': report['students'], 'pupils': report['pupils'],
+            'rejected': report['rejected'], 'seconds': report['seconds'],
+        })
+
+        messages.success(
+            request,
+            f"Successfully imported {report['students']} students and {report['pupils']} pupils "
+            f"({report['rejected']} rejected, {report['rows_per_second']:.0f} rows/sec)."
+        )
+        return render(request, 'library/import_roster.html', {'report': report})
+
+    return render(request, 'library/import_roster.html')
 
-        messages.success(request, f"Successfully imported {books_created} books.")
-        return redirect('book_list')
 
-    return render(request, 'library/import_books.html')
 # Binary File Operations (Serialization)
+@replica_reads
 def serialize_library(request):
-    """Serialize all library data to a pickle file"""
-    # Get all data
-    books = list(Book.objects.all())
-    students = list(Student.objects.all())
-    pupils = list(Pupil.objects.all())
-
-    # Serialize data
-    library_data = {
-        'books': books,
-        'students': students,
-        'pupils': pupils
-    }
-
-    # Create pickle file
-    serialized_data = pickle.dumps(library_data)
-
-    # Create response with file
-    response = HttpResponse(serialized_data, content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="library.pkl"'
+    """Serialize all library data to a streamed snapshot file"""
+    # ?compress=none gives plain JSON Lines, otherwise gzip
+    compress = request.GET.get('compress') != 'none'
+    filename = 'library.jsonl.gz' if compress else 'library.jsonl'
+
+    content_type = 'application/gzip' if compress else 'application/x-ndjson'
+    response = StreamingHttpResponse(iter_snapshot(compress=compress), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
     messages.success(request, "Library data serialized and downloaded successfully")
     return response
 
 
 def deserialize_library(request):
-    """Deserialize library data from a pickle file"""
+    """Deserialize library data from a snapshot file"""
     if request.method == 'POST' and request.FILES.get('library_file'):
         try:
-            # Read pickle file
             library_file = request.FILES['library_file']
-            library_data = pickle.loads(library_file.read())
-
-            # Check if we got valid data
-            if not isinstance(library_data, dict) or not all(
-                    k in library_data for k in ['books', 'students', 'pupils']):
-                messages.error(request, "Invalid library data file format")
-                return redirect('home')
-
-            # Clear existing data if option is selected
-            if request.POST.get('clear_existing') == 'yes':
-                drop_all_data(request, silent=True)
-
-            # Import books
-            books_count = 0
-            for book_obj in library_data['books']:
-                try:
-                    # Check if this book already exists
-                    existing_book = Book.objects.filter(isbn=book_obj.isbn).first()
-                    if existing_book:
-                        # Update existing book
-                        existing_book.title = book_obj.title
-                        existing_book.author = book_obj.author
-                        existing_book.year = book_obj.year
-                        existing_book.quantity = book_obj.quantity
-                        existing_book.label = book_obj.label
-                        existing_book.save()
-                    else:
-                        # Create new book
-                        book = Book(
-                            title=book_obj.title,
-                            author=book_obj.author,
-                            isbn=book_obj.isbn,
-                            year=book_obj.year,
-                            quantity=book_obj.quantity,
-                            label=book_obj.label
-                        )
-                        book.save()
-                    books_count += 1
-                except Exception as e:
-                    print(f"Error importing book: {str(e)}")
-
-            # Import students
-            students_count = 0
-            for student_obj in library_data['students']:
-                try:
-                    # Check if this student already exists
-                    existing_student = Student.objects.filter(user_id=student_obj.user_id).first()
-                    if existing_student:
-                        # Update existing student
-                        existing_student.name = student_obj.name
-                        existing_student.surname = student_obj.surname
-                        existing_student.group = student_obj.group
-                        existing_student.save()
-                    else:
-                        # Create new student
-                        student = Student(
-                            user_id=student_obj.user_id,
-                            name=student_obj.name,
-                            surname=student_obj.surname,
-                            group=student_obj.group
-                        )
-                        student.save()
-                    students_count += 1
-
-                    # Handle borrowed books
-                    if existing_student:
-                        student = existing_student
-                    else:
-                        student = Student.objects.get(user_id=student_obj.user_id)
-
-                    # Clear existing borrowed books
-                    student.borrowed_books.clear()
-
-                    # Add borrowed books
-                    for book in student_obj.borrowed_books.all():
-                        try:
-                            db_book = Book.objects.get(isbn=book.isbn)
-                            student.borrowed_books.add(db_book)
-                        except Book.DoesNotExist:
-                            print(f"Book with ISBN {book.isbn} not found")
-                except Exception as e:
-                    print(f"Error importing student: {str(e)}")
-
-            # Import pupils
-            pupils_count = 0
-            for pupil_obj in library_data['pupils']:
-                try:
-                    # Check if this pupil already exists
-                    existing_pupil = Pupil.objects.filter(user_id=pupil_obj.user_id).first()
-                    if existing_pupil:
-                        # Update existing pupil
-                        existing_pupil.name = pupil_obj.name
-                        existing_pupil.surname = pupil_obj.surname
-                        existing_pupil.group = pupil_obj.group
-                        existing_pupil.age = pupil_obj.age
-                        existing_pupil.save()
-                    else:
-                        # Create new pupil
-                        pupil = Pupil(
-                            user_id=pupil_obj.user_id,
-                            name=pupil_obj.name,
-                            surname=pupil_obj.surname,
-                            group=pupil_obj.group,
-                            age=pupil_obj.age
-                        )
-                        pupil.save()
-                    pupils_count += 1
-
-                    # Handle borrowed books
-                    if existing_pupil:
-                        pupil = existing_pupil
-                    else:
-                        pupil = Pupil.objects.get(user_id=pupil_obj.user_id)
-
-                    # Clear existing borrowed books
-                    pupil.borrowed_books.clear()
-
-                    # Add borrowed books
-                    for book in pupil_obj.borrowed_books.all():
-                        try:
-                            db_book = Book.objects.get(isbn=book.isbn)
-                            pupil.borrowed_books.add(db_book)
-                        except Book.DoesNotExist:
-                            print(f"Book with ISBN {book.isbn} not found")
-                except Exception as e:
-                    print(f"Error importing pupil: {str(e)}")
+
+            # A bad file must not leave the library half cleared
+            with transaction.atomic():
+                # Clear existing data if option is selected
+                if request.POST.get('clear_existing') == 'yes':
+                    purge_all()
+
+                # Upsert everything set-based in a single transaction
+                counts, missing = restore_snapshot(library_file)
+            if missing:
+                logger.warning("Skipped loans with unknown books or users", extra={'skipped': missing})
 
             messages.success(request,
-                             f"Successfully imported {books_count} books, {students_count} students, and {pupils_count} pupils")
+                             f"Successfully imported {counts['books']} books, {counts['students']} students, "
+                             f"and {counts['pupils']} pupils")
+            return redirect('home')
+        except SnapshotError as e:
+            messages.error(request, f"Invalid library data file: {str(e)}")
             return redirect('home')
         except Exception as e:
             messages.error(request, f"Error deserializing library data: {str(e)}")
             return redirect('home')
 
-    return render(request, 'library/deserialize_library.html')
+    return render(request, 'library/deserialize_html.html')
 
 
-def drop_all_data(request, silent=False):
+def drop_all_data(request):
     """Clear all library data"""
-    # Get counts for display
-    books_count = Book.objects.count()
-    students_count = Student.objects.count()
-    pupils_count = Pupil.objects.count()
-
-    if request.method == 'POST' or silent:
-        # Clear all data
-        Book.objects.all().delete()
-        Student.objects.all().delete()
-        Pupil.objects.all().delete()
-
-        if not silent:
-            messages.success(request, "All library data has been cleared")
-            return redirect('home')
-
+    if request.method == 'POST':
+        # Chunked raw deletes in one transaction; no objects are loaded
+        counts = purge_all(progress=_log_purge_progress)
+        logger.warning("All library data cleared", extra={'event': 'library.purged', **counts})
+        messages.success(request,
+                         f"All library data has been cleared: {counts['books']} books, {counts['students']} students, "
+                         f"{counts['pupils']} pupils and {counts['loans']} borrowing records")
+        return redirect('home')
+
+    # Counts for display, from a single query
+    counts = count_rows()
     return render(request, 'library/drop_all_data.html', {
-        'books_count': books_count,
-        'students_count': students_count,
-        'pupils_count': pupils_count
+        'books_count': counts['books'],
+        'students_count': counts['students'],
+        'pupils_count': counts['pupils'],
+        'loans_count': counts['loans'],
     })
+
+
+def _log_purge_progress(table, deleted, total):
+    logger.info("Purge progress", extra={
+        'event': 'library.purge_progress', 'table': table, 'deleted': deleted, 'total': total,
+    })
+
+
 # File Management Menu
 def file_management(request):
     """Display file management options"""
@@ -303,8 +218,9 @@ def delete_book(request, book_id):
     book = get_object_or_404(Book, id=book_id)
 
     if request.method == 'POST':
-        # First check if anyone has borrowed this book
-        if book.borrowed_by_students.exists() or book.borrowed_by_pupils.exists():
+        # Check the loan table itself: the active_loans counter can drift, and
+        # deleting the book would cascade to any open loan it missed
+        if book.loans.active().exists():
             messages.error(request, 'Cannot delete this book because it is currently borrowed by users.')
             return redirect('book_list')
 
@@ -317,9 +233,44 @@ def home(request):
     return render(request, 'library/home.html')
 
 
-def book_list(request):
+@replica_reads
+async def book_list(request):
+    form = BookFilterForm(request.GET)
     books = Book.objects.all()
-    return render(request, 'library/book_list.html', {'books': books})
+    sort = 'title'
+
+    if form.is_valid():
+        filters = form.cleaned_data
+        if filters['q']:
+            # Ranked full-text prefix search, best matches first by default
+            books = search_books(books, filters['q'])
+            sort = search_ordering()
+        if filters['title']:
+            books = books.filter(title__icontains=filters['title'])
+        if filters['author']:
+            books = books.filter(author__icontains=filters['author'])
+        if filters['label']:
+            books = books.filter(label=filters['label'])
+        if filters['year_min'] is not None:
+            books = books.filter(year__gte=filters['year_min'])
+        if filters['year_max'] is not None:
+            books = books.filter(year__lte=filters['year_max'])
+        sort = filters['sort'] or sort
+
+    # Keyset pagination keeps deep pages as cheap as the first one
+    per_page = getattr(settings, 'LIBRARY_BOOKS_PER_PAGE', 50)
+    page = await akeyset_paginate(books, sort, request.GET.get('cursor'), per_page)
+
+    # Filters and sort carried over to the next page link
+    query = request.GET.copy()
+    query.pop('cursor', None)
+
+    return render(request, 'library/book_list.html', {
+        'books': page,
+        'page': page,
+        'form': form,
+        'query': query.urlencode(),
+    })
 
 
 def add_book(request):
@@ -334,9 +285,11 @@ def add_book(request):
     return render(request, 'library/add_book.html', {'form': form})
 
 
+@replica_reads
 def user_list(request):
-    students = Student.objects.all()
-    pupils = Pupil.objects.all()
+    # Borrowed counts come back with the list query itself
+    students = Student.objects.with_borrowed_count()
+    pupils = Pupil.objects.with_borrowed_count()
     return render(request, 'library/user_list.html', {'students': students, 'pupils': pupils})
 
 
@@ -382,22 +335,17 @@ def borrow_book(request):
             book_id = form.cleaned_data['book_id']
 
             try:
-                # Get the book and user objects
-                book = get_object_or_404(Book, id=book_id)
-                print(f"Book found: {book.title}, Quantity before: {book.quantity}")
+                # Get the book and user objects through the lookup cache
+                book = cache.get_book_or_404(book_id)
 
                 if user_type == 'student':
-                    user = get_object_or_404(Student, user_id=user_id)
+                    user = cache.get_user_or_404(Student, user_id)
                 else:  # pupil
-                    user = get_object_or_404(Pupil, user_id=user_id)
+                    user = cache.get_user_or_404(Pupil, user_id)
 
-                # Process the borrowing
+                # Process the borrowing; it updates book.quantity in place
                 success, message = Library.process_borrowing(user, book)
 
-                # Refresh the book data to get the updated quantity
-                book.refresh_from_db()
-                print(f"After borrowing: {book.title}, Quantity: {book.quantity}")
-
                 if success:
                     messages.success(request, message)
                     # Redirect to book list to see the updated quantity
@@ -406,7 +354,7 @@ def borrow_book(request):
                     messages.error(request, message)
             except Exception as e:
                 messages.error(request, f"Error: {str(e)}")
-                print(f"Exception during borrowing: {str(e)}")
+                logger.exception("Borrow request failed", extra={'user_id': user_id, 'book_id': book_id})
     else:
         form = BorrowForm()
 
@@ -423,22 +371,17 @@ def return_book(request):
             book_id = form.cleaned_data['book_id']
 
             try:
-                # Get the book and user objects
-                book = get_object_or_404(Book, id=book_id)
-                print(f"Book found: {book.title}, Quantity before: {book.quantity}")
+                # Get the book and user objects through the lookup cache
+                book = cache.get_book_or_404(book_id)
 
                 if user_type == 'student':
-                    user = get_object_or_404(Student, user_id=user_id)
+                    user = cache.get_user_or_404(Student, user_id)
                 else:  # pupil
-                    user = get_object_or_404(Pupil, user_id=user_id)
+                    user = cache.get_user_or_404(Pupil, user_id)
 
-                # Process the return
+                # Process the return; it updates book.quantity in place
                 success, message = Library.process_return(user, book)
 
-                # Refresh the book data to get the updated quantity
-                book.refresh_from_db()
-                print(f"After returning: {book.title}, Quantity: {book.quantity}")
-
                 if success:
                     messages.success(request, message)
                     # Redirect to book list to see the updated quantity
@@ -447,13 +390,54 @@ def return_book(request):
                     messages.error(request, message)
             except Exception as e:
                 messages.error(request, f"Error: {str(e)}")
-                print(f"Exception during return: {str(e)}")
+                logger.exception("Return request failed", extra={'user_id': user_id, 'book_id': book_id})
     else:
         form = ReturnForm()
 
     return render(request, 'library/return_book.html', {'form': form})
 
-def check_user_type(request):
+@require_GET
+@ensure_csrf_cookie
+def checkout_csrf_token(request):
+    """Give a checkout desk the CSRF cookie, and the token to send back with it."""
+    return JsonResponse({'csrf_token': get_token(request)})
+
+
+@require_POST
+def checkout_batch(request):
+    """
+    Borrow and return many books in one request, for checkout desks.
+
+    Expects a JSON body like {"items": [{"action": "borrow", "user_id": "20001",
+    "book_id": 7}, ...]} and answers with one result per item.
+
+    The usual CSRF check applies. A desk client first GETs
+    checkout_csrf_token, then sends its csrftoken cookie back with the
+    returned token in an X-CSRFToken header.
+    """
+    try:
+        data = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': "Request body must be JSON."}, status=400)
+
+    try:
+        report = process_batch(data.get('items') if isinstance(data, dict) else None)
+    except BatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except BatchConflict as e:
+        return JsonResponse({'error': f"{e} Please retry."}, status=409)
+    return JsonResponse(report)
+
+
+def prometheus_metrics(request):
+    """Per-view request metrics in the Prometheus text format, for local scrapers only."""
+    allowed = getattr(settings, 'LIBRARY_METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+async def check_user_type(request):
     if request.method == 'POST':
         form = UserTypeCheckForm(request.POST)
         if form.is_valid():
@@ -469,16 +453,16 @@ def check_user_type(request):
     return render(request, 'library/check_user_type.html', {'form': form})
 
 
-def user_books(request, user_type, user_id):
+async def user_books(request, user_type, user_id):
     if user_type == 'student':
-        user = get_object_or_404(Student, user_id=user_id)
+        user = await aget_object_or_404(Student, user_id=user_id)
     else:  # pupil
-        user = get_object_or_404(Pupil, user_id=user_id)
+        user = await aget_object_or_404(Pupil, user_id=user_id)
 
-    borrowed_books = user.borrowed_books.all()
+    loans = [loan async for loan in user.loans.active().select_related('book').order_by('due_at')]
     return render(request, 'library/user_books.html', {
         'user': user,
-        'borrowed_books': borrowed_books
+        'loans': loans
     })
 
 
@@ -546,78 +530,87 @@ def delete_pupil(request, user_id):
     return render(request, 'library/delete_pupil.html', {'pupil': pupil})
 
 
-def borrowed_books(request):
+@replica_reads
+async def borrowed_books(request):
     """Display all books that are currently borrowed."""
-
-    # Get all students who have borrowed books
-    students_with_books = Student.objects.filter(borrowed_books__isnull=False).distinct()
-
-    # Get all pupils who have borrowed books
-    pupils_with_books = Pupil.objects.filter(borrowed_books__isnull=False).distinct()
-
-    # Create a list to hold all borrowing records
-    all_borrowings = []
-
-    # Add student borrowings
-    for student in students_with_books:
-        for book in student.borrowed_books.all():
-            all_borrowings.append({
-                'user_type': 'student',
-                'user_id': student.user_id,
-                'user_name': f"{student.name} {student.surname}",
-                'user_group': student.group,
-                'book_id': book.id,
-                'book_title': book.title,
-                'book_author': book.author,
-                'book_isbn': book.isbn,
-                'book_label': book.get_label_display()
-            })
-
-    # Add pupil borrowings
-    for pupil in pupils_with_books:
-        for book in pupil.borrowed_books.all():
-            all_borrowings.append({
-                'user_type': 'pupil',
-                'user_id': pupil.user_id,
-                'user_name': f"{pupil.name} {pupil.surname}",
-                'user_group': pupil.group,
-                'user_age': pupil.age,
-                'book_id': book.id,
-                'book_title': book.title,
-                'book_author': book.author,
-                'book_isbn': book.isbn,
-                'book_label': book.get_label_display()
-            })
-
-    # Sort the borrowings by user name and then book title
-    all_borrowings.sort(key=lambda x: (x['user_name'], x['book_title']))
-
-    # Count total borrowings
-    total_borrowings = len(all_borrowings)
+    # Optional filter used by the admin "View Borrowers" link; an invalid one is ignored
+    form = BorrowedBooksFilterForm(request.GET)
+    book_id = form.cleaned_data['book_id'] if form.is_valid() else None
+    book = await Book.objects.filter(id=book_id).afirst() if book_id is not None else None
+
+    loans = Loan.objects.active()
+    if book_id is not None:
+        loans = loans.filter(book_id=book_id)
+
+    # Every open loan in one joined query, sorted and paged by the database
+    all_borrowings = loans.values(
+        'book_id',
+        'borrowed_at',
+        'due_at',
+        user_type=F('borrower_type'),
+        user_id=Coalesce('student__user_id', 'pupil__user_id'),
+        # Concat() treats NULL parts as '', so coalesce each part rather than the whole name
+        user_name=Concat(
+            Coalesce('student__name', 'pupil__name'), Value(' '),
+            Coalesce('student__surname', 'pupil__surname'),
+            output_field=CharField(),
+        ),
+        user_group=Coalesce('student__group', 'pupil__group'),
+        user_age=F('pupil__age'),
+        book_title=F('book__title'),
+        book_author=F('book__author'),
+        book_isbn=F('book__isbn'),
+        book_label=F('book__label'),
+    ).order_by('user_name', 'book_title', 'id')
+
+    per_page = getattr(settings, 'LIBRARY_BORROWINGS_PER_PAGE', 50)
+    page = await aget_page(all_borrowings, per_page, request.GET.get('page'))
+
+    labels = dict(Book.LABEL_CHOICES)
+    for borrowing in page:
+        borrowing['book_label'] = labels.get(borrowing['book_label'], borrowing['book_label'])
 
     # Count unique borrowers
-    unique_borrowers = len(students_with_books) + len(pupils_with_books)
+    unique_borrowers = await loans.values('student_id', 'pupil_id').distinct().acount()
 
     return render(request, 'library/borrowed_books.html', {
-        'borrowings': all_borrowings,
-        'total_borrowings': total_borrowings,
+        'borrowings': page,
+        'page_obj': page,
+        'book': book,
+        'total_borrowings': page.paginator.count,
         'unique_borrowers': unique_borrowers
     })
 
 
-def edit_borrowing(request, user_type, user_id, book_id):
-    # Get the book and user
-    book = get_object_or_404(Book, id=book_id)
+def swap_candidates(user, current_book, query=''):
+    """In-stock books ``user`` may borrow instead of ``current_book``, optionally searched."""
+    books = user.borrowable_books().filter(quantity__gt=0).exclude(pk=current_book.pk)
+    # Leave out books the user already has; borrowing them again would fail
+    on_loan = Loan.objects.active().filter(book=OuterRef('pk'), **{user.borrower_type: user})
+    books = books.exclude(Exists(on_loan))
+    if query:
+        books = search_books(books, query)
+    return books
 
-    if user_type == 'student':
-        user = get_object_or_404(Student, user_id=user_id)
-    else:  # pupil
-        user = get_object_or_404(Pupil, user_id=user_id)
 
-    # Verify that the user has borrowed this book
-    if book not in user.borrowed_books.all():
+def edit_borrowing(request, user_type, user_id, book_id):
+    model = Student if user_type == 'student' else Pupil
+
+    # The open loan, its book and its borrower in one indexed lookup
+    loan = (
+        Loan.objects.active()
+        .filter(book_id=book_id, **{f'{model.borrower_type}__user_id': user_id})
+        .select_related('book', model.borrower_type)
+        .first()
+    )
+    if loan is None:
+        # 404 for an unknown book or user, otherwise it just isn't on loan
+        cache.get_book_or_404(book_id)
+        cache.get_user_or_404(model, user_id)
         messages.error(request, f"This {user_type} has not borrowed this book.")
         return redirect('user_books', user_type=user_type, user_id=user_id)
+    book = loan.book
+    user = loan.borrower
 
     if request.method == 'POST':
         # Process the form: replace the borrowed book with another one
@@ -641,32 +634,39 @@ def edit_borrowing(request, user_type, user_id, book_id):
                 messages.error(request, "The selected book is not available.")
                 return redirect('edit_borrowing', user_type=user_type, user_id=user_id, book_id=book_id)
 
-            # Process the swap: return the old book and borrow the new one
-            user.borrowed_books.remove(book)
-            book.quantity += 1
-            book.save()
-
-            user.borrowed_books.add(new_book)
-            new_book.quantity -= 1
-            new_book.save()
+            # Process the swap: return the old book and borrow the new one, or neither
+            with transaction.atomic():
+                swapped = user.return_book(book) and user.borrow_book(new_book)
+                if not swapped:
+                    transaction.set_rollback(True)
+            if not swapped:
+                messages.error(request, "The selected book is not available.")
+                return redirect('edit_borrowing', user_type=user_type, user_id=user_id, book_id=book_id)
 
             messages.success(request, f"Successfully swapped '{book.title}' for '{new_book.title}'.")
             return redirect('user_books', user_type=user_type, user_id=user_id)
 
-        except Book.DoesNotExist:
+        except (Book.DoesNotExist, ValueError):
             messages.error(request, "The selected book was not found.")
             return redirect('edit_borrowing', user_type=user_type, user_id=user_id, book_id=book_id)
 
-    # If GET request, show the form with available books
-    # Only show books that the user can borrow
-    if user_type == 'student':
-        available_books = Book.objects.filter(quantity__gt=0).exclude(id=book_id)
-    else:  # pupil
-        available_books = Book.objects.filter(quantity__gt=0, label='for children').exclude(id=book_id)
+    # If GET request, show one page of the books this user could take
+    # instead, searchable, however large the catalogue is
+    search = request.GET.get('q', '').strip()
+    candidates = swap_candidates(user, book, search)
+    per_page = getattr(settings, 'LIBRARY_PICKER_PER_PAGE', 25)
+    page = keyset_paginate(candidates, search_ordering() if search else 'title',
+                           request.GET.get('cursor'), per_page)
+
+    query = request.GET.copy()
+    query.pop('cursor', None)
 
     return render(request, 'library/edit_borrowing.html', {
         'user': user,
         'user_type': user_type,
         'current_book': book,
-        'available_books': available_books
+        'available_books': page,
+        'page': page,
+        'search': search,
+        'query': query.urlencode(),
     })
\ No newline at end of file
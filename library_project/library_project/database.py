@@ -0,0 +1,124 @@
+"""
+Database configuration from the environment.
+
+settings.py builds DATABASES['default'] with database_config(os.environ).
+LIBRARY_DB_ENGINE picks the profile:
+
+sqlite (default)
+    LIBRARY_DB_NAME defaults to db.sqlite3 next to manage.py. Transactions
+    start with BEGIN IMMEDIATE (LIBRARY_SQLITE_TRANSACTION_MODE), so a
+    writer waits for the lock up front instead of failing with "database
+    is locked" when it tries to upgrade a read lock. busy_timeout and the
+    synchronous level come from sqlite_pragmas() and are set on every new
+    connection by library.sqlite. LIBRARY_SQLITE_WAL=1 switches the
+    database to the WAL journal as well. It is off by default because
+    the journal mode is stored in the database file and WAL leaves -wal
+    and -shm files beside it, which the sample db.sqlite3 in the
+    repository should not get from a plain manage.py command.
+
+postgresql
+    LIBRARY_DB_NAME, _USER, _PASSWORD, _HOST and _PORT locate the server.
+    With LIBRARY_DB_POOL=1, connections come from a psycopg pool
+    (LIBRARY_DB_POOL_MIN_SIZE, _MAX_SIZE, _TIMEOUT); this needs
+    psycopg[pool]. Without it, connections persist for
+    LIBRARY_DB_CONN_MAX_AGE seconds. Django does not allow both at once.
+    Health checks are on either way, so a connection the server dropped
+    is replaced rather than failing the next request.
+
+A read replica is configured by LIBRARY_DB_REPLICA_NAME (SQLite file or
+PostgreSQL database) and, for PostgreSQL, LIBRARY_DB_REPLICA_HOST and
+_PORT. Any setting not given is the same as the primary's. Library
+report views read from it (see library.routing). Under test it mirrors
+the primary, as Django recommends for replicas. To try it locally with
+SQLite, point it at a copy of db.sqlite3 and re-copy the file to
+"replicate".
+
+LIBRARY_DB_TEST_NAME names the database that tests and benchmarks create.
+Use a file path to run the SQLite profile against a real file rather
+than in memory.
+"""
+ENGINES = {
+    'sqlite': 'django.db.backends.sqlite3',
+    'postgresql': 'django.db.backends.postgresql',
+}
+
+DEFAULT_SQLITE_PRAGMAS = {
+    # Milliseconds a connection waits for a lock before giving up
+    'busy_timeout': 5000,
+}
+# Added with LIBRARY_SQLITE_WAL; NORMAL is only safe from corruption under WAL
+WAL_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+DEFAULT_CONN_MAX_AGE = 60
+DEFAULT_POOL = {'min_size': 2, 'max_size': 10, 'timeout': 10}
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def _flag(environ, name):
+    return environ.get(name, '').strip().lower() in TRUE_VALUES
+
+
+def sqlite_pragmas(environ):
+    """The PRAGMAs for each new SQLite connection, from LIBRARY_SQLITE_<NAME> overrides."""
+    defaults = dict(DEFAULT_SQLITE_PRAGMAS)
+    if _flag(environ, 'LIBRARY_SQLITE_WAL'):
+        defaults.update(WAL_SQLITE_PRAGMAS)
+    pragmas = {}
+    for name in {**DEFAULT_SQLITE_PRAGMAS, **WAL_SQLITE_PRAGMAS}:
+        value = environ.get(f'LIBRARY_SQLITE_{name.upper()}', defaults.get(name))
+        if value is not None:
+            pragmas[name] = value
+    return pragmas
+
+
+def database_config(environ, base_dir=None):
+    """A DATABASES entry for the profile selected by ``environ``."""
+    engine = environ.get('LIBRARY_DB_ENGINE', 'sqlite')
+    if engine not in ENGINES:
+        raise ValueError(f"LIBRARY_DB_ENGINE must be one of {', '.join(ENGINES)}, not {engine!r}")
+
+    config = {'ENGINE': ENGINES[engine]}
+    if environ.get('LIBRARY_DB_TEST_NAME'):
+        config['TEST'] = {'NAME': environ['LIBRARY_DB_TEST_NAME']}
+
+    if engine == 'sqlite':
+        config['NAME'] = environ.get('LIBRARY_DB_NAME') or base_dir / 'db.sqlite3'
+        config['OPTIONS'] = {'transaction_mode': environ.get('LIBRARY_SQLITE_TRANSACTION_MODE', 'IMMEDIATE')}
+        return config
+
+    config.update({
+        'NAME': environ.get('LIBRARY_DB_NAME', 'library'),
+        'USER': environ.get('LIBRARY_DB_USER', ''),
+        'PASSWORD': environ.get('LIBRARY_DB_PASSWORD', ''),
+        'HOST': environ.get('LIBRARY_DB_HOST', ''),
+        'PORT': environ.get('LIBRARY_DB_PORT', ''),
+        'CONN_HEALTH_CHECKS': True,
+    })
+    if _flag(environ, 'LIBRARY_DB_POOL'):
+        # The pool keeps connections open; Django must close its handle after each request
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS'] = {'pool': {
+            name: int(environ.get(f'LIBRARY_DB_POOL_{name.upper()}', default))
+            for name, default in DEFAULT_POOL.items()
+        }}
+    else:
+        config['CONN_MAX_AGE'] = int(environ.get('LIBRARY_DB_CONN_MAX_AGE', DEFAULT_CONN_MAX_AGE))
+    return config
+
+
+def replica_config(environ, base_dir=None):
+    """A DATABASES entry for the read replica, or None if none is configured."""
+    overrides = {
+        key: environ[f'LIBRARY_DB_REPLICA_{key}']
+        for key in ('NAME', 'HOST', 'PORT')
+        if environ.get(f'LIBRARY_DB_REPLICA_{key}')
+    }
+    if not overrides:
+        return None
+    config = database_config(environ, base_dir)
+    config.update(overrides)
+    config['TEST'] = {'MIRROR': 'default'}
+    return config
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 
+from .database import database_config, replica_config, sqlite_pragmas
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,6 +43,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack
+    'library.middleware.MetricsMiddleware',
+    'library.middleware.RequestIdMiddleware',
+    # Keeps a user's reads on the primary just after they write
+    'library.middleware.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,13 +80,88 @@ WSGI_APPLICATION = 'library_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Chosen by LIBRARY_DB_ENGINE and friends; see library_project/database.py
+
 DATABASES = {
+    'default': database_config(os.environ, BASE_DIR),
+}
+
+# Optional read replica for the report views; see library/routing.py
+LIBRARY_REPLICA_DATABASE = 'replica'
+if replica := replica_config(os.environ, BASE_DIR):
+    DATABASES[LIBRARY_REPLICA_DATABASE] = replica
+DATABASE_ROUTERS = ['library.routing.ReplicaRouter']
+# Seconds a user's reads stay on the primary after they write
+LIBRARY_REPLICA_LAG_SECONDS = 10
+
+# Set on every new SQLite connection by library.sqlite
+LIBRARY_SQLITE_PRAGMAS = sqlite_pragmas(os.environ)
+
+
+# Cache used by library.cache for book and user lookups
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.environ.get('LIBRARY_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('LIBRARY_CACHE_LOCATION', 'library'),
     }
 }
 
+LIBRARY_CACHE_TIMEOUT = 300
+
+# Requests running more SQL queries than this log a warning from library.metrics;
+# LIBRARY_QUERY_BUDGETS = {'url_name': n} overrides it per view, None disables it
+LIBRARY_QUERY_BUDGET = 50
+LIBRARY_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+
+# Logging
+# Library loggers write JSON lines to stderr through a queue, so requests
+# never wait on I/O; see library/log.py
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'library.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'request_context': {
+            '()': 'library.log.RequestContextFilter',
+        },
+        'sampling': {
+            '()': 'library.log.SamplingFilter',
+        },
+    },
+    'handlers': {
+        'queue': {
+            'class': 'library.log.QueueListenerHandler',
+            'formatter': 'json',
+            'filters': ['request_context', 'sampling'],
+        },
+    },
+    'loggers': {
+        'library': {
+            'handlers': ['queue'],
+            'level': os.environ.get('LIBRARY_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Keeps the JSON log lines out of the test output
+TEST_RUNNER = 'library.test_runner.QuietLoggingRunner'
+
+# Fraction of each high-volume event that is logged; unlisted events are all kept
+LIBRARY_LOG_SAMPLE_RATES = {
+    'loan.opened': 0.1,
+    'loan.closed': 0.1,
+    'import.rejected': 0.1,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators